@@ -0,0 +1,84 @@
+"""
+AutoCrop のクロップ領域検出のマイクロベンチマーク
+輪郭を塗りつぶしたマスクと np.where で領域を求める従来の方法と、エッジの行・列の射影から求める現在の方法について、
+処理時間とピークメモリ (tracemalloc で計測した NumPy/OpenCV の配列) を比較する。
+
+使い方 (リポジトリのルートで実行):
+    python TEST/bench_autocrop.py --sizes 2000x1500 6000x8000 --repeat 3
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from ImageEditor import AutoCrop
+
+def legacy_content_box(np_image: np.ndarray) -> tuple[int, int, int, int] | None:
+    """変更前の _get_crop_area と同じ方法で (x_min, y_min, x_max, y_max) を求める"""
+    complementary_color = [255 - np.mean(np_image[..., i]) for i in range(3)]
+    background = np.full(np_image.shape, complementary_color, dtype=np.uint8)
+    diff = cv2.absdiff(np_image, background)
+    gray_diff = AutoCrop._convert_to_gray(diff)
+    blurred_diff = cv2.GaussianBlur(gray_diff, (5, 5), 0)
+    thresh = cv2.adaptiveThreshold(blurred_diff, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    edges = cv2.Canny(thresh, threshold1=30, threshold2=100)
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    mask = np.zeros(np_image.shape[:2], dtype=np.uint8)
+    for contour in contours:
+        cv2.drawContours(mask, [contour], -1, 255, thickness=cv2.FILLED)
+    y_coords, x_coords = np.where(mask == 255)
+    if len(x_coords) == 0:
+        return None
+    return int(np.min(x_coords)), int(np.min(y_coords)), int(np.max(x_coords)), int(np.max(y_coords))
+
+def current_content_box(np_image: np.ndarray) -> tuple[int, int, int, int] | None:
+    """現在の AutoCrop._detect_content_box で (x_min, y_min, x_max, y_max) を求める"""
+    autocrop = AutoCrop()
+    return autocrop._detect_content_box(np_image, autocrop._complementary_color(np_image))
+
+def make_letterbox_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """上下に黒い帯のある、なめらかなノイズの画像を作る"""
+    rng = np.random.default_rng(seed)
+    border = height // 10
+    content = rng.integers(0, 256, (max(1, (height - 2 * border) // 50), max(1, width // 50), 3), dtype=np.uint8)
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[border:height - border] = cv2.resize(content, (width, height - 2 * border), interpolation=cv2.INTER_CUBIC)
+    return image
+
+def measure(func, np_image: np.ndarray, repeat: int) -> tuple[float, float, tuple]:
+    """最短の処理時間 (秒) とピークメモリ (MB) と結果を返す"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(np_image)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(np_image)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 1024 ** 2, result
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoCrop のクロップ領域検出のベンチマーク")
+    parser.add_argument("--sizes", nargs="+", default=["2000x1500", "4000x3000", "6000x8000"],
+                        help="画像サイズ (幅x高さ)")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数")
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'method':>8} {'time [s]':>9} {'peak [MB]':>10}  box")
+    for size in args.sizes:
+        width, height = (int(value) for value in size.split("x"))
+        np_image = make_letterbox_image(width, height)
+        for name, func in (("legacy", legacy_content_box), ("current", current_content_box)):
+            seconds, peak, box = measure(func, np_image, args.repeat)
+            print(f"{size:>10} {name:>8} {seconds:9.3f} {peak:10.1f}  {box}")
+
+if __name__ == "__main__":
+    main()
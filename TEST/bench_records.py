@@ -0,0 +1,86 @@
+"""
+検索結果の行の生成方法のマイクロベンチマーク
+SQLiteManager.dict_factory で行ごとに辞書を作る方法と、record_type に ImageRecord (sqlite3.Row) を指定する方法について、
+images テーブルの全件を fetchall した時の処理時間とピークメモリ (tracemalloc で計測した Python オブジェクト) を比較する。
+
+使い方 (リポジトリのルートで実行):
+    python TEST/bench_records.py --rows 500000 --repeat 3
+"""
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from module.db import SQLiteManager
+from module.records import ImageRecord
+
+def create_database(db_path: Path, rows: int) -> None:
+    """images テーブルと同じ列を持つテーブルに rows 行を追加する"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE images (
+            id INTEGER PRIMARY KEY, uuid TEXT, phash TEXT, phash_int INTEGER, stored_image_path TEXT,
+            width INTEGER, height INTEGER, format TEXT, mode TEXT, has_alpha BOOLEAN, filename TEXT,
+            extension TEXT, color_space TEXT, icc_profile TEXT, created_at TIMESTAMP, updated_at TIMESTAMP,
+            content_hash TEXT
+        )
+    """)
+    created_at = "2024-09-26T20:21:08.451199"
+    conn.executemany(
+        "INSERT INTO images VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((str(uuid.uuid4()), f"{i:016x}", i, f"image_dataset/original_images/{i:08d}.webp", 1024, 768, "WEBP",
+          "RGB", False, f"{i:08d}.webp", "webp", "sRGB", None, created_at, created_at, f"{i:064x}")
+         for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+def fetch_dicts(conn: sqlite3.Connection) -> list:
+    cursor = conn.cursor()
+    cursor.row_factory = SQLiteManager.dict_factory
+    return cursor.execute("SELECT * FROM images").fetchall()
+
+def fetch_records(conn: sqlite3.Connection) -> list:
+    cursor = conn.cursor()
+    cursor.row_factory = ImageRecord
+    return cursor.execute("SELECT * FROM images").fetchall()
+
+def measure(func, conn: sqlite3.Connection, repeat: int) -> tuple[float, float]:
+    """最短の処理時間 (秒) とピークメモリ (MB) を返す"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(conn)
+        times.append(time.perf_counter() - start)
+        del result
+    tracemalloc.start()
+    result = func(conn)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return min(times), peak / 1024 ** 2
+
+def main():
+    parser = argparse.ArgumentParser(description="検索結果の行の生成方法のベンチマーク")
+    parser.add_argument("--rows", type=int, default=500000, help="images テーブルの行数")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = Path(temp_dir) / "bench_records.db"
+        create_database(db_path, args.rows)
+        conn = sqlite3.connect(db_path)
+        try:
+            print(f"{'rows':>8} {'method':>12} {'time [s]':>9} {'peak [MB]':>10}")
+            for name, func in (("dict_factory", fetch_dicts), ("ImageRecord", fetch_records)):
+                seconds, peak = measure(func, conn, args.repeat)
+                print(f"{args.rows:>8} {name:>12} {seconds:9.3f} {peak:10.1f}")
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -118,7 +118,9 @@ def test_on_filter_applied(qtbot, mock_config_manager, mock_file_system_manager,
             use_and=case['expected_use_and'],
             start_date=None,
             end_date=None,
-            include_untagged=case['expected_include_untagged']
+            include_untagged=case['expected_include_untagged'],
+            limit=DatasetExportWidget.PAGE_SIZE,
+            after_id=None
         )
 
         if case['expect_no_results']:
@@ -149,6 +151,26 @@ def test_on_filter_applied(qtbot, mock_config_manager, mock_file_system_manager,
         mock_update_thumbnail_selector.reset_mock()
         mock_critical.reset_mock()
 
+def test_on_filter_applied_paging(qtbot, mock_config_manager, mock_file_system_manager,
+                                  mock_image_database_manager, mocker):
+    """検索結果を PAGE_SIZE 件ずつ after_id で取得し、全ページのidとpathの対応を残すことの確認"""
+    widget = DatasetExportWidget()
+    widget.initialize(mock_config_manager, mock_file_system_manager, mock_image_database_manager)
+    qtbot.addWidget(widget)
+    mocker.patch.object(DatasetExportWidget, 'PAGE_SIZE', 2)
+    pages = [[{'image_id': i, 'stored_image_path': f'/path/to/image{i}.jpg'} for i in ids] for ids in ([1, 2], [3])]
+    mock_image_database_manager.get_images_by_filter.side_effect = [(pages[0], 3), (pages[1], 1)]
+    mock_update_thumbnail_selector = mocker.patch.object(widget, 'update_thumbnail_selector')
+
+    widget.on_filter_applied({'filter_type': 'tags', 'filter_text': 'tag1', 'resolution': 0,
+                              'use_and': True, 'include_untagged': False})
+
+    calls = mock_image_database_manager.get_images_by_filter.call_args_list
+    assert [(c.kwargs['limit'], c.kwargs['after_id']) for c in calls] == [(2, None), (2, 2)]
+    assert list(widget.image_path_id_map.values()) == [1, 2, 3]
+    mock_update_thumbnail_selector.assert_called_once_with(list(widget.image_path_id_map.keys()), 3)
+    mock_image_database_manager.get_images_by_filter.side_effect = None
+
 def test_on_exportButton_clicked_no_export_directory(qtbot, mock_config_manager, mock_file_system_manager, mock_image_database_manager, mocker):
     widget = DatasetExportWidget()
     widget.initialize(mock_config_manager, mock_file_system_manager, mock_image_database_manager)
@@ -227,7 +249,7 @@ def test_on_exportButton_clicked_no_export_formats(qtbot, mock_config_manager, m
             {
                 Path('/path/to/image1.jpg'): 1
             },
-            Exception("Database error"),  # get_image_annotations が例外を投げる
+            Exception("Database error"),  # get_annotations_for_images が例外を投げる
             False,
             True,   # expect_critical: エラーダイアログが表示される
             False,
@@ -256,12 +278,13 @@ def test_export_dataset(qtbot, mock_config_manager, mock_file_system_manager,
     # image_path_id_map を設定
     widget.image_path_id_map = image_path_id_map
 
-    # get_image_annotations の返り値を設定
+    # get_annotations_for_images の返り値を設定
     if isinstance(annotations_list, Exception):
         # 例外を発生させる
-        mock_image_database_manager.get_image_annotations.side_effect = annotations_list
+        mock_image_database_manager.get_annotations_for_images.side_effect = annotations_list
     else:
-        mock_image_database_manager.get_image_annotations.side_effect = annotations_list
+        mock_image_database_manager.get_annotations_for_images.return_value = dict(
+            zip(image_path_id_map.values(), annotations_list))
 
     # FileSystemManager のメソッドをモック
     mock_file_system_manager.export_dataset_to_txt = mocker.Mock()
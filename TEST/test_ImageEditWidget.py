@@ -54,7 +54,8 @@ def test_process_all_images(widget, mocker):
     # idm のモックを明示的に設定
     widget.idm = mocker.Mock()
     widget.idm.get_image_id_by_name.return_value = None  # 画像IDが存在しないと仮定
-    widget.idm.register_original_image.return_value = (1, {'has_alpha': False, 'mode': 'RGB'})
+    widget.idm.store_original_image.return_value = (None, {'has_alpha': False, 'mode': 'RGB', 'stored_image_path': 'stored.png'})
+    widget.idm.add_stored_original_image.return_value = 1
 
     progress_callback = mocker.Mock()
     status_callback = mocker.Mock()
@@ -62,7 +63,60 @@ def test_process_all_images(widget, mocker):
 
     widget.process_all_images(progress_callback=progress_callback, status_callback=status_callback, is_canceled=is_canceled)
 
-    assert widget.idm.register_original_image.call_count == len(test_image_paths)
+    assert widget.idm.store_original_image.call_count == len(test_image_paths)
+    assert widget.idm.add_stored_original_image.call_count == len(test_image_paths)
+
+def test_process_all_images_pipeline(widget, mocker):
+    """保存スレッドを使うパイプラインで入力順に進捗とDB登録が行われることの確認"""
+    test_image_paths = [Path(f'test_image{i}.png') for i in range(4)]
+    widget.directory_images = test_image_paths
+    widget.upscaler = None
+    widget.cm.config['image_processing'].update({'process_workers': 1, 'io_workers': 2, 'max_pending_images': 2})
+
+    mocker.patch('src.ImageEditWidget.ImageAnalyzer.get_existing_annotations', return_value=None)
+    widget.ipm = mocker.Mock()
+    widget.ipm.process_image.return_value = 'processed_image_data'
+    widget.idm = mocker.MagicMock()
+    widget.idm.detect_duplicate_image.return_value = None
+    widget.idm.store_original_image.return_value = (None, {'has_alpha': False, 'mode': 'RGB', 'stored_image_path': 'stored.png'})
+    widget.idm.add_stored_original_image.side_effect = range(4)
+    widget.idm.check_processed_image_exists.side_effect = [None, {'id': 1}, None, None]  # 2枚目は保存済み
+    widget.fsm.save_processed_image.side_effect = lambda image, path: Path(f'processed_{path.stem}.webp')
+    widget.fsm.get_image_info.return_value = {'width': 512, 'height': 512}
+
+    progress_callback = mocker.Mock()
+    widget.process_all_images(progress_callback=progress_callback)
+
+    assert [c.args[0] for c in progress_callback.call_args_list] == [25, 50, 75, 100]
+    assert widget.ipm.process_image.call_count == 3
+    assert [c.args[0] for c in widget.idm.register_processed_image.call_args_list] == [0, 2, 3]
+    # 画像ごとの登録と、処理済み画像の登録をまとめた短い transaction でコミットし、処理の完了待ちの間は書き込みロックを持たない
+    widget.idm.batch_transaction.assert_not_called()
+    assert widget.idm.transaction.call_count == 5
+
+def test_process_all_images_copy_outside_transaction(widget, mocker):
+    """オリジナル画像のコピーは transaction の外で行い、保存に失敗した画像はスキップすることの確認"""
+    widget.directory_images = [Path('test_image0.png'), Path('test_image1.png')]
+    widget.upscaler = None
+    widget.cm.config['image_processing'].update({'process_workers': 1, 'io_workers': 1, 'max_pending_images': 2})
+
+    mocker.patch('src.ImageEditWidget.ImageAnalyzer.get_existing_annotations', return_value=None)
+    widget.ipm = mocker.Mock()
+    widget.ipm.process_image.return_value = None
+    widget.idm = mocker.MagicMock()
+    widget.idm.detect_duplicate_image.return_value = None
+    events = []
+    widget.idm.transaction.return_value.__enter__.side_effect = lambda: events.append('begin')
+    widget.idm.transaction.return_value.__exit__.side_effect = lambda *args: events.append('end')
+    stored = [None, (None, {'has_alpha': False, 'mode': 'RGB', 'stored_image_path': 'stored.png'})]
+    widget.idm.store_original_image.side_effect = lambda *args: events.append('store') or stored.pop(0)
+    widget.idm.add_stored_original_image.side_effect = lambda *args: events.append('add') or 1
+    widget.idm.check_processed_image_exists.return_value = None
+
+    widget.process_all_images()
+
+    assert events == ['store', 'store', 'begin', 'add', 'end']
+    assert widget.idm.save_annotations.call_count == 1
 
 def test_on_pushButtonStartProcess_clicked(widget, mocker):
     mock_initialize_processing = mocker.patch.object(widget, 'initialize_processing')
@@ -1,10 +1,12 @@
 # TEST/test_Image_Editor.py
 
+import uuid
 import pytest
+import numpy as np
 from pathlib import Path
 from PIL import Image, ImageDraw
 from ImageEditor import ImageProcessingManager, ImageProcessor, AutoCrop, Upscaler
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 @pytest.mark.parametrize("image_type, has_alpha, mode", [
     ("rgb", False, 'RGB'),
@@ -90,6 +92,127 @@ def test_process_image_rgba_with_alpha(mock_file_system_manager, sample_images,
     assert resized_image.mode == 'RGBA'
     # サイズはレターボックスの有無により異なる場合があります
 
+def test_reduction_scale(mock_file_system_manager, preferred_resolutions):
+    processor = ImageProcessor(mock_file_system_manager, target_resolution=512, preferred_resolutions=preferred_resolutions)
+    # 長辺が出力サイズの最大値を下回らない範囲で2のべき乗に縮小する
+    assert processor.max_output_side() == 1216
+    assert processor.reduction_scale(12000, 8000) == 8
+    assert processor.reduction_scale(6000, 4000) == 4
+    assert processor.reduction_scale(1500, 1000) == 1
+    assert processor.is_large_enough(1500, 1000)
+    assert not processor.is_large_enough(500, 300)
+
+@pytest.mark.parametrize("suffix", [".jpg", ".png"])
+def test_process_image_reduced_decode(mock_file_system_manager, preferred_resolutions, tmp_path, suffix):
+    """大きな画像は縮小して読み込み、元の解像度で処理した場合と同じサイズの画像を出力することの確認"""
+    image = Image.new('RGB', (4000, 3000), color='black')
+    ImageDraw.Draw(image).rectangle([0, 300, 4000, 2700], fill='red')
+    path = tmp_path / f"reduced_decode{suffix}"
+    image.save(path)
+    manager = ImageProcessingManager(mock_file_system_manager, 512, preferred_resolutions)
+
+    loaded_sizes = []
+    load_reduced = ImageProcessor.load_reduced
+    def record(img, scale):
+        reduced = load_reduced(img, scale)
+        loaded_sizes.append(reduced.size)
+        return reduced
+    with patch.object(ImageProcessor, 'load_reduced', side_effect=record):
+        resized_image = manager.process_image(path, False, 'RGB')
+    assert loaded_sizes == [(2000, 1500)]
+
+    # 縮小しない場合と同じサイズになる
+    with patch.object(ImageProcessor, 'reduction_scale', return_value=1):
+        expected_image = manager.process_image(path, False, 'RGB')
+    assert resized_image.size == expected_image.size
+
+def test_process_image_reduced_decode_fallback(mock_file_system_manager, preferred_resolutions, tmp_path):
+    """クロップ後の画像が出力サイズに足りない場合は元の解像度で読み込み直すことの確認"""
+    image = Image.new('RGB', (3200, 3200), color='black')
+    ImageDraw.Draw(image).rectangle([1400, 1400, 1800, 1800], fill='red')
+    path = tmp_path / "reduced_decode_fallback.png"
+    image.save(path)
+    manager = ImageProcessingManager(mock_file_system_manager, 512, preferred_resolutions)
+    with patch('ImageEditor.Image.open', wraps=Image.open) as image_open:
+        manager.process_image(path, False, 'RGB')
+    assert image_open.call_count == 2
+
+@pytest.fixture
+def tiny_upscaler_model(tmp_path):
+    """重みを乱数で初期化した小さな4倍の ESRGAN を保存し、Upscaler.MODEL_PATHS に登録する"""
+    import torch
+    from spandrel.architectures.ESRGAN import ESRGAN
+
+    torch.manual_seed(0)
+    model_path = tmp_path / f"tiny_x4_{uuid.uuid4().hex}.pth"
+    torch.save(ESRGAN(num_filters=8, num_blocks=1, scale=4).state_dict(), model_path)
+    Upscaler.clear_cache()
+    with patch.dict(Upscaler.MODEL_PATHS, {"tiny_x4": (model_path, 4.0)}):
+        yield "tiny_x4"
+    Upscaler.clear_cache()
+
+def test_split_tiles():
+    """タイルの窓がすべて同じ大きさで画像の内側に収まり、結果を使う領域が画像を重なりなく覆うことの確認"""
+    window_size, tiles = Upscaler._split_tiles(100, 70, 32, 8)
+    assert window_size == (48, 48)
+    covered = np.zeros((100, 70), dtype=int)
+    for (y0, x0, y1, x1), (top, left) in tiles:
+        assert 0 <= top <= y0 and y1 <= top + 48 <= 100
+        assert 0 <= left <= x0 and x1 <= left + 48 <= 70
+        covered[y0:y1, x0:x1] += 1
+    assert (covered == 1).all()
+    assert Upscaler._split_tiles(20, 30, 32, 8) == ((20, 30), [((0, 0, 20, 30), (0, 0))])
+
+def test_upscale_image_tiled(tiny_upscaler_model):
+    """モデルを1回だけ読み込み、タイルに分割してまとめて推論しても画像全体で推論した結果と一致することの確認"""
+    from spandrel import ModelLoader
+
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)).resize((width * 2, height * 2))
+              for height, width in [(30, 40), (30, 40), (12, 16)]]
+    with patch.object(ModelLoader, 'load_from_file', autospec=True, side_effect=ModelLoader.load_from_file) as load:
+        whole = [Upscaler.upscale_image(img, tiny_upscaler_model, tile_size=0) for img in images]
+        tiled = [Upscaler.upscale_image(img, tiny_upscaler_model, tile_size=24, tile_overlap=16, batch_size=3)
+                 for img in images]
+        single = Upscaler.upscale_image(images[2], tiny_upscaler_model, scale=2)
+    assert load.call_count == 1
+    assert [img.size for img in tiled] == [(320, 240), (320, 240), (128, 96)]
+    for whole_img, tiled_img in zip(whole, tiled):
+        assert np.array_equal(np.asarray(whole_img), np.asarray(tiled_img))
+    assert single.size == (64, 48)
+
+def test_upscaler_select_device():
+    """CUDA が使えない場合は CPU にフォールバックし、スレッド数を設定することの確認"""
+    import torch
+
+    threads = torch.get_num_threads()
+    try:
+        with patch('torch.cuda.is_available', return_value=False):
+            assert Upscaler.select_device('auto', 1).type == 'cpu'
+            assert Upscaler.select_device('cuda', 1).type == 'cpu'
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(threads)
+
+def test_upscaler_worker_options():
+    """ワーカープロセスに渡すオプションは、CPU の場合だけスレッド数をワーカー数で分割することの確認"""
+    import ImageEditor
+    options = {'device': 'cpu', 'num_threads': 8, 'tile_size': 256}
+    assert Upscaler.worker_options(options, 4) == {'device': 'cpu', 'num_threads': 2, 'tile_size': 256}
+    assert Upscaler.worker_options(options, 16)['num_threads'] == 1
+    assert options['num_threads'] == 8  # 元のオプションは変更しない
+    with patch('torch.cuda.is_available', return_value=True):
+        assert Upscaler.worker_options({'device': 'auto', 'num_threads': 8}, 4)['num_threads'] == 8
+    with patch('torch.cuda.is_available', return_value=False), patch('os.cpu_count', return_value=12):
+        assert Upscaler.worker_options({'device': 'auto', 'num_threads': 0}, 4)['num_threads'] == 3
+
+    # ワーカープロセスの ImageProcessingManager にオプションが渡る
+    try:
+        ImageEditor.initialize_process_worker(512, [(512, 512)], 0, {'device': 'cpu', 'num_threads': 2})
+        assert ImageEditor._worker_processing_manager.upscaler_options == {'device': 'cpu', 'num_threads': 2}
+    finally:
+        ImageEditor._worker_processing_manager = None
+
 def test_upscale_image_with_model(sample_images):
     #TODO: RealESRGAN_x4plus のみ対応から対応モデルを増やす
     img = Image.open(sample_images["rgb512"])
@@ -112,6 +112,36 @@ def crop_test_images():
 
     return images
 
+@pytest.mark.parametrize("pattern", [
+    'no_borders', 'letterbox', 'pillarbox', 'four_sides', 'gradient_with_borders', 'gradient_only',
+    'alpha_with_borders', 'grayscale_with_borders', 'non_standard_aspect', 'small'
+])
+def test_proxy_crop_area_matches_full_resolution(crop_test_images, pattern):
+    """
+    縮小版で検出したクロップ領域が、元の解像度で検出した領域と1ピクセル以内で一致することの確認。
+    縮小版が使われるようにテスト用画像を8倍に拡大して比較する。
+    """
+    image = crop_test_images[pattern]
+    np_image = np.array(image.resize((image.width * 8, image.height * 8), Image.NEAREST))
+    autocrop = AutoCrop()
+
+    full_area = autocrop._get_crop_area(np_image)
+    proxy_area = autocrop._get_crop_area(np_image, proxy_max_side=512)
+    if full_area is None:
+        assert proxy_area is None
+    else:
+        assert proxy_area is not None
+        assert all(abs(full - proxy) <= 1 for full, proxy in zip(full_area, proxy_area)), (full_area, proxy_area)
+
+@pytest.mark.parametrize("pattern", ['alpha_with_borders', 'grayscale_with_borders'])
+def test_crop_area_rgba_and_grayscale(crop_test_images, pattern):
+    """RGBA とグレースケールの画像でも、RGB のレターボックス画像と同じように上下の枠を検出することの確認"""
+    autocrop = AutoCrop()
+    crop_area = autocrop._get_crop_area(np.array(crop_test_images[pattern]))
+    letterbox_area = autocrop._get_crop_area(np.array(crop_test_images['letterbox']))
+    assert crop_area is not None
+    assert all(abs(area - expected) <= 2 for area, expected in zip(crop_area, letterbox_area)), crop_area
+
 # def display_images(original_img, cropped_img, title="Original and Cropped Images"):
 #     """
 #     元の画像とクロップ後の画像を並べて表示します。
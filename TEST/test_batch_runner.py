@@ -0,0 +1,53 @@
+import io
+import json
+import argparse
+import pytest
+from unittest.mock import MagicMock, patch
+
+from batch_runner import BatchRunner, ImageBatchProcessor, JsonProgressReporter, parse_shard
+
+def test_collect_image_paths_shard(tmp_path):
+    """画像ファイルの収集とシャード分割の確認"""
+    image_dir = tmp_path / "shard_images"
+    image_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(5):
+        (image_dir / f"{i}.png").touch()
+    (image_dir / "note.txt").touch()
+
+    all_paths = BatchRunner.collect_image_paths([image_dir])
+    assert [path.name for path in all_paths] == [f"{i}.png" for i in range(5)]
+
+    shards = [BatchRunner.collect_image_paths([image_dir], (i, 2)) for i in range(2)]
+    assert [path.name for path in shards[0]] == ["0.png", "2.png", "4.png"]
+    assert sorted(shards[0] + shards[1]) == all_paths
+
+@pytest.mark.parametrize("device, cuda, workers", [("cpu", True, 4), ("auto", False, 4), ("auto", True, 1),
+                                                    ("cuda", True, 1)])
+def test_batch_processor_upscaler_workers(device, cuda, workers):
+    """アップスケーラーを使う場合も CPU ならプロセスプールで処理し、GPU ならワーカーを1つにすることの確認"""
+    ipm = MagicMock(upscaler_options={'device': device})
+    with patch('torch.cuda.is_available', return_value=cuda):
+        processor = ImageBatchProcessor(MagicMock(), MagicMock(), ipm, 512, [(512, 512)], upscaler="RealESRGAN_x4plus",
+                                        process_workers=4)
+    assert processor.process_workers == workers
+
+def test_parse_shard():
+    assert parse_shard("1/4") == (1, 4)
+    for value in ["4/4", "a/b", "1"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
+
+def test_json_progress_reporter():
+    """進捗が1行1JSONで出力され、同じ値は繰り返されないことの確認"""
+    stream = io.StringIO()
+    reporter = JsonProgressReporter('process', 2, stream)
+    reporter.progress(50)
+    reporter.progress(50)
+    reporter.progress(100)
+    summary = reporter.done(processed=2)
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [record['event'] for record in records] == ['progress', 'progress', 'done']
+    assert records[1]['progress'] == 100
+    assert records[2]['processed'] == 2 and records[2]['total'] == 2
+    assert summary['images_per_sec'] is not None
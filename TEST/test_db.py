@@ -1,6 +1,12 @@
+import json
+import pickle
+import threading
 import pytest
+import sqlite3
 from pathlib import Path
-from module.db import SQLiteManager, ImageRepository, ImageDatabaseManager
+from module.db import (SQLiteManager, ImageRepository, ImageDatabaseManager, PHashIndex, phash_to_sqlite_int,
+                       extract_original_image_info)
+from module.records import ImageRecord
 from unittest.mock import MagicMock, patch
 from module.log import get_logger
 import uuid
@@ -55,6 +61,73 @@ def test_sqlite_fetch_one(sqlite_manager):
     assert result['type'] == 'vision'
     assert result['provider'] == 'OpenAI'
 
+def test_sqlite_pragmas(sqlite_manager):
+    """接続ごとに設定するPRAGMAの確認"""
+    assert sqlite_manager.fetch_one("PRAGMA journal_mode")['journal_mode'] == 'wal'
+    assert sqlite_manager.fetch_one("PRAGMA synchronous")['synchronous'] == 1  # NORMAL
+    assert sqlite_manager.fetch_one("PRAGMA busy_timeout")['timeout'] == 5000
+
+def test_sqlite_write_retries_busy(test_db_paths):
+    """他の接続が書き込みロックを持っている間は BEGIN IMMEDIATE を再試行し、解放後に書き込めることの確認"""
+    img_db, tag_db = test_db_paths
+    manager = SQLiteManager(img_db, tag_db, {'busy_timeout_ms': 50})
+    manager.create_tables()
+    blocker = sqlite3.connect(img_db, isolation_level=None, check_same_thread=False)
+    try:
+        blocker.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.2, blocker.execute, ("COMMIT",)).start()
+        query = "INSERT INTO models (name, type, provider) VALUES (?, 'tagger', 'test')"
+        with manager.transaction():
+            manager.execute(query, ('busy-transaction',))
+        row = manager.fetch_one("SELECT COUNT(*) AS count FROM models WHERE name LIKE 'busy-%'")
+        assert row['count'] == 1
+    finally:
+        manager.close()
+        blocker.close()
+
+def test_transaction(image_database_manager, sample_image_info):
+    """transaction のコミット・ロールバックと SAVEPOINT による入れ子の確認"""
+    manager = image_database_manager
+    db = manager.db_manager
+
+    phashes = iter(['0000000000000000', 'ffffffffffffffff', '00000000ffffffff', 'ffffffff00000000',
+                    '0f0f0f0f0f0f0f0f', 'f0f0f0f0f0f0f0f0'])
+
+    def count():
+        return db.fetch_one("SELECT COUNT(*) AS count FROM images")['count']
+
+    def add_image():
+        return manager.repository.add_original_image({**sample_image_info, 'uuid': str(uuid.uuid4()),
+                                                      'phash': next(phashes)})
+
+    with manager.transaction():
+        image_id = add_image()
+        manager.save_annotations(image_id, {'tags': [{'tag': 'cat', 'model_id': 1}], 'captions': []})
+        with pytest.raises(ValueError):
+            with manager.transaction():
+                add_image()
+                raise ValueError("内側だけ取り消す")
+        assert count() == 1
+    assert count() == 1
+    assert not db.in_transaction
+
+    with pytest.raises(RuntimeError):
+        with manager.transaction():
+            add_image()
+            raise RuntimeError("すべて取り消す")
+    assert count() == 1
+    # ロールバックされた画像はpHashインデックスにも残らない
+    assert manager.repository._phash_index is None
+
+    # commit_every 件ごとにコミットし、例外が起きたらコミット前の分だけを取り消す
+    with pytest.raises(RuntimeError):
+        with manager.batch_transaction(commit_every=2) as checkpoint:
+            for _ in range(3):
+                add_image()
+                checkpoint()
+            raise RuntimeError("3枚目は取り消す")
+    assert count() == 3
+
 def test_add_original_image(image_database_manager, sample_image_info):
     """オリジナル画像の追加とメタデータの取得"""
     image_id = image_database_manager.repository.add_original_image(sample_image_info)
@@ -235,6 +308,86 @@ def test_find_tag_id(image_database_manager, sample_image_info):
     tag_id = manager.repository.find_tag_id('spiked collar')
     assert tag_id == 1
 
+def test_get_annotations_for_images(image_database_manager):
+    """複数画像のアノテーションの一括取得が1枚ずつの取得と一致することの確認"""
+    manager = image_database_manager
+    image_ids = [_insert_image_with_phash(manager, phash, idx)
+                 for idx, phash in enumerate(['0000000000000000', 'ffffffffffffffff', '00000000ffffffff'])]
+    manager.save_annotations(image_ids[0], {'tags': [{'tag': 'cat', 'model_id': 1}, {'tag': 'dog', 'model_id': None}],
+                                            'captions': [{'caption': 'a cat', 'model_id': 1}],
+                                            'score': {'score': 0.5, 'model_id': 1}})
+    manager.save_annotations(image_ids[2], {'tags': [{'tag': 'bird', 'model_id': 1}], 'captions': []})
+
+    # 存在しない画像IDも空のアノテーションとして返す
+    annotations = manager.get_annotations_for_images(image_ids + [9999])
+    assert list(annotations) == image_ids + [9999]
+    for image_id in image_ids:
+        expected = manager.get_image_annotations(image_id)
+        for key in ('tags', 'captions', 'scores'):
+            assert annotations[image_id][key] == expected[key]
+    assert annotations[9999] == {'tags': [], 'captions': [], 'scores': []}
+
+    chunks = list(manager.iter_annotations_for_images(image_ids, chunk_size=2))
+    assert [list(chunk) for chunk in chunks] == [image_ids[:2], image_ids[2:]]
+
+def test_records(image_database_manager, sample_image_info):
+    """レコードが辞書と同じように参照できることの確認"""
+    manager = image_database_manager
+    image_id = manager.repository.add_original_image(sample_image_info)
+
+    metadata = manager.get_image_metadata(image_id)
+    assert isinstance(metadata, ImageRecord)
+    assert metadata['width'] == metadata.width == metadata.get('width') == 512
+    assert metadata.get('unknown') is None and 'unknown' not in metadata
+    with pytest.raises(KeyError):
+        metadata['unknown']
+    # 辞書と同じく列番号では参照できない
+    with pytest.raises(KeyError):
+        metadata[0]
+    assert metadata.get(0) is None
+    as_dict = dict(metadata)
+    assert metadata == as_dict and as_dict == metadata
+    assert {**metadata}['uuid'] == sample_image_info['uuid']
+    assert pickle.loads(pickle.dumps(metadata)) == as_dict
+
+    # '_' で始まる列はキーに含めない
+    images, count = manager.repository.find_images(include_untagged=True)
+    assert count == 1 and '_total_count' not in images[0] and images[0]['image_id'] == image_id
+
+def test_find_tag_ids(image_database_manager):
+    """複数タグの一括検索とtag_idキャッシュの確認"""
+    repository = image_database_manager.repository
+    repository.tag_id_cache.clear()
+
+    tag_ids = repository.find_tag_ids(['1girl', 'blue eyes', 'unknown tag', '1girl'])
+    assert tag_ids == {'1girl': 1, 'blue eyes': 3, 'unknown tag': None}
+    assert repository.tag_id_cache.stats()['misses'] == 3
+
+    # 2回目はキャッシュから返す
+    assert repository.find_tag_id('blue eyes') == 3
+    assert repository.find_tag_id('unknown tag') is None
+    assert repository.tag_id_cache.stats()['hits'] == 2
+
+    repository.tag_id_cache.maxsize = 2
+    repository.find_tag_ids(['nsfw'])
+    assert len(repository.tag_id_cache) == 2
+
+def test_find_tag_id_duplicate_rows(tmp_path):
+    """同じタグが複数行ある場合、1件ずつの検索と一括検索が同じ最小の tag_id を返すことの確認"""
+    tag_db = tmp_path / f"duplicate_tags_{uuid.uuid4().hex}.db"
+    with sqlite3.connect(tag_db) as conn:
+        conn.execute("CREATE TABLE TAGS (tag_id INTEGER, tag TEXT)")
+        conn.executemany("INSERT INTO TAGS VALUES (?, ?)", [(7, 'dup'), (3, 'dup'), (5, 'single')])
+    manager = SQLiteManager(tmp_path / f"duplicate_tags_images_{uuid.uuid4().hex}.db", tag_db)
+    try:
+        repository = ImageRepository(manager)
+        assert repository.find_tag_id('dup') == 3
+        assert repository.find_tag_id('missing') is None
+        repository.tag_id_cache.clear()
+        assert repository.find_tag_ids(['dup', 'single', 'missing']) == {'dup': 3, 'single': 5, 'missing': None}
+    finally:
+        manager.close()
+
 def test_update_image_metadata(image_database_manager, sample_image_info):
     """画像メタデータの更新の確認"""
     manager = image_database_manager
@@ -444,7 +597,7 @@ test_cases = [
         "tags": [],
         "caption": None,
         "expected_count": 0,
-        "expected_ids": lambda ids: None
+        "expected_ids": lambda ids: set()
     },
     # テストケース10: 解像度フィルタ
     {
@@ -515,12 +668,8 @@ def test_get_images_by_filter_cases(setup_test_data, case):
     )
 
     assert count == expected_count, f"{description} - 期待される画像数と一致しません"
-    # None が返ってくる場合に備える
-    if filtered_images is None:
-        assert expected_ids is None, f"{description} - 期待される画像IDと一致しません"
-    else:
-        actual_ids = set(img['image_id'] for img in filtered_images)
-        assert actual_ids == expected_ids, f"{description} - 期待される画像IDと一致しません"
+    actual_ids = set(img['image_id'] for img in filtered_images)
+    assert actual_ids == expected_ids, f"{description} - 期待される画像IDと一致しません"
 
 def test_get_images_by_filter(image_database_manager, sample_image_info, tmp_path):
     """フィルタによる画像検索の確認"""
@@ -631,3 +780,557 @@ def test_create_tables(image_database_manager):
         # 期待されるカラムがすべて存在するか確認
         for column in expected_columns:
             assert column in existing_columns, f"テーブル '{table}' にカラム '{column}' が存在しません。"
+
+def _insert_image_with_phash(manager, phash: str, idx: int) -> int:
+    """phashを指定して images テーブルに直接画像を追加する"""
+    query = """
+    INSERT INTO images (uuid, stored_image_path, width, height, format, mode, has_alpha, filename,
+                        extension, color_space, icc_profile, phash, phash_int, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    created_at = datetime.now().isoformat()
+    params = (str(uuid.uuid4()), f"phash_image_{idx}.jpg", 256, 256, "WEBP", "RGB", False,
+              f"phash_image_{idx}.jpg", 'webp', 'sRGB', None, phash, phash_to_sqlite_int(phash), created_at, created_at)
+    return manager.db_manager.execute(query, params).lastrowid
+
+def test_phash_index_search():
+    """BK-treeのしきい値検索と削除の確認"""
+    index = PHashIndex()
+    index.add(1, 0x0)
+    index.add(2, 0b111)          # 距離3
+    index.add(3, 0xFF)           # 距離8
+    index.add(4, 0xFFFF0000)     # 距離16
+
+    assert index.nearest(0x1, 5) == (1, 1)
+    assert sorted(image_id for _, image_id in index.search(0x0, 8)) == [1, 2, 3]
+
+    index.remove(1)
+    assert index.nearest(0x0, 5) == (3, 2)
+    assert len(index) == 3
+
+def test_get_image_id_by_phash(image_database_manager):
+    """pHashインデックスによる類似画像検索と差分更新の確認"""
+    manager = image_database_manager
+    repository = manager.repository
+    image_id1 = _insert_image_with_phash(manager, 'ffff0000ffff0000', 1)
+    _insert_image_with_phash(manager, 'not_a_phash', 2)  # 解釈できないpHashは無視される
+
+    # 2bit違いは一致、しきい値を下げると不一致
+    assert repository.get_image_id_by_phash('ffff0000ffff0003') == image_id1
+    assert repository.get_image_id_by_phash('ffff0000ffff0003', threshold=1) is None
+    assert repository.get_image_id_by_phash('0000ffff0000ffff') is None
+
+    # 構築後に削除した画像はインデックスからも消える
+    repository.delete_image(image_id1)
+    assert repository.get_image_id_by_phash('ffff0000ffff0000') is None
+
+def test_phash_int_backfill(image_database_manager):
+    """phash_int が未設定の既存行がマイグレーションで16進数のpHashから埋められることの確認"""
+    manager = image_database_manager
+    image_id = _insert_image_with_phash(manager, 'ffff0000ffff0000', 1)
+    manager.db_manager.execute("UPDATE images SET phash_int = NULL WHERE id = ?", (image_id,))
+    manager.db_manager.execute("PRAGMA user_version = 0")
+
+    manager.db_manager.create_tables()
+
+    row = manager.db_manager.fetch_one("SELECT phash_int FROM images WHERE id = ?", (image_id,))
+    assert row['phash_int'] == phash_to_sqlite_int('ffff0000ffff0000')
+    assert row['phash_int'] < 0  # 上位ビットが立っているので符号付きでは負数
+
+def test_migrate_retries_deferred_fts(test_db_paths):
+    """trigram に対応していない SQLite では FTS のマイグレーションを保留し、対応した後の migrate で作成することの確認"""
+    img_db, tag_db = test_db_paths
+    manager = SQLiteManager(img_db, tag_db)
+    with patch.object(sqlite3, 'sqlite_version_info', (3, 31, 1)):
+        manager.create_tables()
+        assert manager.schema_version == SQLiteManager.MIGRATIONS[-1][0]
+        assert not manager.fts_enabled
+        image_id = manager.execute(
+            "INSERT INTO images (uuid, phash, stored_image_path, width, height, format, extension) "
+            "VALUES (?, 'ffff0000ffff0000', 'path', 256, 256, 'WEBP', 'webp')", (str(uuid.uuid4()),)).lastrowid
+        manager.execute("INSERT INTO tags (image_id, tag) VALUES (?, 'long_hair')", (image_id,))
+        # 対応していないままなら保留し続ける
+        manager.migrate()
+        assert not manager.fts_enabled
+    assert manager.fetch_one("SELECT 1 FROM db_settings WHERE key = 'deferred_migration:_migration_fts'")
+
+    manager.migrate()
+    assert manager.fts_enabled
+    assert manager.fetch_one("SELECT COUNT(*) AS count FROM db_settings WHERE key LIKE 'deferred_migration:%'")['count'] == 0
+    rows = manager.fetch_all("SELECT rowid FROM tags_fts WHERE tag LIKE '%hair%'")
+    assert [row['rowid'] for row in rows] == [1]
+    manager.close()
+
+def test_migrate_resumes_backfill(test_db_paths):
+    """中断したバックフィルが次回のマイグレーションで続きから再開されることの確認"""
+    img_db, tag_db = test_db_paths
+    manager = SQLiteManager(img_db, tag_db)
+    with patch.object(SQLiteManager, 'MIGRATIONS', []):
+        manager.create_tables()
+    assert manager.schema_version == 0
+    for idx in range(5):
+        image_id = manager.execute(
+            "INSERT INTO images (uuid, phash, stored_image_path, width, height, format, extension) "
+            "VALUES (?, 'ffff0000ffff0000', 'path', 256, 256, 'WEBP', 'webp')", (str(uuid.uuid4()),)).lastrowid
+        manager.execute("INSERT INTO tags (image_id, tag) VALUES (?, ?)", (image_id, f"long_hair_{idx}"))
+
+    backfill_tags_fts = SQLiteManager._backfill_tags_fts
+    def interrupted(self, conn, first_id, last_id):
+        if first_id > 2:
+            raise sqlite3.OperationalError("中断")
+        backfill_tags_fts(self, conn, first_id, last_id)
+
+    with patch.object(SQLiteManager, '_backfill_tags_fts', interrupted):
+        with pytest.raises(sqlite3.OperationalError):
+            manager.migrate(batch_size=2)
+    assert manager.schema_version == 2
+    state = manager.fetch_one("SELECT value FROM db_settings WHERE key = 'backfill:tags_fts'")
+    assert json.loads(state['value']) == {'last_id': 2, 'end_id': 5}
+
+    progress = []
+    version = manager.migrate(lambda name, done, total: progress.append((name, done, total)), batch_size=2)
+    assert version == manager.schema_version == SQLiteManager.MIGRATIONS[-1][0]
+    assert [entry for entry in progress if entry[0] == 'tags_fts'] == [('tags_fts', 4, 5), ('tags_fts', 5, 5)]
+    assert manager.fetch_one("SELECT COUNT(*) AS count FROM db_settings WHERE key LIKE 'backfill:%'")['count'] == 0
+    rows = manager.fetch_all("SELECT rowid FROM tags_fts WHERE tag LIKE '%hair%'")
+    assert sorted(row['rowid'] for row in rows) == [1, 2, 3, 4, 5]
+    # external content テーブルと索引が一致している
+    manager.execute("INSERT INTO tags_fts(tags_fts, rank) VALUES ('integrity-check', 1)")
+    row = manager.fetch_one("SELECT COUNT(*) AS count FROM images WHERE phash_int = ?",
+                            (phash_to_sqlite_int('ffff0000ffff0000'),))
+    assert row['count'] == 5
+    manager.close()
+
+def test_get_processed_images(image_database_manager):
+    """解像度に合う処理済み画像がSQLで選ばれ、一括取得と1件ずつの取得が一致することの確認"""
+    manager = image_database_manager
+    repository = manager.repository
+    image_id1 = _insert_image_with_phash(manager, '0000000000000001', 1)
+    image_id2 = _insert_image_with_phash(manager, '0000000000000002', 2)
+    image_id3 = _insert_image_with_phash(manager, '0000000000000003', 3)
+    for image_id, width, height in [(image_id1, 896, 1152), (image_id1, 1024, 768), (image_id1, 512, 512),
+                                    (image_id2, 896, 1152), (image_id2, 640, 480)]:
+        manager.db_manager.execute(
+            "INSERT INTO processed_images (image_id, stored_image_path, width, height, has_alpha, filename) "
+            "VALUES (?, ?, ?, ?, 0, ?)", (image_id, f"{width}x{height}.webp", width, height, f"{width}x{height}.webp"))
+
+    # 長辺が一致するものを面積が近いものより優先する
+    assert repository.get_processed_image(image_id1, 1024)['filename'] == "1024x768.webp"
+    assert repository.get_processed_image(image_id2, 1024)['filename'] == "896x1152.webp"
+    assert repository.get_processed_image(image_id1)['filename'] == "512x512.webp"
+    assert repository.get_processed_image(image_id1, 2048) is None
+    assert len(repository.get_processed_image(image_id1, all_data=True)) == 3
+
+    for resolution in (0, 512, 1024, 2048):
+        processed = manager.get_processed_images([image_id1, image_id2, image_id3], resolution)
+        expected = {image_id: repository.get_processed_image(image_id, resolution)
+                    for image_id in (image_id1, image_id2, image_id3)}
+        assert processed == {image_id: metadata for image_id, metadata in expected.items() if metadata}
+    assert processed == {}
+
+    record = repository.get_processed_image(image_id1, 1024)
+    assert (record['long_side'], record['area']) == (1024, 1024 * 768)
+    plan = manager.db_manager.explain_query_plan(
+        "SELECT id FROM processed_images WHERE image_id = ? AND long_side = ?", (image_id1, 1024))
+    assert any('idx_processed_images_size' in detail for detail in plan)
+
+def test_find_duplicates_by_phashes(image_database_manager):
+    """複数pHashの一括類似検索の確認"""
+    manager = image_database_manager
+    image_id1 = _insert_image_with_phash(manager, 'ffff0000ffff0000', 1)
+    image_id2 = _insert_image_with_phash(manager, '00000000000000ff', 2)
+
+    results = manager.find_duplicates_by_phashes([
+        'ffff0000ffff0001',  # image_id1 と距離1
+        '00000000000000fe',  # image_id2 と距離1
+        '0f0f0f0f0f0f0f0f',  # 一致なし
+        'not_a_phash',       # 解釈できない
+    ])
+    assert results == [image_id1, image_id2, None, None]
+    assert manager.find_duplicates_by_phashes(['ffff0000ffff0001'], threshold=0) == [None]
+
+def test_register_original_images(image_database_manager, tmp_path):
+    """複数画像の一括登録と重複判定の確認"""
+    import numpy as np
+    from PIL import Image
+    from module.file_sys import FileSystemManager
+
+    manager = image_database_manager
+    src_dir = tmp_path / "batch_src"
+    src_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        img = Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).resize((256, 256))
+        path = src_dir / f"batch_{i}.png"
+        img.save(path)
+        paths.append(path)
+    # 1枚目と同じ内容の画像（バッチ内重複）
+    img = Image.open(paths[0]).resize((128, 128))
+    paths.append(src_dir / "batch_0_small.png")
+    img.save(paths[-1])
+
+    fsm = FileSystemManager()
+    fsm.initialize(tmp_path / "batch_output", 512)
+    progress = []
+    results = manager.register_original_images(paths, fsm, progress_callback=progress.append, max_workers=2)
+
+    assert len(results) == 4
+    assert all(result is not None for result in results)
+    image_ids = [image_id for image_id, _ in results]
+    assert len(set(image_ids[:3])) == 3
+    assert image_ids[3] == image_ids[0]
+    assert Path(results[0][1]['stored_image_path']).exists()
+    assert progress[-1] == 100
+
+    # 2回目はすべてDB内の既存画像として扱われる
+    again = manager.register_original_images(paths[:3], fsm, max_workers=1)
+    assert [image_id for image_id, _ in again] == image_ids[:3]
+    assert again[0][1]['stored_image_path'] == results[0][1]['stored_image_path']
+
+def test_register_original_images_failure(image_database_manager, tmp_path):
+    """一括登録の失敗やコピー中のキャンセルで、コピーした画像を残さず、登録済みの重複画像は返すことの確認"""
+    import numpy as np
+    from PIL import Image
+    from module.file_sys import FileSystemManager
+
+    manager = image_database_manager
+    src_dir = tmp_path / f"batch_failure_{uuid.uuid4().hex}"
+    src_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(4)
+    paths = []
+    for i in range(4):
+        path = src_dir / f"failure_{i}.png"
+        Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).resize((256, 256)).save(path)
+        paths.append(path)
+    fsm = FileSystemManager()
+    fsm.initialize(src_dir / "output", 512)
+    image_id, _ = manager.register_original_image(paths[0], fsm)
+
+    stored = []
+    save_original_image = fsm.save_original_image
+    def save(*args, **kwargs):
+        stored.append(save_original_image(*args, **kwargs))
+        return stored[-1]
+    with patch.object(fsm, 'save_original_image', side_effect=save), \
+         patch.object(manager.repository, 'add_original_images', side_effect=sqlite3.OperationalError("failed")):
+        results = manager.register_original_images(paths, fsm, max_workers=1)
+    assert results[0][0] == image_id
+    assert results[1:] == [None, None, None]
+    assert len(stored) == 3 and not any(path.exists() for path in stored)
+
+    # 1枚目のコピー後にキャンセルすると、コピー中の画像を待って削除し、残りはコピーしない
+    stored.clear()
+    def slow_save(*args, **kwargs):
+        if stored:
+            time.sleep(0.2)
+        return save(*args, **kwargs)
+    with patch.object(fsm, 'save_original_image', side_effect=slow_save):
+        results = manager.register_original_images(paths, fsm, is_canceled=lambda: bool(stored), max_workers=1)
+    assert results[0][0] == image_id
+    assert results[1:] == [None, None, None]
+    assert 1 <= len(stored) <= 2 and not any(path.exists() for path in stored)
+    assert manager.get_total_image_count() == 1
+
+def test_file_fingerprints(image_database_manager, tmp_path):
+    """変更のないファイルは file_fingerprints の記録を使い、画像をデコードしないことの確認"""
+    import os
+    import numpy as np
+    from PIL import Image
+    from module.file_sys import FileSystemManager
+
+    manager = image_database_manager
+    src_dir = tmp_path / "fingerprint_src"
+    src_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(1)
+    paths = []
+    for i in range(3):
+        path = src_dir / f"fingerprint_{i}.png"
+        Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).resize((256, 256)).save(path)
+        paths.append(path)
+    fsm = FileSystemManager()
+    fsm.initialize(tmp_path / "fingerprint_output", 512)
+
+    results = manager.register_original_images(paths[:2], fsm, max_workers=1)
+    image_ids = [image_id for image_id, _ in results]
+    rows = manager.db_manager.fetch_all("SELECT * FROM file_fingerprints ORDER BY path")
+    assert [row['image_id'] for row in rows] == image_ids
+    assert rows[0]['sha256'] == FileSystemManager.calculate_sha256(paths[0])
+
+    # 2回目は stat だけで登録済みと判定する
+    with patch('module.db.extract_original_image_info', side_effect=AssertionError("decoded")), \
+         patch('module.db.calculate_phash', side_effect=AssertionError("decoded")):
+        again = manager.register_original_images(paths[:2], fsm, max_workers=1)
+        assert [image_id for image_id, _ in again] == image_ids
+        assert manager.detect_duplicate_image(paths[1]) == image_ids[1]
+
+    # 未登録のファイルは重複チェックで記録し、登録時にはデコードし直さない
+    assert manager.detect_duplicate_image(paths[2]) is None
+    with patch('module.db.calculate_phash', side_effect=AssertionError("decoded")), \
+         patch.object(FileSystemManager, 'get_image_info', side_effect=AssertionError("decoded")):
+        image_id, metadata = manager.register_original_image(paths[2], fsm)
+    assert metadata['width'] == 256 and image_id not in image_ids
+    assert manager.detect_duplicate_image(paths[2]) == image_id
+
+    # 更新日時だけが変わったファイルはハッシュを計算し直し、内容が同じなのでデコードしない
+    stat = os.stat(paths[0])
+    os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    with patch('module.db.extract_original_image_info', wraps=extract_original_image_info) as extract:
+        again = manager.register_original_images(paths[:2], fsm, max_workers=1)
+    assert extract.call_count == 0
+    assert [image_id for image_id, _ in again] == image_ids
+
+    # 内容が変わったファイルは計算し直す
+    Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).resize((256, 256)).save(paths[0])
+    os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 2_000_000_000))
+    with patch('module.db.extract_original_image_info', wraps=extract_original_image_info) as extract:
+        manager.register_original_images(paths[:2], fsm, max_workers=1)
+    assert extract.call_count == 1
+
+def test_content_hash_dedup(image_database_manager, tmp_path):
+    """内容が完全に一致する画像は名前や場所が違っても、デコードせずにSHA-256で重複と判定することの確認"""
+    import shutil
+    import numpy as np
+    from PIL import Image
+    from module.file_sys import FileSystemManager
+
+    manager = image_database_manager
+    src_dir = tmp_path / "hash_src"
+    src_dir.mkdir(parents=True, exist_ok=True)
+    path = src_dir / "original.png"
+    Image.fromarray(np.random.default_rng(2).integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(path)
+    fsm = FileSystemManager()
+    fsm.initialize(tmp_path / "hash_output", 512)
+
+    image_id, metadata = manager.register_original_image(path, fsm)
+    sha256 = FileSystemManager.calculate_sha256(path)
+    assert manager.repository.find_images_by_content_hash([sha256, 'missing']) == {sha256: image_id}
+    # 保存したコピーも同じ内容になっている
+    assert FileSystemManager.calculate_sha256(Path(metadata['stored_image_path'])) == sha256
+
+    copies = []
+    for i in range(2):
+        copy_dir = tmp_path / f"hash_copy_{i}"
+        copy_dir.mkdir(parents=True, exist_ok=True)
+        copies.append(Path(shutil.copy(path, copy_dir / f"renamed_{i}.png")))
+    with patch('module.db.extract_original_image_info', side_effect=AssertionError("decoded")), \
+         patch('module.db.calculate_phash', side_effect=AssertionError("decoded")), \
+         patch.object(FileSystemManager, 'save_original_image', side_effect=AssertionError("copied")):
+        assert manager.detect_duplicate_image(copies[0]) == image_id
+        results = manager.register_original_images(copies, fsm, max_workers=1)
+        assert [result[0] for result in results] == [image_id, image_id]
+    assert manager.get_total_image_count() == 1
+
+def test_content_hash_backfill(image_database_manager, tmp_path):
+    """マイグレーション前に登録された画像の content_hash は起動時にはファイルを読まず、fill_content_hashes で保存済みのファイルから
+    埋められ、ファイルのない画像はスキップすることの確認"""
+    from module.file_sys import FileSystemManager
+
+    manager = image_database_manager
+    src_dir = tmp_path / f"content_hash_backfill_{uuid.uuid4().hex}"
+    src_dir.mkdir(parents=True, exist_ok=True)
+    stored = src_dir / "stored.png"
+    stored.write_bytes(b"stored image")
+    image_id = _insert_image_with_phash(manager, 'ffff0000ffff0000', 1)
+    missing_id = _insert_image_with_phash(manager, '0000ffff0000ffff', 2)
+    manager.db_manager.execute("UPDATE images SET stored_image_path = ?, content_hash = NULL WHERE id = ?",
+                               (str(stored), image_id))
+    manager.db_manager.execute("UPDATE images SET stored_image_path = ?, content_hash = NULL WHERE id = ?",
+                               (str(src_dir / "missing.png"), missing_id))
+    manager.db_manager.execute("PRAGMA user_version = 6")
+
+    with patch.object(FileSystemManager, 'calculate_sha256', side_effect=AssertionError("read")):
+        manager.db_manager.create_tables()
+    assert manager.count_images_without_content_hash() == 2
+
+    progress = []
+    assert manager.fill_content_hashes(batch_size=1, progress_callback=progress.append) == {'hashed': 1, 'missing': 1}
+    assert progress == [50, 100]
+    assert manager.repository.find_images_by_content_hash([FileSystemManager.calculate_sha256(stored)]) == {
+        FileSystemManager.calculate_sha256(stored): image_id}
+    row = manager.db_manager.fetch_one("SELECT content_hash FROM images WHERE id = ?", (missing_id,))
+    assert row['content_hash'] is None
+
+def test_single_decode_pipeline(image_database_manager, tmp_path, preferred_resolutions):
+    """重複チェックから登録・クロップ・リサイズまで、ImageHandle を渡せば画像を1回だけデコードすることの確認"""
+    import numpy as np
+    from PIL import Image, ImageFile
+    from module.file_sys import FileSystemManager
+    from module.image_handle import ImageHandle
+    from ImageEditor import ImageProcessingManager
+
+    manager = image_database_manager
+    src_dir = tmp_path / f"single_decode_{uuid.uuid4().hex}"
+    src_dir.mkdir(parents=True, exist_ok=True)
+    path = src_dir / "large.jpg"
+    image = np.zeros((1600, 2400, 3), dtype=np.uint8)
+    image[160:1440] = np.random.default_rng(3).integers(0, 256, (1280, 2400, 3), dtype=np.uint8)
+    Image.fromarray(image).save(path)
+    fsm = FileSystemManager()
+    fsm.initialize(src_dir / "output", 512)
+    ipm = ImageProcessingManager(fsm, 512, preferred_resolutions)
+
+    decoded = []
+    load = ImageFile.ImageFile.load
+    def count_decode(img):
+        if img.tile:
+            decoded.append(img.size)
+        return load(img)
+    with patch.object(ImageFile.ImageFile, 'load', count_decode), \
+         patch.object(FileSystemManager, 'get_image_info', side_effect=AssertionError("reopened")), \
+         ImageHandle(path) as handle:
+        assert manager.detect_duplicate_image(path, handle) is None
+        image_id, metadata = manager.register_original_image(path, fsm, handle)
+        processed = ipm.process_image(handle, metadata['has_alpha'], metadata['mode'])
+    assert decoded == [(2400, 1600)]
+    assert handle.decode_count == 1
+    assert manager.repository.get_image_id_by_phash(metadata['phash']) == image_id
+    assert processed is not None and max(processed.size) >= 512
+
+def test_get_images_by_filter_single_query(image_database_manager):
+    """タグ・キャプション・NSFW・解像度・ページングをまとめた検索の確認"""
+    manager = image_database_manager
+    data = [
+        (['cat', 'cute'], 'a cute cat'),
+        (['cat', 'sleeping'], 'a sleeping cat'),
+        (['dog'], 'a dog in the park'),
+        (['cat', 'nsfw'], 'a cat'),
+        ([], 'no tags'),
+    ]
+    image_ids = []
+    for idx, (tags, caption) in enumerate(data):
+        image_id = _insert_image_with_phash(manager, f'{idx:016x}', idx)
+        image_ids.append(image_id)
+        for tag in tags:
+            manager.db_manager.execute(
+                "INSERT INTO tags (image_id, tag, updated_at) VALUES (?, ?, '2024-01-01 00:00:00')", (image_id, tag))
+        manager.db_manager.execute(
+            "INSERT INTO captions (image_id, caption, updated_at) VALUES (?, ?, '2024-01-01 00:00:00')", (image_id, caption))
+        # 1枚目だけ解像度の合わない処理済み画像
+        width = 300 if idx == 0 else 512
+        manager.db_manager.execute(
+            "INSERT INTO processed_images (image_id, stored_image_path, width, height, has_alpha, filename) "
+            "VALUES (?, ?, ?, ?, 0, ?)", (image_id, f'p{idx}.webp', width, width, f'p{idx}.webp'))
+    # 直接追加したアノテーションのフラグを計算
+    manager.repository.refresh_image_flags()
+
+    def ids(tags=None, **kwargs):
+        images, count = manager.get_images_by_filter(tags=tags, **kwargs)
+        assert count == len(images) or 'limit' in kwargs or 'after_id' in kwargs
+        return [image['image_id'] for image in images]
+
+    assert ids(['cat']) == image_ids[:2]  # nsfw は除外される
+    assert ids(['cat'], include_nsfw=True) == [image_ids[0], image_ids[1], image_ids[3]]
+    assert ids(['cat', 'cute']) == [image_ids[0]]
+    assert ids(['cute', 'dog'], use_and=False) == [image_ids[0], image_ids[2]]
+    assert ids(['"ca"']) == []
+    assert ids(['cat'], caption='*sleep*') == [image_ids[1]]
+    assert ids(caption='park') == [image_ids[2]]
+    assert ids(include_untagged=True) == [image_ids[4]]
+    assert ids(['cat'], end_date='2023-01-01 00:00:00') == []
+
+    images, count = manager.get_images_by_filter(tags=['cat', 'dog'], use_and=False, resolution=512)
+    assert [image['image_id'] for image in images] == [image_ids[1], image_ids[2]]
+    assert images[0]['stored_image_path'] == 'p1.webp'
+
+    # ページング: 件数はページに関係なく一致件数を返す
+    page, count = manager.get_images_by_filter(caption='a', include_nsfw=True, limit=2)
+    assert [image['image_id'] for image in page] == image_ids[:2] and count == 5
+    page, count = manager.get_images_by_filter(caption='a', include_nsfw=True, limit=2, offset=2)
+    assert [image['image_id'] for image in page] == image_ids[2:4] and count == 5
+    page, _ = manager.get_images_by_filter(caption='a', include_nsfw=True, limit=2, after_id=image_ids[1])
+    assert [image['image_id'] for image in page] == image_ids[2:4]
+    page, count = manager.get_images_by_filter(caption='a', include_nsfw=True, limit=2, offset=10)
+    assert page == [] and count == 5
+
+def test_image_flags(image_database_manager, sample_image_info):
+    """NSFWフラグとタグ一覧の更新と、キーワード変更時の再計算の確認"""
+    manager = image_database_manager
+    repository = manager.repository
+    image_id = manager.repository.add_original_image(sample_image_info)
+    other_id = _insert_image_with_phash(manager, '00000000000000ff', 9)
+
+    repository.save_annotations(image_id, {
+        'tags': [{'tag': 'cat', 'model_id': 1}, {'tag': 'Nude', 'model_id': 1}],
+        'captions': [{'caption': 'a cat', 'model_id': 1}],
+    })
+    flags = manager.db_manager.fetch_one("SELECT * FROM image_flags WHERE image_id = ?", (image_id,))
+    assert flags['nsfw'] == 1
+    assert flags['tag_set'] == 'Nude, cat'
+
+    # キーワードが変わったら全画像を再計算する
+    assert repository.sync_image_flags()
+    assert not repository.sync_image_flags()
+    repository.nsfw_keywords = ['cat']
+    assert repository.sync_image_flags()
+    rows = manager.db_manager.fetch_all("SELECT image_id, nsfw FROM image_flags ORDER BY image_id")
+    assert [(row['image_id'], row['nsfw']) for row in rows] == [(image_id, 1), (other_id, 0)]
+    repository.nsfw_keywords = []
+    repository.refresh_image_flags()
+    assert manager.db_manager.fetch_one("SELECT SUM(nsfw) AS n FROM image_flags")['n'] == 0
+
+    # 画像を削除するとフラグも削除される
+    repository.delete_image(image_id)
+    assert manager.db_manager.fetch_one("SELECT * FROM image_flags WHERE image_id = ?", (image_id,)) is None
+
+def test_tag_caption_fts_search(image_database_manager):
+    """全文検索テーブルの同期と検索語句の変換の確認"""
+    manager = image_database_manager
+    repository = manager.repository
+    assert manager.db_manager.fts_enabled
+
+    image_id1 = _insert_image_with_phash(manager, '0000000000000001', 1)
+    image_id2 = _insert_image_with_phash(manager, '0000000000000002', 2)
+    for image_id, tag in [(image_id1, 'long_hair'), (image_id2, 'long hair'), (image_id2, 'Cat ears')]:
+        manager.db_manager.execute(
+            "INSERT INTO tags (image_id, tag, updated_at) VALUES (?, ?, '2024-01-01 00:00:00')", (image_id, tag))
+    manager.db_manager.execute(
+        "INSERT INTO captions (image_id, caption, updated_at) VALUES (?, 'a girl 100% happy', '2024-01-01 00:00:00')", (image_id1,))
+    start, end = '2020-01-01 00:00:00', '2030-01-01 00:00:00'
+
+    # '_' や '%' は候補を広めに取り、元の条件で絞り込む
+    assert repository.get_images_by_tag('long_hair', start, end) == [image_id1]
+    assert repository.get_images_by_tag('"long hair"', start, end) == [image_id2]
+    assert sorted(repository.get_images_by_tag('long*', start, end)) == [image_id1, image_id2]
+    assert repository.get_images_by_tag('cat ear', start, end) == [image_id2]  # 大文字小文字は区別しない
+    assert repository.get_images_by_tag('"cat ears"', start, end) == []
+    assert sorted(repository.get_images_by_tag('ng', start, end)) == [image_id1, image_id2]  # 2文字は索引を使わない
+    assert repository.get_images_by_caption('100%', start, end) == [image_id1]
+    assert repository.get_images_by_caption('100_', start, end) == []
+
+    # 削除・更新がトリガーで反映される
+    manager.db_manager.execute("DELETE FROM tags WHERE tag = 'long_hair'")
+    manager.db_manager.execute("UPDATE tags SET tag = 'dog ears' WHERE tag = 'Cat ears'")
+    assert repository.get_images_by_tag('long_hair', start, end) == []
+    assert repository.get_images_by_tag('cat ear', start, end) == []
+    assert repository.get_images_by_tag('dog ear', start, end) == [image_id2]
+    rows = manager.db_manager.fetch_all("SELECT rowid FROM tags_fts WHERE tag LIKE '%ears%'")
+    assert len(rows) == 1
+
+def test_explain_query_plans(image_database_manager):
+    """複合インデックスがバージョン付きで作成され、検索に全件スキャンがないことの確認"""
+    manager = image_database_manager
+    db_manager = manager.db_manager
+    assert db_manager.schema_version == SQLiteManager.MIGRATIONS[-1][0]
+    indexes = {row['name'] for row in db_manager.fetch_all("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'idx_tags_tag_updated_at', 'idx_images_filename'} <= indexes
+
+    # 適用済みのマイグレーションは実行しない
+    db_manager.execute("DROP INDEX idx_images_filename")
+    db_manager.create_tables()
+    assert db_manager.fetch_one("SELECT 1 FROM sqlite_master WHERE name = 'idx_images_filename'") is None
+
+    image_id = _insert_image_with_phash(manager, '0000000000000001', 1)
+    db_manager.execute("INSERT INTO tags (image_id, tag) VALUES (?, '1girl')", (image_id,))
+    count = db_manager.fetch_one("SELECT COUNT(*) AS count FROM images")['count']
+    plans = manager.explain_query_plans()
+    assert db_manager.fetch_one("SELECT COUNT(*) AS count FROM images")['count'] == count
+    methods = {plan['method'] for plan in plans}
+    assert {'get_images_by_tag', 'find_images (AND)', 'get_annotations_for_images'} <= methods
+    for plan in plans:
+        if plan['method'].startswith('find_images') or plan['method'] == 'get_images_by_tag':
+            assert plan['full_scans'] == [], plan
+    tag_plans = [plan for plan in plans if plan['method'] == 'get_images_by_tag' and 'tags' in plan['query']]
+    assert any('idx_tags_tag_updated_at' in detail for plan in tag_plans for detail in plan['plan'])
+    # インデックスがなければ全件スキャンとして報告される
+    assert any(plan['full_scans'] == ['SCAN images'] for plan in plans if plan['method'] == 'get_image_id_by_name')
@@ -0,0 +1,101 @@
+import os
+import uuid
+import pytest
+from PIL import Image
+from unittest.mock import patch
+
+from module.file_sys import FileSystemManager
+
+def test_save_original_image_content_hash(tmp_path):
+    """コピーしながら計算したSHA-256が事前に計算したハッシュと異なる場合はエラーにすることの確認"""
+    src = tmp_path / "src.bin"
+    src.write_bytes(b"content" * 1000)
+    dst = tmp_path / "dst.bin"
+    assert FileSystemManager.copy_file(src, dst, calculate_hash=True) == FileSystemManager.calculate_sha256(src)
+
+    fsm = FileSystemManager()
+    fsm.initialize(tmp_path / f"output_{uuid.uuid4().hex}", 512)
+    with pytest.raises(ValueError):
+        fsm.save_original_image(src, content_hash="0" * 64)
+    assert not list(fsm.original_images_dir.rglob("src*"))
+
+    # コピーに失敗しても予約した空ファイルを残さず、次の保存で同じ名前を使う
+    with patch.object(FileSystemManager, 'copy_file', side_effect=OSError("disk full")), pytest.raises(OSError):
+        fsm.save_original_image(src)
+    assert not list(fsm.original_images_dir.rglob("src*"))
+    assert fsm.save_original_image(src).name == "src.bin"
+
+def test_save_processed_image_failure(tmp_path):
+    """処理済み画像の保存に失敗した場合は予約した空ファイルを残さないことの確認"""
+    fsm = FileSystemManager()
+    fsm.initialize(tmp_path / f"processed_output_{uuid.uuid4().hex}", 512)
+    original_path = tmp_path / "processed_src" / "image.png"
+    image = Image.new('RGB', (64, 64))
+    with patch.object(Image.Image, 'save', side_effect=OSError("disk full")), pytest.raises(OSError):
+        fsm.save_processed_image(image, original_path)
+    assert not list(fsm.resized_images_dir.rglob("*.webp"))
+    assert fsm.save_processed_image(image, original_path).name == "processed_src_00000.webp"
+
+def test_content_store(tmp_path):
+    """内容のハッシュで保存先を決め、同じボリューム上ではデータを複製せずに保存することの確認"""
+    tmp_path = tmp_path / f"content_store_{uuid.uuid4().hex}"
+    fsm = FileSystemManager()
+    fsm.initialize(tmp_path / "output", 512, original_store='content')
+    src = tmp_path / "a" / "Image.PNG"
+    src.parent.mkdir()
+    src.write_bytes(b"image" * 1000)
+    sha256 = FileSystemManager.calculate_sha256(src)
+
+    stored = fsm.save_original_image(src, content_hash=sha256)
+    assert stored == fsm.content_store_dir / sha256[:2] / sha256[2:4] / f"{sha256}.png"
+    assert stored.read_bytes() == src.read_bytes()
+    # tmp_path は同じボリュームなのでコピーしない (ハードリンクなら同じ inode)
+    assert os.stat(stored).st_ino == os.stat(src).st_ino or FileSystemManager.reflink_file(src, tmp_path / "probe")
+
+    # 名前や場所が違っても同じ内容なら同じパスを返す
+    other = tmp_path / "b" / "other.png"
+    other.parent.mkdir()
+    other.write_bytes(src.read_bytes())
+    assert fsm.save_original_image(other) == stored
+    assert not list(fsm.content_store_dir.rglob("*.tmp"))
+
+    # リンクできない場合はコピーし、書きかけのファイルを残さない
+    dst = tmp_path / "copied.png"
+    with patch.object(FileSystemManager, 'reflink_file', return_value=False), \
+         patch('module.file_sys.os.link', side_effect=OSError("cross-device link")):
+        assert FileSystemManager.link_or_copy_file(src, dst, sha256) == 'copy'
+        with pytest.raises(ValueError):
+            FileSystemManager.link_or_copy_file(src, tmp_path / "broken.png", "0" * 64)
+    assert dst.read_bytes() == src.read_bytes()
+    assert not (tmp_path / "broken.png").exists() and not list(tmp_path.glob(".*.tmp"))
+
+    with pytest.raises(ValueError):
+        fsm.initialize(tmp_path / "output", 512, original_store='unknown')
+
+def test_copy_files(tmp_path):
+    """カーネル内のコピーと、使えない場合の shutil.copyfile の両方で内容と更新日時がコピーされることの確認"""
+    tmp_path = tmp_path / f"copy_files_{uuid.uuid4().hex}"
+    src_dir, dst_dir = tmp_path / "src", tmp_path / "dst"
+    src_dir.mkdir(parents=True)
+    dst_dir.mkdir()
+    files = []
+    for i in range(5):
+        src = src_dir / f"{i}.bin"
+        src.write_bytes(os.urandom(100_000 + i))
+        os.utime(src, ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000 + i))
+        files.append((src, dst_dir / src.name))
+    files.append((src_dir / "missing.bin", dst_dir / "missing.bin"))
+
+    progress = []
+    stats = FileSystemManager.copy_files(files, max_workers=3, progress_callback=progress.append)
+    assert stats['copied'] == 5 and stats['failed'] == 1
+    assert stats['bytes'] == sum(100_000 + i for i in range(5)) and stats['bytes_per_second'] > 0
+    assert progress == [1, 2, 3, 4, 5, 6]
+    for src, dst in files[:5]:
+        assert dst.read_bytes() == src.read_bytes()
+        assert os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns
+
+    src, dst = files[0][0], tmp_path / "fallback.bin"
+    with patch('module.file_sys.os.copy_file_range', side_effect=OSError("unsupported"), create=True):
+        assert FileSystemManager.copy_file(src, dst) is None
+    assert dst.read_bytes() == src.read_bytes()
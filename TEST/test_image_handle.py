@@ -0,0 +1,35 @@
+import pickle
+import pytest
+import imagehash
+from PIL import Image
+
+from module.file_sys import FileSystemManager
+from module.image_handle import ImageHandle
+
+@pytest.mark.parametrize("image_type", ["rgb", "rgba", "p", "cmyk"])
+def test_image_handle_matches_separate_reads(sample_images, image_type):
+    """ハンドルから求めた画像情報とpHashが、ファイルを個別に開いて求めた値と一致することの確認"""
+    path = sample_images[image_type]
+    with ImageHandle(path) as handle:
+        assert handle.info == FileSystemManager.get_image_info(path)
+        assert handle.decode_count == 0  # 画像情報はヘッダーだけから求める
+        with Image.open(path) as img:
+            assert handle.phash == str(imagehash.phash(img))
+        assert handle.grayscale_proxy.size == (ImageHandle.PHASH_PROXY_SIZE, ImageHandle.PHASH_PROXY_SIZE)
+        assert handle.image.size == handle.size
+        assert handle.decode_count == 1
+
+def test_image_handle_release_and_pickle(sample_images):
+    """解放やプロセス間の受け渡しで画素を手放し、画像情報とpHashは残すことの確認"""
+    handle = ImageHandle(sample_images["rgb"])
+    phash = handle.phash
+    info = handle.info
+    handle.release()
+    assert not handle.is_decoded
+    assert handle.phash == phash and handle.info == info
+
+    restored = pickle.loads(pickle.dumps(handle))
+    assert restored.path == handle.path
+    assert restored.info == info and restored.phash == phash
+    assert restored.decode_count == 0 and not restored.is_decoded
+    handle.close()
@@ -0,0 +1,18 @@
+"""
+GUIなしでバッチ処理を実行するエントリーポイント
+
+例:
+    python -m cli ingest testimg/1_img
+    python -m cli --shard 0/4 process testimg --resolution 1024
+    python -m cli export dataset_out --tags "1girl, solo" --resolution 1024
+"""
+import sys
+from pathlib import Path
+
+src_path = Path(__file__).parent / "src"
+sys.path.append(str(src_path))
+
+from batch_runner import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,6 +10,7 @@ from module.db import ImageDatabaseManager
 from module.log import get_logger
 
 class DatasetExportWidget(QWidget, Ui_DatasetExportWidget):
+    PAGE_SIZE = 200  # 検索結果を1回に取得する件数
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setupUi(self)
@@ -60,22 +61,32 @@ class DatasetExportWidget(QWidget, Ui_DatasetExportWidget):
         elif filter_type == "caption":
             caption = filter_text
 
-        filtered_image_metadata, list_count = self.idm.get_images_by_filter(
-            tags=tags,
-            caption=caption,
-            resolution=resolution,
-            use_and=use_and,
-            start_date=start_date,
-            end_date=end_date,
-            include_untagged=include_untagged
-        )
-        if not filtered_image_metadata:
+        # 検索結果は PAGE_SIZE 件ずつ image_id 順に取得し、idとpathの対応だけを残す
+        image_path_id_map = {}
+        list_count, after_id = None, None
+        while True:
+            page, page_count = self.idm.get_images_by_filter(
+                tags=tags,
+                caption=caption,
+                resolution=resolution,
+                use_and=use_and,
+                start_date=start_date,
+                end_date=end_date,
+                include_untagged=include_untagged,
+                limit=self.PAGE_SIZE,
+                after_id=after_id
+            )
+            if list_count is None:
+                list_count = page_count
+            image_path_id_map.update({Path(item['stored_image_path']): item['image_id'] for item in page})
+            if len(page) < self.PAGE_SIZE:
+                break
+            after_id = page[-1]['image_id']
+        if not image_path_id_map:
             self.logger.info(f"{filter_type} に {filter_text} を含む検索結果がありません")
             QMessageBox.critical(self,  "info", f"{filter_type} に {filter_text} を含む検索結果がありません")
             return
-
-        # idとpathの対応だけを取り出す
-        self.image_path_id_map = {Path(item['stored_image_path']): item['image_id'] for item in filtered_image_metadata}
+        self.image_path_id_map = image_path_id_map
 
         # サムネイルセレクターを更新
         self.update_thumbnail_selector(list(self.image_path_id_map.keys()), list_count)
@@ -101,11 +112,21 @@ class DatasetExportWidget(QWidget, Ui_DatasetExportWidget):
 
         total_images = len(selected_images)
         export_successful = True
+        try:
+            # 選択した画像のアノテーションをまとめて取得する
+            image_ids = [self.image_path_id_map[path] for path in selected_images if path in self.image_path_id_map]
+            annotations_by_id = self.idm.get_annotations_for_images(image_ids)
+        except Exception as e:
+            self.logger.error(f"エクスポート中にエラーが発生しました: {str(e)}")
+            QMessageBox.critical(self, "Error", f"エクスポート中にエラーが発生しました: {str(e)}")
+            self.exportButton.setEnabled(True)
+            return
+
         for i, image_path in enumerate(selected_images):
             try:
                 image_id = self.image_path_id_map.get(image_path)
                 if image_id is not None:
-                    annotations = self.idm.get_image_annotations(image_id)
+                    annotations = annotations_by_id[image_id]
                     if self.latestcheckBox.isChecked():
                         # 最近のアノテーションのみをフィルタリング
                         annotations = self.idm.filter_recent_annotations(annotations)
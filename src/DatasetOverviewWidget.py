@@ -11,6 +11,7 @@ from module.log import get_logger
 from caption_tags import ImageAnalyzer
 
 class DatasetOverviewWidget(QWidget, Ui_DatasetOverviewWidget):
+    PAGE_SIZE = 200  # 検索結果を1回に取得する件数
     dataset_loaded = Signal()
 
     def __init__(self, parent=None):
@@ -70,22 +71,32 @@ class DatasetOverviewWidget(QWidget, Ui_DatasetOverviewWidget):
         elif filter_type == "caption":
             caption = filter_text
 
-        filtered_image_metadata, list_count = self.idm.get_images_by_filter(
-            tags=tags,
-            caption=caption,
-            resolution=resolution,
-            use_and=use_and,
-            start_date=start_date,
-            end_date=end_date,
-            include_untagged=include_untagged
-        )
-        if not filtered_image_metadata:
+        # 検索結果は PAGE_SIZE 件ずつ image_id 順に取得し、idとpathの対応だけを残す
+        image_path_id_map = {}
+        list_count, after_id = None, None
+        while True:
+            page, page_count = self.idm.get_images_by_filter(
+                tags=tags,
+                caption=caption,
+                resolution=resolution,
+                use_and=use_and,
+                start_date=start_date,
+                end_date=end_date,
+                include_untagged=include_untagged,
+                limit=self.PAGE_SIZE,
+                after_id=after_id
+            )
+            if list_count is None:
+                list_count = page_count
+            image_path_id_map.update({item['image_id']: Path(item['stored_image_path']) for item in page})
+            if len(page) < self.PAGE_SIZE:
+                break
+            after_id = page[-1]['image_id']
+        if not image_path_id_map:
             self.logger.info(f"検索条件に一致する画像がありませんでした: {filter_type}  {filter_text}")
             QMessageBox.critical(self, "info", f"検索条件に一致する画像がありませんでした: {filter_type}  {filter_text}")
             return
-
-        # idとpathの対応だけを取り出す
-        self.image_path_id_map = {item['image_id']: Path(item['stored_image_path']) for item in filtered_image_metadata}
+        self.image_path_id_map = image_path_id_map
 
         # サムネイルセレクターを更新
         self.update_thumbnail_selector(list(self.image_path_id_map.values()))
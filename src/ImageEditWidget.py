@@ -10,8 +10,10 @@ from gui_file.ImageEditWidget_ui import Ui_ImageEditWidget
 from module.log import get_logger
 from module.file_sys import FileSystemManager
 from module.db import ImageDatabaseManager
+from module.image_handle import ImageHandle
 from caption_tags import ImageAnalyzer
-from ImageEditor import ImageProcessingManager
+from ImageEditor import ImageProcessingManager, Upscaler
+from batch_runner import ImageBatchProcessor
 
 class ImageEditWidget(QWidget, Ui_ImageEditWidget):
     THUMBNAIL_SIZE = 64
@@ -41,9 +43,12 @@ class ImageEditWidget(QWidget, Ui_ImageEditWidget):
 
     def initialize_processing(self):
         """画像処理に必要なクラスの初期化"""
-        self.fsm.initialize(Path(self.cm.config['directories']['output']), self.target_resolution)
+        self.fsm.initialize(Path(self.cm.config['directories']['output']), self.target_resolution,
+                            self.cm.config['image_processing'].get('original_store', 'dated'))
         self.ipm = ImageProcessingManager(self.fsm, self.target_resolution,
-                                          self.preferred_resolutions)
+                                          self.preferred_resolutions,
+                                          self.cm.config['image_processing'].get('autocrop_proxy_max_side', 0),
+                                          Upscaler.options_from_config(self.cm.config['image_processing']))
 
     def showEvent(self, event):
         """ウィジェットが表示される際にメインウィンドウで選択された画像を表示する"""
@@ -138,46 +143,28 @@ class ImageEditWidget(QWidget, Ui_ImageEditWidget):
 
     def process_all_images(self, progress_callback=None, status_callback=None, is_canceled=None):
         try:
-            total_images = len(self.directory_images)
-            for index, image_path in enumerate(self.directory_images):
-                if is_canceled and is_canceled():
-                    break
-                self.process_image(image_path)
-                # 進捗の更新
-                if progress_callback:
-                    progress = int((index + 1) / total_images * 100)
-                    progress_callback(progress)
-                # ステータスの更新
-                if status_callback:
-                    status_callback(f"画像 {index + 1}/{total_images} を処理中")
+            processor = ImageBatchProcessor.from_config(self.cm.config, self.fsm, self.idm, self.ipm,
+                                                        self.target_resolution, upscaler=self.upscaler)
+            processor.process_images(self.directory_images, progress_callback, status_callback, is_canceled)
         except Exception as e:
             self.logger.error(f"画像処理中にエラーが発生しました: {str(e)}")
             raise e
 
     def process_image(self, image_file: Path):
-        image_id = self.idm.detect_duplicate_image(image_file)
-        if not image_id:
-            image_id, original_image_metadata = self.idm.register_original_image(image_file, self.fsm)
-        else:
-            original_image_metadata = self.idm.get_image_metadata(image_id)
-
-        existing_annotations = ImageAnalyzer.get_existing_annotations(image_file)
-        if existing_annotations:
-            self.idm.save_annotations(image_id, existing_annotations)
-        else:
-            self.idm.save_annotations(image_id, {'tags': [], 'captions': []})
-
-        existing_processed_image = self.idm.check_processed_image_exists(image_id, self.target_resolution)
-        if existing_processed_image:
-            self.logger.info(f"指定解像度の画像は保存済みです: {image_file}")
-            return
-
-        processed_image = self.ipm.process_image(
-            image_file,
-            original_image_metadata['has_alpha'],
-            original_image_metadata['mode'],
-            upscaler=self.upscaler
-        )
+        processor = ImageBatchProcessor.from_config(self.cm.config, self.fsm, self.idm, self.ipm,
+                                                    self.target_resolution, upscaler=self.upscaler)
+        with ImageHandle(image_file) as handle:
+            prepared = processor.prepare_image(image_file, handle)
+            if not prepared:
+                return
+            image_id, original_image_metadata = prepared
+
+            processed_image = self.ipm.process_image(
+                handle,
+                original_image_metadata['has_alpha'],
+                original_image_metadata['mode'],
+                upscaler=self.upscaler
+            )
         if processed_image:
             self.handle_processing_result(processed_image, image_file, image_id)
         else:
@@ -4,20 +4,25 @@
 - 画像の色域を変換
 - 画像をリサイズ
 """
+import os
 import cv2
+import math
+import threading
 from pathlib import Path
-from spandrel import ModelLoader, ImageModelDescriptor
+from spandrel import ModelLoader, ImageModelDescriptor, ModelTiling
 import torch
 import numpy as np
 from PIL import Image
 from module.file_sys import FileSystemManager
+from module.image_handle import ImageHandle
 from module.log import get_logger
 from typing import Optional
 from scipy import ndimage
 
 class ImageProcessingManager:
     def __init__(self, file_system_manager: FileSystemManager, target_resolution: int,
-                 preferred_resolutions: list[tuple[int, int]]):
+                 preferred_resolutions: list[tuple[int, int]], autocrop_proxy_max_side: int = 0,
+                 upscaler_options: Optional[dict] = None):
         """
         ImageProcessingManagerを初期化
         デフォルト値はmodule/config.pyに定義
@@ -26,10 +31,14 @@ class ImageProcessingManager:
             file_system_manager (FileSystemManager): ファイルシステムマネージャ
             target_resolution (int): 目標解像度
             preferred_resolutions (list[tuple[int, int]]): 優先解像度リスト #TODO: 解像度じゃなくてアスペクト比表記のほうがいいかも
+            autocrop_proxy_max_side (int): 自動クロップの枠検出に使う縮小版の長辺 0で縮小しない
+            upscaler_options (Optional[dict]): Upscaler.upscale_image に渡すオプション (Upscaler.options_from_config で読み込む)
         """
         self.logger = get_logger(__name__)
         self.file_system_manager = file_system_manager
         self.target_resolution = target_resolution
+        self.autocrop_proxy_max_side = autocrop_proxy_max_side
+        self.upscaler_options = upscaler_options or {}
 
         try:
             # ImageProcessorの初期化
@@ -41,12 +50,13 @@ class ImageProcessingManager:
             self.logger.error(message)
             raise ValueError(message) from e
 
-    def process_image(self, db_stored_original_path: Path, original_has_alpha: bool, original_mode: str, upscaler: str = None) -> Optional[Image.Image]:
+    def process_image(self, db_stored_original_path: Path | ImageHandle, original_has_alpha: bool, original_mode: str, upscaler: str = None) -> Optional[Image.Image]:
         """
         画像を処理し、処理後の画像オブジェクトを返す
 
         Args:
-            db_stored_original_path (Path): 処理する画像ファイルのパス
+            db_stored_original_path (Path | ImageHandle): 処理する画像ファイルのパス、または重複チェックなどで開いた画像のハンドル。
+                デコード済みのハンドルはデコードし直さずに使う。ハンドルは呼び出し元で閉じる
             original_has_alpha (bool): 元画像がアルファチャンネルを持つかどうか
             original_mode (str): 元画像のモード (例: 'RGB', 'CMYK', 'P')
             upscaler (str): アップスケーラーの名前
@@ -55,31 +65,113 @@ class ImageProcessingManager:
             Optional[Image.Image]: 処理済み画像オブジェクト。処理不要の場合はNone
 
         """
+        if isinstance(db_stored_original_path, ImageHandle):
+            handle, own_handle = db_stored_original_path, False
+        else:
+            handle, own_handle = ImageHandle(db_stored_original_path), True
+        db_stored_original_path = handle.path
         try:
-            with Image.open(db_stored_original_path) as img:
-                cropped_img = AutoCrop.auto_crop_image(img)
+            # 出力サイズより十分大きい画像は縮小して読み込む
+            original_size = handle.size
+            scale = self.image_processor.reduction_scale(*original_size)
+            if scale > 1:
+                if handle.is_decoded:
+                    # デコード済みの画像から縮小する
+                    reduced_img = self.image_processor.load_reduced(handle.image, scale)
+                else:
+                    # ハンドルの画像は元の解像度のまま残すため、別に開いて draft で縮小してデコードする
+                    with Image.open(db_stored_original_path) as img:
+                        reduced_img = self.image_processor.load_reduced(img, scale)
+                # クロップの余白が元の解像度で同じ幅になるよう、実際に縮小された倍率で割る
+                margin = max(1, round(AutoCrop.CROP_MARGIN * reduced_img.width / original_size[0]))
+                cropped_img = AutoCrop.auto_crop_image(reduced_img, self.autocrop_proxy_max_side, margin=margin)
+                if self.image_processor.is_large_enough(cropped_img.width, cropped_img.height):
+                    self.logger.debug(f"1/{scale} に縮小して読み込みました: {db_stored_original_path} {original_size} -> {reduced_img.size}")
+                    return self._convert_and_resize(cropped_img, db_stored_original_path, original_has_alpha,
+                                                    original_mode, upscaler)
+                # クロップで小さくなり出力サイズに足りないので、元の解像度で読み込み直す
+                self.logger.debug(f"縮小して読み込むとクロップ後の画像が出力サイズに足りません: {db_stored_original_path}")
+
+            cropped_img = AutoCrop.auto_crop_image(handle.image, self.autocrop_proxy_max_side)
+            return self._convert_and_resize(cropped_img, db_stored_original_path, original_has_alpha,
+                                            original_mode, upscaler)
 
-                converted_img = self.image_processor.normalize_color_profile(cropped_img, original_has_alpha, original_mode)
+        except Exception as e:
+            self.logger.error("画像処理中にエラーが発生しました: %s", e)
+        finally:
+            if own_handle:
+                handle.close()
 
-                if max(cropped_img.width, cropped_img.height) < self.target_resolution:
-                    if upscaler: #TODO: アップスケールした画像はそれを示すデータも保存すべきか？
-                        if converted_img.mode == 'RGBA':
-                            self.logger.info(f"RGBA 画像のためアップスケールをスキップ: {db_stored_original_path}")
-                        else:
-                            self.logger.debug(f"長編が指定解像度未満のため{db_stored_original_path}をアップスケールします: {upscaler}")
-                            converted_img = Upscaler.upscale_image(converted_img, upscaler)
-                            if max(converted_img.width, converted_img.height) < self.target_resolution:
-                                self.logger.info(f"画像サイズが小さすぎるため処理をスキップ: {db_stored_original_path}")
-                                return None
-                resized_img = self.image_processor.resize_image(converted_img)
+    def _convert_and_resize(self, cropped_img: Image.Image, db_stored_original_path: Path, original_has_alpha: bool,
+                            original_mode: str, upscaler: str = None) -> Optional[Image.Image]:
+        """
+        クロップ済みの画像の色空間を正規化し、必要ならアップスケールしてから目標解像度にリサイズする
 
-                return resized_img
+        Args:
+            cropped_img (Image.Image): クロップ済みの画像
+            db_stored_original_path (Path): 元画像のパス (ログ用)
+            original_has_alpha (bool): 元画像がアルファチャンネルを持つかどうか
+            original_mode (str): 元画像のモード
+            upscaler (str): アップスケーラーの名前
 
-        except Exception as e:
-            self.logger.error("画像処理中にエラーが発生しました: %s", e)
+        Returns:
+            Optional[Image.Image]: 処理済み画像オブジェクト。処理不要の場合はNone
+        """
+        converted_img = self.image_processor.normalize_color_profile(cropped_img, original_has_alpha, original_mode)
+
+        if max(cropped_img.width, cropped_img.height) < self.target_resolution:
+            if upscaler: #TODO: アップスケールした画像はそれを示すデータも保存すべきか？
+                if converted_img.mode == 'RGBA':
+                    self.logger.info(f"RGBA 画像のためアップスケールをスキップ: {db_stored_original_path}")
+                else:
+                    self.logger.debug(f"長編が指定解像度未満のため{db_stored_original_path}をアップスケールします: {upscaler}")
+                    converted_img = Upscaler.upscale_image(converted_img, upscaler, **self.upscaler_options)
+                    if max(converted_img.width, converted_img.height) < self.target_resolution:
+                        self.logger.info(f"画像サイズが小さすぎるため処理をスキップ: {db_stored_original_path}")
+                        return None
+        resized_img = self.image_processor.resize_image(converted_img)
+
+        return resized_img
+
+_worker_processing_manager: Optional[ImageProcessingManager] = None
+
+def initialize_process_worker(target_resolution: int, preferred_resolutions: list[tuple[int, int]],
+                              autocrop_proxy_max_side: int = 0, upscaler_options: Optional[dict] = None) -> None:
+    """
+    ProcessPoolExecutor の initializer
+    ワーカープロセスごとに ImageProcessingManager を1つだけ生成する
+
+    Args:
+        target_resolution (int): 目標解像度
+        preferred_resolutions (list[tuple[int, int]]): 優先解像度リスト
+        autocrop_proxy_max_side (int): 自動クロップの枠検出に使う縮小版の長辺 0で縮小しない
+        upscaler_options (Optional[dict]): Upscaler.upscale_image に渡すオプション (Upscaler.worker_options で分割したもの)
+    """
+    global _worker_processing_manager
+    _worker_processing_manager = ImageProcessingManager(None, target_resolution, preferred_resolutions,
+                                                        autocrop_proxy_max_side, upscaler_options)
+
+def process_image_in_worker(db_stored_original_path: Path | ImageHandle, original_has_alpha: bool, original_mode: str,
+                            upscaler: str = None) -> Optional[Image.Image]:
+    """
+    ワーカープロセス内で ImageProcessingManager.process_image を実行する
+
+    Args:
+        db_stored_original_path (Path | ImageHandle): 処理する画像ファイルのパス、または画像のハンドル (画素は含まれない)
+        original_has_alpha (bool): 元画像がアルファチャンネルを持つかどうか
+        original_mode (str): 元画像のモード
+        upscaler (str): アップスケーラーの名前
+
+    Returns:
+        Optional[Image.Image]: 処理済み画像オブジェクト。処理不要の場合はNone
+    """
+    if _worker_processing_manager is None:
+        raise RuntimeError("ワーカープロセスが初期化されていません。initialize_process_worker を指定してください")
+    return _worker_processing_manager.process_image(db_stored_original_path, original_has_alpha, original_mode, upscaler)
 
 class ImageProcessor:
     logger = get_logger("ImageProcessor")
+    UNREDUCIBLE_MODES = ('1', 'P', 'I;16', 'I;16L', 'I;16B', 'I;16N')  # Image.reduce が扱えないモード
     def __init__(self, file_system_manager: FileSystemManager, target_resolution: int, preferred_resolutions: list[tuple[int, int]]) -> None:
         self.logger = ImageProcessor.logger
         self.file_system_manager = file_system_manager
@@ -143,8 +235,79 @@ class ImageProcessor:
             return min(matching_resolutions, key=lambda res: abs((res[0] * res[1]) - target_area))
         return None
 
-    def resize_image(self, img: Image.Image) -> Image.Image:
-        original_width, original_height = img.size
+    def max_output_side(self) -> int:
+        """resize_image が出力する画像の長辺の最大値"""
+        # アスペクト比ごとに _find_matching_resolution が選ぶ解像度
+        target_area = self.target_resolution ** 2
+        chosen: dict[float, tuple[int, int]] = {}
+        for res in self.preferred_resolutions:
+            aspect_ratio = res[0] / res[1]
+            if (aspect_ratio not in chosen
+                    or abs(res[0] * res[1] - target_area) < abs(chosen[aspect_ratio][0] * chosen[aspect_ratio][1] - target_area)):
+                chosen[aspect_ratio] = res
+        # 一致しない場合は長辺を target_resolution にして32の倍数に丸める
+        return max([math.ceil(self.target_resolution / 32) * 32] + [max(res) for res in chosen.values()])
+
+    def reduction_scale(self, width: int, height: int) -> int:
+        """
+        長辺が max_output_side を下回らない範囲で、読み込み時に縮小できる最大の2のべき乗を返す
+
+        Args:
+            width (int): 画像の幅
+            height (int): 画像の高さ
+
+        Returns:
+            int: 縮小率の逆数 (1, 2, 4, 8, ...)。縮小しない場合は1
+        """
+        required_side = self.max_output_side()
+        scale = 1
+        while max(width, height) // (scale * 2) >= required_side:
+            scale *= 2
+        return scale
+
+    def is_large_enough(self, width: int, height: int) -> bool:
+        """resize_image で拡大せずに出力サイズにできる大きさかどうか"""
+        if max(width, height) < self.target_resolution:
+            return False
+        new_width, new_height = self.output_size(width, height)
+        return width >= new_width and height >= new_height
+
+    @staticmethod
+    def load_reduced(img: Image.Image, scale: int) -> Image.Image:
+        """
+        開いた画像を 1/scale に縮小して読み込む。
+        JPEG は draft で DCT の段階で縮小してデコードする (1/2, 1/4, 1/8)。
+        draft に対応しない形式や、draft で縮小しきれない分は読み込み後に reduce で縮小する。
+        reduce に対応しないモード (P, 1, I;16 など) は縮小しない。
+
+        Args:
+            img (Image.Image): Image.open で開いた、まだ読み込んでいない画像
+            scale (int): 縮小率の逆数 (2のべき乗)
+
+        Returns:
+            Image.Image: 縮小した画像
+        """
+        original_width = img.width
+        # 要求したサイズ以上で最も小さくなる倍率が選ばれるので、切り上げたサイズを指定して scale より縮小しないようにする
+        img.draft(None, (math.ceil(img.width / scale), math.ceil(img.height / scale)))
+        img.load()
+        remaining = scale // max(1, round(original_width / img.width))
+        if remaining > 1 and img.mode not in ImageProcessor.UNREDUCIBLE_MODES:
+            return img.reduce(remaining)
+        return img
+
+    def output_size(self, width: int, height: int) -> tuple[int, int]:
+        """
+        resize_image で出力する画像のサイズを返す
+
+        Args:
+            width (int): 画像の幅
+            height (int): 画像の高さ
+
+        Returns:
+            tuple[int, int]: 出力する画像の (幅, 高さ)
+        """
+        original_width, original_height = width, height
         matching_resolution = self._find_matching_resolution(original_width, original_height)
 
         if matching_resolution:
@@ -163,13 +326,19 @@ class ImageProcessor:
             # 両辺を32の倍数に調整
             new_width = round(new_width / 32) * 32
             new_height = round(new_height / 32) * 32
+        return new_width, new_height
 
+    def resize_image(self, img: Image.Image) -> Image.Image:
         # アスペクト比を保ちつつ、新しいサイズでリサイズ
-        return img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        return img.resize(self.output_size(img.width, img.height), Image.Resampling.LANCZOS)
 
 
 class AutoCrop:
     _instance = None
+    # 縮小版で検出した辺を元の解像度で検出し直す帯の幅。GaussianBlur(5x5) と adaptiveThreshold(11x11) が参照する画素数
+    # 縮小版ではこれらが縮小率の分だけ広い範囲を参照するので、検出した辺は縮小版の画素でこの程度外側にずれる
+    REFINE_PADDING = 8
+    CROP_MARGIN = 5  # 検出した領域から余分に削るピクセル数
 
     def __new__(cls):
         if cls._instance is None:
@@ -181,9 +350,22 @@ class AutoCrop:
         self.logger = get_logger(__name__)
 
     @classmethod
-    def auto_crop_image(cls, pil_image: Image.Image) -> Image.Image:
+    def auto_crop_image(cls, pil_image: Image.Image, proxy_max_side: int = 0, refine: bool = True,
+                        margin: int = CROP_MARGIN) -> Image.Image:
+        """
+        画像の枠を検出してクロップする
+
+        Args:
+            pil_image (Image.Image): 処理する画像
+            proxy_max_side (int): 長辺がこれより大きい画像は、この長辺に縮小した画像で枠を検出する。0で縮小しない
+            refine (bool): 縮小版で検出した各辺の周辺だけを元の解像度で検出し直す場合は True
+            margin (int): 検出した領域から余分に削るピクセル数。縮小して読み込んだ画像では縮小率に合わせて小さくする
+
+        Returns:
+            Image.Image: クロップされた（または元の）画像
+        """
         instance = cls()
-        return instance._auto_crop_image(pil_image)
+        return instance._auto_crop_image(pil_image, proxy_max_side, refine, margin)
 
     @staticmethod
     def _convert_to_gray(image: np.ndarray) -> np.ndarray:
@@ -193,7 +375,7 @@ class AutoCrop:
         if image.shape[2] == 3:
             return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
         if image.shape[2] == 4:
-            return cv2.cvtColor(cv2.cvtColor(image, cv2.COLOR_RGBA2RGB), cv2.COLOR_RGB2GRAY)
+            return cv2.cvtColor(image, cv2.COLOR_RGBA2GRAY)
         raise ValueError(f"サポートされていない画像形式です。形状: {image.shape}")
 
     @staticmethod
@@ -261,81 +443,205 @@ class AutoCrop:
 
         return detected_borders
 
-    def _get_crop_area(self, np_image: np.ndarray) -> Optional[tuple[int, int, int, int]]:
+    def _get_crop_area(self, np_image: np.ndarray, proxy_max_side: int = 0, refine: bool = True,
+                       margin: int = CROP_MARGIN) -> Optional[tuple[int, int, int, int]]:
         """
         クロップ領域を検出するためのメソッド。OpenCV を使ったエリア検出。
+        長辺が proxy_max_side より大きい画像は縮小版で検出し、元の解像度の座標に戻す。
+
+        Args:
+            np_image (np.ndarray): 画像
+            proxy_max_side (int): 検出に使う縮小版の長辺。0で縮小しない
+            refine (bool): 縮小版で検出した各辺の周辺だけを元の解像度で検出し直す場合は True
+            margin (int): 検出した領域から余分に削るピクセル数
+
+        Returns:
+            Optional[tuple[int, int, int, int]]: クロップ領域 (x, y, 幅, 高さ)。検出できない場合は None
         """
         try:
-            # 差分によるクロップ領域検出を追加
-            complementary_color = [255 - np.mean(np_image[..., i]) for i in range(3)]
-            background = np.full(np_image.shape, complementary_color, dtype=np.uint8)
-            diff = cv2.absdiff(np_image, background)
-
-            # 差分をグレースケール変換
-            gray_diff = self._convert_to_gray(diff)
-
-            # ブラー処理を適用してノイズ除去
-            blurred_diff = cv2.GaussianBlur(gray_diff, (5, 5), 0)
-
-            # しきい値処理
-            thresh = cv2.adaptiveThreshold(
-                blurred_diff,  # グレースケール化された差分画像を使う
-                255,  # 最大値（白）
-                cv2.ADAPTIVE_THRESH_GAUSSIAN_C,  # 適応的しきい値の種類（ガウス法）
-                cv2.THRESH_BINARY,  # 2値化（白か黒）
-                11,  # ピクセル近傍のサイズ (奇数で指定)
-                2   # 平均値または加重平均から減算する定数
-            )
-            # エッジ検出
-            edges = cv2.Canny(thresh, threshold1=30, threshold2=100)
-            # 輪郭検出
-            contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            if contours:
-                x_min, y_min, x_max, y_max = np_image.shape[1], np_image.shape[0], 0, 0
-                for contour in contours:
-                    x, y, w, h = cv2.boundingRect(contour)
-                    x_min, y_min = min(x_min, x), min(y_min, y)
-                    x_max, y_max = max(x_max, x + w), max(y_max, y + h)
-
-                # マスク処理によってクロップ領域を決定する
-                mask = np.zeros(np_image.shape[:2], dtype=np.uint8)
-                for contour in contours:
-                    cv2.drawContours(mask, [contour], -1, 255, thickness=cv2.FILLED)
-
-                # マスクの白い領域の座標を取得
-                y_coords, x_coords = np.where(mask == 255)
-                if len(x_coords) > 0 and len(y_coords) > 0:
-                    x_min, y_min = np.min(x_coords), np.min(y_coords)
-                    x_max, y_max = np.max(x_coords), np.max(y_coords)
-
-                    # エリアを検証する必要がなくなり、ここで余分な領域を削るロジックを追加する
-                    # TODO: このロジックは適切かどうかを検討する
-                    margin = 5  # 余分に削るピクセル数
-                    x_min = max(0, x_min + margin)
-                    y_min = max(0, y_min + margin)
-                    x_max = min(np_image.shape[1], x_max - margin)
-                    y_max = min(np_image.shape[0], y_max - margin)
-
-                    return x_min, y_min, x_max - x_min, y_max - y_min
-            return None
+            np_image = self._color_channels(np_image)
+            height, width = np_image.shape[:2]
+            if proxy_max_side and max(height, width) > proxy_max_side:
+                content_box = self._detect_content_box_with_proxy(np_image, proxy_max_side, refine)
+            else:
+                complementary_color = self._complementary_color(np_image)
+                content_box = self._detect_content_box(np_image, complementary_color)
+            if content_box is None:
+                return None
+            x_min, y_min, x_max, y_max = content_box
+
+            # エリアを検証する必要がなくなり、ここで余分な領域を削るロジックを追加する
+            # TODO: このロジックは適切かどうかを検討する
+            x_min = max(0, x_min + margin)
+            y_min = max(0, y_min + margin)
+            x_max = min(width, x_max - margin)
+            y_max = min(height, y_max - margin)
+
+            return x_min, y_min, x_max - x_min, y_max - y_min
         except Exception as e:
             self.logger.error(f"AutoCrop._get_crop_area: クロップ領域の検出中にエラーが発生しました: {e}")
             return None
 
-    def _auto_crop_image(self, pil_image: Image.Image) -> Image.Image:
+    @staticmethod
+    def _color_channels(np_image: np.ndarray) -> np.ndarray:
+        """枠の検出に使う色のチャンネルを返す。RGBA はアルファを除き、RGB とグレースケールはそのまま返す"""
+        if np_image.ndim == 3 and np_image.shape[2] == 4:
+            return cv2.cvtColor(np_image, cv2.COLOR_RGBA2RGB)
+        return np_image
+
+    @staticmethod
+    def _complementary_color(np_image: np.ndarray) -> list[float]:
+        """画像の平均色の補色をチャンネルごとに返す"""
+        channels = 1 if np_image.ndim == 2 else np_image.shape[2]
+        return [255 - mean for mean in cv2.mean(np_image)[:channels]]
+
+    def _detect_content_box_with_proxy(self, np_image: np.ndarray, proxy_max_side: int,
+                                       refine: bool) -> Optional[tuple[int, int, int, int]]:
+        """
+        長辺を proxy_max_side に縮小した画像で内容の領域を検出し、元の解像度の座標に戻す。
+        縮小版の1画素は元の複数の画素にまたがるので、取りこぼさないよう外側に丸める。
+
+        Returns:
+            Optional[tuple[int, int, int, int]]: 元の解像度での (x_min, y_min, x_max, y_max)。max も領域に含む
+        """
+        height, width = np_image.shape[:2]
+        scale = proxy_max_side / max(height, width)
+        proxy_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        proxy = cv2.resize(np_image, proxy_size, interpolation=cv2.INTER_AREA)
+        # 面積平均で縮小しているので、補色の元にする平均色は元の画像とほぼ同じになる
+        complementary_color = self._complementary_color(proxy)
+        proxy_box = self._detect_content_box(proxy, complementary_color)
+        if proxy_box is None:
+            return None
+
+        scale_x, scale_y = width / proxy_size[0], height / proxy_size[1]
+        x_min, y_min, x_max, y_max = proxy_box
+        content_box = (
+            math.floor(x_min * scale_x), math.floor(y_min * scale_y),
+            min(width, math.ceil((x_max + 1) * scale_x)) - 1, min(height, math.ceil((y_max + 1) * scale_y)) - 1
+        )
+        self.logger.debug(f"縮小版 {proxy_size} で検出した領域: {proxy_box} -> {content_box}")
+        if refine:
+            refined_box = self._refine_content_box(np_image, content_box, complementary_color,
+                                                   math.ceil(max(scale_x, scale_y)))
+            if refined_box is None:
+                # 縮小版でしか見つからない輪郭は元の解像度での検出結果と一致しないので、元の解像度で検出し直す
+                self.logger.debug("縮小版で検出した辺を元の解像度で確認できないため、元の解像度で検出します")
+                return self._detect_content_box(np_image, self._complementary_color(np_image))
+            content_box = refined_box
+        return content_box
+
+    def _refine_content_box(self, np_image: np.ndarray, content_box: tuple[int, int, int, int],
+                            complementary_color: list[float], proxy_pixel: int) -> Optional[tuple[int, int, int, int]]:
+        """
+        縮小版から戻した領域の各辺について、辺の周辺の帯だけを元の解像度で検出し直す
+
+        Args:
+            np_image (np.ndarray): 元の解像度の画像
+            content_box (tuple[int, int, int, int]): 縮小版から戻した (x_min, y_min, x_max, y_max)
+            complementary_color (list[float]): 差分に使う補色
+            proxy_pixel (int): 縮小版の1画素に相当する元の画素数
+
+        Returns:
+            Optional[tuple[int, int, int, int]]: 検出し直した (x_min, y_min, x_max, y_max)。
+                どの辺の周辺でも輪郭が見つからない場合は None
+        """
+        height, width = np_image.shape[:2]
+        x_min, y_min, x_max, y_max = content_box
+        pad = self.REFINE_PADDING * (proxy_pixel + 1)
+        # 辺に沿った方向は領域全体、辺と直交する方向は辺の前後 pad 画素
+        x_range = (max(0, x_min - pad), min(width, x_max + pad + 1))
+        y_range = (max(0, y_min - pad), min(height, y_max + pad + 1))
+        bands = {
+            'top': ((max(0, y_min - pad), min(height, y_min + pad + 1)), x_range),
+            'bottom': ((max(0, y_max - pad), min(height, y_max + pad + 1)), x_range),
+            'left': (y_range, (max(0, x_min - pad), min(width, x_min + pad + 1))),
+            'right': (y_range, (max(0, x_max - pad), min(width, x_max + pad + 1))),
+        }
+        refined = list(content_box)
+        found = False
+        for side, ((top, bottom), (left, right)) in bands.items():
+            band_box = self._detect_content_box(np_image[top:bottom, left:right], complementary_color)
+            if band_box is None:
+                continue
+            found = True
+            if side == 'top':
+                refined[1] = top + band_box[1]
+            elif side == 'bottom':
+                refined[3] = top + band_box[3]
+            elif side == 'left':
+                refined[0] = left + band_box[0]
+            else:
+                refined[2] = left + band_box[2]
+        return tuple(refined) if found else None
+
+    def _detect_content_box(self, np_image: np.ndarray,
+                            complementary_color: list[float]) -> Optional[tuple[int, int, int, int]]:
+        """
+        補色との差分からエッジを検出し、エッジを囲む領域を求める。
+        外側の輪郭で囲まれた領域はエッジの画素を囲む矩形と一致するので、輪郭やマスクは作らずに
+        行と列ごとにエッジの有無を集計して求める
+
+        Args:
+            np_image (np.ndarray): RGB またはグレースケールの画像
+            complementary_color (list[float]): 差分に使う補色
+
+        Returns:
+            Optional[tuple[int, int, int, int]]: (x_min, y_min, x_max, y_max)。max も領域に含む。検出できない場合は None
+        """
+        # 差分によるクロップ領域検出を追加
+        # 補色は画像と同じ大きさの配列にせず、スカラーとして渡す (uint8 への変換は切り捨て)
+        background = [int(value) for value in np.array(complementary_color).astype(np.uint8)]
+        diff = cv2.absdiff(np_image, tuple(background + [0] * (4 - len(background))))
+
+        # 差分をグレースケール変換
+        # 大きな画像で中間の配列が同時に残らないよう、使い終わったものから解放する
+        gray_diff = self._convert_to_gray(diff)
+        del diff
+
+        # ブラー処理を適用してノイズ除去 (同じ配列に上書きする)
+        blurred_diff = cv2.GaussianBlur(gray_diff, (5, 5), 0, dst=gray_diff)
+
+        # しきい値処理
+        thresh = cv2.adaptiveThreshold(
+            blurred_diff,  # グレースケール化された差分画像を使う
+            255,  # 最大値（白）
+            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,  # 適応的しきい値の種類（ガウス法）
+            cv2.THRESH_BINARY,  # 2値化（白か黒）
+            11,  # ピクセル近傍のサイズ (奇数で指定)
+            2   # 平均値または加重平均から減算する定数
+        )
+        del gray_diff, blurred_diff
+        # エッジ検出
+        edges = cv2.Canny(thresh, threshold1=30, threshold2=100)
+        del thresh
+
+        # エッジのある行と列の範囲
+        rows = np.any(edges, axis=1)
+        if not rows.any():
+            return None
+        cols = np.any(edges, axis=0)
+        y_min, y_max = int(np.argmax(rows)), len(rows) - 1 - int(np.argmax(rows[::-1]))
+        x_min, x_max = int(np.argmax(cols)), len(cols) - 1 - int(np.argmax(cols[::-1]))
+        return x_min, y_min, x_max, y_max
+
+    def _auto_crop_image(self, pil_image: Image.Image, proxy_max_side: int = 0, refine: bool = True,
+                         margin: int = CROP_MARGIN) -> Image.Image:
         """
         PIL.Image オブジェクトを受け取り、必要に応じて自動クロップを行います。
 
         Args:
             pil_image (Image.Image): 処理する PIL.Image オブジェクト
+            proxy_max_side (int): 枠の検出に使う縮小版の長辺。0で縮小しない
+            refine (bool): 縮小版で検出した各辺の周辺だけを元の解像度で検出し直す場合は True
+            margin (int): 検出した領域から余分に削るピクセル数
 
         Returns:
             Image.Image: クロップされた（または元の）PIL.Image オブジェクト
         """
         try:
             np_image = np.array(pil_image)
-            crop_area = self._get_crop_area(np_image)
+            crop_area = self._get_crop_area(np_image, proxy_max_side, refine, margin)
 
             # デバッグ情報の出力
             self.logger.debug(f"Crop area: {crop_area}")
@@ -355,25 +661,156 @@ class AutoCrop:
             return pil_image
 
 class Upscaler:
+    """
+    spandrel で読み込んだ超解像モデルで画像をアップスケールする
+    - モデルはプロセス内でモデル名とデバイスごとに1回だけ読み込み、get で使い回す
+    - GPU がない場合は CPU で推論し、torch のスレッド数を設定する
+    - 大きな画像は重なりのある同じ大きさのタイルに分割して推論し、メモリ使用量を抑える
+    - 同じ大きさのタイルは画像をまたいで batch_size 枚ずつまとめて推論する
+    """
     # TODO: 暫定的なモデルパスとスケール値､もっと追加がしやすいようにする
     MODEL_PATHS: dict[str, tuple[Path, float]] = {
         "RealESRGAN_x4plus": (Path(r"H:\StabilityMatrix-win-x64\Data\Models\RealESRGAN\RealESRGAN_x4plus.pth"), 4.0),
     }
-    def __init__(self, model_name: str):
+    TILE_SIZE = 512  # タイルごとに結果を使う領域の一辺 (入力のピクセル数) 0で分割しない
+    TILE_OVERLAP = 16  # タイルの周囲に含める隣の領域の幅 継ぎ目が出ないよう、この部分の推論結果は使わない
+    BATCH_SIZE = 4  # 1回の推論にまとめるタイル数
+    _instances: dict[tuple[str, str], 'Upscaler'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, model_name: str, device: str = 'auto', num_threads: int = 0):
+        """
+        モデルを読み込む 通常は get でキャッシュしたインスタンスを取得する
+
+        Args:
+            model_name (str): MODEL_PATHS に登録したモデル名
+            device (str): 推論に使うデバイス ('auto', 'cuda', 'cpu' など) 'auto' は CUDA が使えれば CUDA
+            num_threads (int): CPU で推論する場合のスレッド数 0でCPU数
+        """
         self.logger = get_logger(__name__)
+        self.model_name = model_name
         self.model_path, self.recommended_scale = self.MODEL_PATHS[model_name]
+        self.device = self.select_device(device, num_threads)
         self.model = self._load_model(self.model_path)
-        self.model.cuda().eval()
+        self.model.to(self.device).eval()
+
+    @classmethod
+    def get(cls, model_name: str, device: str = 'auto', num_threads: int = 0) -> 'Upscaler':
+        """
+        モデル名とデバイスごとにプロセス内で1つだけ生成した Upscaler を返す
+
+        Args:
+            model_name (str): MODEL_PATHS に登録したモデル名
+            device (str): 推論に使うデバイス
+            num_threads (int): CPU で推論する場合のスレッド数 0でCPU数
+
+        Returns:
+            Upscaler: 読み込み済みのモデルを持つインスタンス
+        """
+        key = (model_name, str(cls.select_device(device, num_threads)))
+        with cls._instances_lock:
+            upscaler = cls._instances.get(key)
+            if upscaler is None:
+                upscaler = cls(model_name, device, num_threads)
+                cls._instances[key] = upscaler
+                upscaler.logger.info(f"アップスケールモデルを読み込みました: {model_name} ({key[1]})")
+            return upscaler
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """読み込んだモデルを解放する"""
+        with cls._instances_lock:
+            cls._instances.clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    @staticmethod
+    def select_device(device: str = 'auto', num_threads: int = 0) -> torch.device:
+        """
+        推論に使うデバイスを決める CUDA が使えない場合は CPU にフォールバックし、torch のスレッド数を設定する
+
+        Args:
+            device (str): 'auto' または torch.device に指定できる文字列
+            num_threads (int): CPU で推論する場合のスレッド数 0でCPU数
+
+        Returns:
+            torch.device: 推論に使うデバイス
+        """
+        if not device or device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        selected = torch.device(device)
+        if selected.type == 'cuda' and not torch.cuda.is_available():
+            get_logger(__name__).warning(f"CUDA が使えないため CPU でアップスケールします: {device}")
+            selected = torch.device('cpu')
+        if selected.type == 'cpu':
+            threads = num_threads or os.cpu_count() or 1
+            if torch.get_num_threads() != threads:
+                torch.set_num_threads(threads)
+        return selected
+
+    @staticmethod
+    def runs_on_cpu(device: str = 'auto') -> bool:
+        """select_device と同じ規則で、CPU で推論するかどうかを返す スレッド数は変更しない"""
+        if not device or device == 'auto':
+            return not torch.cuda.is_available()
+        selected = torch.device(device)
+        return selected.type == 'cpu' or (selected.type == 'cuda' and not torch.cuda.is_available())
+
+    @staticmethod
+    def options_from_config(processing_config: dict) -> dict:
+        """設定の image_processing セクションから upscale_image に渡すオプションを読み込む"""
+        return {
+            'device': processing_config.get('upscaler_device', 'auto'),
+            'num_threads': processing_config.get('upscaler_threads', 0),
+            'tile_size': processing_config.get('upscaler_tile_size', Upscaler.TILE_SIZE),
+            'tile_overlap': processing_config.get('upscaler_tile_overlap', Upscaler.TILE_OVERLAP),
+            'batch_size': processing_config.get('upscaler_batch_size', Upscaler.BATCH_SIZE),
+        }
+
+    @staticmethod
+    def worker_options(options: dict, workers: int) -> dict:
+        """
+        ワーカープロセスに渡すオプションを作る CPU で推論する場合は、スレッド数をワーカー数で分割して使いすぎを防ぐ
+
+        Args:
+            options (dict): options_from_config で読み込んだオプション
+            workers (int): ワーカープロセス数
+
+        Returns:
+            dict: ワーカープロセスごとのオプション
+        """
+        options = dict(options)
+        if workers > 1 and Upscaler.runs_on_cpu(options.get('device', 'auto')):
+            threads = options.get('num_threads') or os.cpu_count() or 1
+            options['num_threads'] = max(1, threads // workers)
+        return options
 
     @classmethod
     def get_available_models(cls) -> list[str]:
         return list(cls.MODEL_PATHS.keys())
 
     @classmethod
-    def upscale_image(cls, img: Image.Image, model_name: str, scale: float = None) -> Image.Image:
-        upscaler = cls(model_name)
-        scale = scale or upscaler.recommended_scale
-        return upscaler._upscale(img, scale)
+    def upscale_image(cls, img: Image.Image, model_name: str, scale: float = None,
+                      device: str = 'auto', num_threads: int = 0, tile_size: int = TILE_SIZE,
+                      tile_overlap: int = TILE_OVERLAP, batch_size: int = BATCH_SIZE) -> Image.Image:
+        """
+        プロセス内で1回だけ読み込んだモデルで画像をアップスケールする
+
+        Args:
+            img (Image.Image): アップスケールする画像
+            model_name (str): MODEL_PATHS に登録したモデル名
+            scale (float): スケール倍率 None でモデルの推奨倍率
+            device (str): 推論に使うデバイス
+            num_threads (int): CPU で推論する場合のスレッド数 0でCPU数
+            tile_size (int): タイルごとに結果を使う領域の一辺 0で分割しない
+            tile_overlap (int): タイルの周囲に含める隣の領域の幅
+            batch_size (int): 1回の推論にまとめるタイル数
+
+        Returns:
+            Image.Image: アップスケールされた画像 失敗した場合は元の画像
+        """
+        upscaler = cls.get(model_name, device, num_threads)
+        return upscaler._upscale(img, scale or upscaler.recommended_scale, tile_size, tile_overlap, batch_size)
 
     def _load_model(self, model_path: Path) -> ImageModelDescriptor:
         model = ModelLoader().load_from_file(model_path)
@@ -381,37 +818,90 @@ class Upscaler:
             self.logger.error("読み込まれたモデルは ImageModelDescriptor のインスタンスではありません")
         return model
 
-    def _upscale(self, img: Image.Image, scale: float) -> Image.Image:
+    def _upscale(self, img: Image.Image, scale: float, tile_size: int = TILE_SIZE,
+                 tile_overlap: int = TILE_OVERLAP, batch_size: int = BATCH_SIZE) -> Image.Image:
         """
-        画像をアップスケールする
+        画像を同じ大きさのタイルに分割し、batch_size 枚ずつまとめて推論してアップスケールする
         Args:
             img (Image.Image): アップスケールする画像
             scale (float): スケール倍率
+            tile_size (int): タイルごとに結果を使う領域の一辺 0で分割しない
+            tile_overlap (int): タイルの周囲に含める隣の領域の幅
+            batch_size (int): 1回の推論にまとめるタイル数
         Returns:
             Image.Image: アップスケールされた画像
         """
         try:
-            img_tensor = self._convert_image_to_tensor(img)
-            with torch.no_grad():
-                output = self.model(img_tensor)
-            return self._convert_tensor_to_image(output, scale, img.size)
+            if self.model.tiling != ModelTiling.SUPPORTED:
+                # タイルに分割すると結果が変わるモデルは画像全体で推論する
+                tile_size = 0
+            model_scale = self.model.scale
+            array = np.asarray(img.convert('RGB'))
+            output = np.empty((array.shape[0] * model_scale, array.shape[1] * model_scale, 3), dtype=np.uint8)
+
+            (window_height, window_width), tiles = self._split_tiles(array.shape[0], array.shape[1],
+                                                                     tile_size, tile_overlap)
+            pad_width, pad_height = self.model.size_requirements.get_padding(window_width, window_height)
+            for start in range(0, len(tiles), max(1, batch_size)):
+                batch = tiles[start:start + max(1, batch_size)]
+                windows = np.stack([array[top:top + window_height, left:left + window_width]
+                                    for _, (top, left) in batch])
+                if pad_width or pad_height:
+                    windows = np.pad(windows, ((0, 0), (0, pad_height), (0, pad_width), (0, 0)), mode='edge')
+                results = self._infer(windows)
+                for ((y0, x0, y1, x1), (top, left)), result in zip(batch, results):
+                    # 周囲の重なりを除いた領域だけを書き込む
+                    output[y0 * model_scale:y1 * model_scale, x0 * model_scale:x1 * model_scale] = \
+                        result[(y0 - top) * model_scale:(y1 - top) * model_scale,
+                               (x0 - left) * model_scale:(x1 - left) * model_scale]
+                del windows, results
+
+            output_image = Image.fromarray(output)
+            expected_size = (int(img.width * scale), int(img.height * scale))
+            if output_image.size != expected_size:
+                output_image = output_image.resize(expected_size, Image.LANCZOS)
+            return output_image
         except Exception as e:
             self.logger.error(f"アップスケーリング中のエラー: {e}")
             return img
 
-    def _convert_image_to_tensor(self, image: Image.Image) -> torch.Tensor:
-        img_np = np.array(image).astype(np.float32) / 255.0
-        img_tensor = torch.from_numpy(img_np).permute(2, 0, 1).unsqueeze(0).cuda()
-        return img_tensor
-
-    def _convert_tensor_to_image(self, tensor: torch.Tensor, scale: float, original_size: tuple) -> Image.Image:
-        output_np = tensor.squeeze().cpu().numpy().transpose(1, 2, 0)
-        output_np = (output_np * 255).clip(0, 255).astype(np.uint8)
-        output_image = Image.fromarray(output_np)
-        expected_size = (int(original_size[0] * scale), int(original_size[1] * scale))
-        if output_image.size != expected_size:
-            output_image = output_image.resize(expected_size, Image.LANCZOS)
-        return output_image
+    @staticmethod
+    def _split_tiles(height: int, width: int, tile_size: int,
+                     tile_overlap: int) -> tuple[tuple[int, int], list[tuple[tuple[int, int, int, int], tuple[int, int]]]]:
+        """
+        画像を推論に使う同じ大きさのタイルに分割する
+        各タイルは結果を使う領域を tile_size ごとに区切り、周囲に tile_overlap だけ広げた窓を画像の内側に収まるようずらしたもの
+
+        Args:
+            height (int): 画像の高さ
+            width (int): 画像の幅
+            tile_size (int): タイルごとに結果を使う領域の一辺 0で分割しない
+            tile_overlap (int): タイルの周囲に含める隣の領域の幅
+
+        Returns:
+            tuple: ((窓の高さ, 窓の幅), [((y0, x0, y1, x1) 結果を使う領域, (top, left) 窓の左上), ...])
+        """
+        if tile_size <= 0 or (height <= tile_size and width <= tile_size):
+            return (height, width), [((0, 0, height, width), (0, 0))]
+        window_height = min(height, tile_size + 2 * tile_overlap)
+        window_width = min(width, tile_size + 2 * tile_overlap)
+        tiles = []
+        for y0 in range(0, height, tile_size):
+            y1 = min(y0 + tile_size, height)
+            top = min(max(y0 - tile_overlap, 0), height - window_height)
+            for x0 in range(0, width, tile_size):
+                x1 = min(x0 + tile_size, width)
+                left = min(max(x0 - tile_overlap, 0), width - window_width)
+                tiles.append(((y0, x0, y1, x1), (top, left)))
+        return (window_height, window_width), tiles
+
+    def _infer(self, windows: np.ndarray) -> np.ndarray:
+        """(N, H, W, 3) の uint8 配列を推論し、(N, H*scale, W*scale, 3) の uint8 配列を返す"""
+        tensor = torch.from_numpy(windows).to(self.device).permute(0, 3, 1, 2).float().div_(255.0)
+        with torch.inference_mode():
+            output = self.model(tensor)
+            output = output.mul_(255.0).clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1)
+            return output.cpu().numpy()
 
 if __name__ == '__main__':
     ##自動クロップのテスト
@@ -235,7 +235,8 @@ class ImageTaggerWidget(QWidget, Ui_ImageTaggerWidget):
 
     def save_to_db(self):
         fsm = FileSystemManager() # TODO: 暫定後で設計から見直す
-        fsm.initialize(Path(self.cm.config['directories']['output']), self.cm.config['image_processing']['target_resolution'])
+        fsm.initialize(Path(self.cm.config['directories']['output']), self.cm.config['image_processing']['target_resolution'],
+                       self.cm.config['image_processing'].get('original_store', 'dated'))
         for result in self.all_results:
             image_path = Path(result['image_path'])
             image_id = self.idm.detect_duplicate_image(image_path)
@@ -0,0 +1,573 @@
+"""
+Qt を使わずに画像の登録・処理・タグ付け・エクスポートを実行するバッチランナー
+- ImageBatchProcessor: 画像処理パイプライン (ImageEditWidget と共用)
+- BatchRunner: CLI から呼び出す各ステージ
+- main: コマンドライン引数の解析
+
+進捗は1行1JSONで標準出力に書き出し、ログは標準エラー出力とログファイルに出力する
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Optional, TextIO
+
+from module.config import get_config
+from module.log import setup_logger, get_logger
+from module.file_sys import FileSystemManager
+from module.db import ImageDatabaseManager
+from module.image_handle import ImageHandle
+from module.api_utils import APIClientFactory
+from caption_tags import ImageAnalyzer
+from ImageEditor import ImageProcessingManager, Upscaler, initialize_process_worker, process_image_in_worker
+
+class ImageBatchProcessor:
+    """画像をステージに分けたパイプラインで処理する
+
+    1. 重複チェック・オリジナル画像とアノテーションのDB登録 (呼び出し元スレッド)
+    2. クロップ・色空間変換・リサイズ (ProcessPoolExecutor)
+    3. 処理済み画像のWebP保存 (ThreadPoolExecutor)
+    4. 処理済み画像のDB登録 (呼び出し元スレッド)
+
+    同時に処理中にする画像数は max_pending_images で制限し、進捗は入力順に通知する
+    処理済み画像のDB登録は commit_every 枚ごとにまとめて短い transaction でコミットする
+    他のスレッドやプロセスが書き込めるよう、ハッシュの計算・デコード・クロップの完了待ちの間は書き込みロックを持たない
+    画像ごとに ImageHandle を1つ生成し、重複チェックのpHash計算でデコードした画像をクロップ・リサイズでも使う
+    """
+    def __init__(self, fsm: FileSystemManager, idm: ImageDatabaseManager, ipm: ImageProcessingManager,
+                 target_resolution: int, preferred_resolutions: list[tuple[int, int]], upscaler: str = None,
+                 process_workers: int = 0, io_workers: int = 4, max_pending_images: int = 32,
+                 commit_every: int = 50):
+        """
+        Args:
+            fsm (FileSystemManager): 初期化済みのファイルシステムマネージャ
+            idm (ImageDatabaseManager): 画像データベースマネージャ
+            ipm (ImageProcessingManager): 画像処理マネージャ (並列処理しない場合に使用)
+            target_resolution (int): 目標解像度
+            preferred_resolutions (list[tuple[int, int]]): 優先解像度リスト
+            upscaler (str): アップスケーラーの名前
+            process_workers (int): クロップ・リサイズを行うプロセス数 0でCPU数、1で並列処理しない
+            io_workers (int): 処理済み画像の保存を行うスレッド数
+            max_pending_images (int): 同時に処理中にする画像の上限
+            commit_every (int): DBへの書き込みをまとめてコミットする画像数
+        """
+        self.logger = get_logger("ImageBatchProcessor")
+        self.fsm = fsm
+        self.idm = idm
+        self.ipm = ipm
+        self.target_resolution = target_resolution
+        self.preferred_resolutions = preferred_resolutions
+        self.upscaler = upscaler
+        self.process_workers = process_workers or os.cpu_count() or 1
+        if upscaler and not Upscaler.runs_on_cpu(ipm.upscaler_options.get('device', 'auto')):
+            # GPU のメモリにワーカープロセスごとにモデルを読み込まないよう並列処理しない
+            # CPU の場合はワーカーごとにモデルを1回だけ読み込み、スレッド数をワーカー数で分割する
+            self.process_workers = 1
+        self.io_workers = max(1, io_workers)
+        self.max_pending_images = max(1, max_pending_images)
+        self.commit_every = max(1, commit_every)
+
+    @classmethod
+    def from_config(cls, config: dict, fsm: FileSystemManager, idm: ImageDatabaseManager,
+                    ipm: ImageProcessingManager, target_resolution: int, upscaler: str = None) -> 'ImageBatchProcessor':
+        """設定の image_processing セクションからワーカー数を、database セクションからコミット間隔を読み込んで生成する"""
+        processing_config = config['image_processing']
+        return cls(fsm, idm, ipm, target_resolution, config['preferred_resolutions'], upscaler=upscaler,
+                   process_workers=processing_config.get('process_workers', 0),
+                   io_workers=processing_config.get('io_workers', 4),
+                   max_pending_images=processing_config.get('max_pending_images', 32),
+                   commit_every=config.get('database', {}).get('commit_every', 50))
+
+    def process_images(self, image_files: list[Path], progress_callback: Optional[Callable[[int], None]] = None,
+                       status_callback: Optional[Callable[[str], None]] = None,
+                       is_canceled: Optional[Callable[[], bool]] = None) -> dict[str, int]:
+        """画像をまとめて処理する
+
+        Args:
+            image_files (list[Path]): 処理する画像ファイルのパスのリスト
+            progress_callback (Optional[Callable[[int], None]]): 進捗（0-100）を受け取るコールバック
+            status_callback (Optional[Callable[[str], None]]): ステータス文字列を受け取るコールバック
+            is_canceled (Optional[Callable[[], bool]]): キャンセルされたかを返すコールバック
+
+        Returns:
+            dict[str, int]: 'processed'（保存した枚数）, 'skipped'（保存済み・処理不要・失敗）, 'total'（完了した枚数）
+        """
+        total_images = len(image_files)
+        pending = deque()  # 入力順の処理中画像 {'image_file', 'image_id', 'stage', 'future'}
+        saved = []  # DBへの登録を待つ処理済み画像 (image_id, processed_path, processed_metadata, image_file)
+        summary = {'processed': 0, 'skipped': 0, 'total': 0}
+
+        def advance(block: bool) -> None:
+            """処理中の画像を次のステージへ進め、先頭から完了したものをDBに登録する"""
+            if block and pending and pending[0]['future'] is not None:
+                wait([pending[0]['future']])
+            for entry in pending:
+                if entry['stage'] == 'process' and entry['future'].done():
+                    processed_image = self._get_processed_image(entry['future'], entry['image_file'])
+                    if processed_image is None:
+                        entry['stage'], entry['future'] = 'done', None
+                    else:
+                        entry['stage'] = 'save'
+                        entry['future'] = io_pool.submit(self.save_processed_image, processed_image, entry['image_file'])
+            while pending and (pending[0]['stage'] == 'done'
+                               or (pending[0]['stage'] == 'save' and pending[0]['future'].done())):
+                entry = pending.popleft()
+                result = self._get_saved_image(entry['future'], entry['image_file']) if entry['stage'] == 'save' else None
+                if result:
+                    saved.append((entry['image_id'], *result, entry['image_file']))
+                    summary['processed'] += 1
+                else:
+                    summary['skipped'] += 1
+                summary['total'] += 1
+                if len(saved) >= self.commit_every:
+                    self._register_saved_images(saved)
+                if progress_callback:
+                    progress_callback(int(summary['total'] / total_images * 100))
+                if status_callback:
+                    status_callback(f"画像 {summary['total']}/{total_images} を処理中")
+
+        process_pool = None
+        if self.process_workers > 1:
+            process_pool = ProcessPoolExecutor(max_workers=self.process_workers,
+                                               initializer=initialize_process_worker,
+                                               initargs=(self.target_resolution, self.preferred_resolutions,
+                                                         self.ipm.autocrop_proxy_max_side,
+                                                         Upscaler.worker_options(self.ipm.upscaler_options,
+                                                                                 self.process_workers)))
+        io_pool = ThreadPoolExecutor(max_workers=self.io_workers)
+        try:
+            for image_file in image_files:
+                if is_canceled and is_canceled():
+                    self.logger.info("画像処理がキャンセルされました")
+                    for entry in pending:
+                        if entry['stage'] == 'process':
+                            entry['future'].cancel()
+                    break
+                entry = {'image_file': image_file, 'image_id': None, 'stage': 'done', 'future': None}
+                with ImageHandle(image_file) as handle:
+                    prepared = self.prepare_image(image_file, handle)
+                    if prepared:
+                        image_id, original_image_metadata = prepared
+                        entry.update({
+                            'image_id': image_id,
+                            'stage': 'process',
+                            'future': self._submit_processing(process_pool, handle,
+                                                              original_image_metadata['has_alpha'],
+                                                              original_image_metadata['mode'])
+                        })
+                pending.append(entry)
+                advance(block=False)
+                while len(pending) >= self.max_pending_images:
+                    advance(block=True)
+            while pending:
+                advance(block=True)
+        finally:
+            # 例外で中断した場合も保存済みの画像は登録する
+            self._register_saved_images(saved)
+            if process_pool:
+                process_pool.shutdown(cancel_futures=True)
+            io_pool.shutdown()
+        return summary
+
+    def prepare_image(self, image_file: Path, handle: Optional[ImageHandle] = None) -> Optional[tuple[int, dict]]:
+        """オリジナル画像とアノテーションをDBに登録し、処理が必要な画像の情報を返す
+
+        Args:
+            image_file (Path): 処理する画像ファイルのパス
+            handle (Optional[ImageHandle]): image_file を開いたハンドル。重複チェックと登録で画像情報とpHashを共有する
+
+        Returns:
+            Optional[tuple[int, dict]]: (image_id, original_image_metadata)。指定解像度の画像が保存済みの場合はNone
+        """
+        # 重複チェック、アノテーションの読み込み、オリジナル画像のコピーは書き込みロックを取る前に済ませる
+        image_id = self.idm.detect_duplicate_image(image_file, handle)
+        existing_annotations = ImageAnalyzer.get_existing_annotations(image_file)
+        if image_id:
+            original_image_metadata = self.idm.get_image_metadata(image_id)
+        else:
+            stored = self.idm.store_original_image(image_file, self.fsm, handle)
+            if stored is None:
+                self.logger.warning(f"オリジナル画像を保存できないためスキップします: {image_file}")
+                return None
+            image_id, original_image_metadata = stored
+        new_stored_path = None if image_id else Path(original_image_metadata['stored_image_path'])
+        # オリジナル画像とアノテーションの登録を1つの単位にし、失敗したら両方取り消す
+        try:
+            with self.idm.transaction():
+                if not image_id:
+                    image_id = self.idm.add_stored_original_image(image_file, original_image_metadata)
+                if existing_annotations:
+                    self.idm.save_annotations(image_id, existing_annotations)
+                else:
+                    self.idm.save_annotations(image_id, {'tags': [], 'captions': []})
+        except Exception:
+            if new_stored_path is not None:
+                new_stored_path.unlink(missing_ok=True)
+            raise
+
+        existing_processed_image = self.idm.check_processed_image_exists(image_id, self.target_resolution)
+        if existing_processed_image:
+            self.logger.info(f"指定解像度の画像は保存済みです: {image_file}")
+            return None
+        return image_id, original_image_metadata
+
+    def save_processed_image(self, processed_image, image_file: Path) -> tuple[Path, dict]:
+        """処理済み画像を保存してメタデータを取得する。保存用スレッドからも呼び出される"""
+        processed_path = self.fsm.save_processed_image(processed_image, image_file)
+        processed_metadata = self.fsm.get_image_info(processed_path)
+        return processed_path, processed_metadata
+
+    def _submit_processing(self, process_pool: Optional[ProcessPoolExecutor], handle: ImageHandle,
+                           has_alpha: bool, mode: str) -> Future:
+        """画像処理をワーカープロセスに投入する。プールがない場合はこのスレッドでデコード済みの画像を使って処理する
+
+        ワーカープロセスには画素を送らず、ワーカーが縮小してデコードし直す
+        """
+        if process_pool:
+            return process_pool.submit(process_image_in_worker, handle, has_alpha, mode, self.upscaler)
+        future = Future()
+        try:
+            future.set_result(self.ipm.process_image(handle, has_alpha, mode, upscaler=self.upscaler))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _get_processed_image(self, future: Future, image_file: Path):
+        """画像処理の結果を取り出す。失敗・キャンセル・処理不要の場合はNone"""
+        if future.cancelled():
+            return None
+        try:
+            processed_image = future.result()
+        except Exception as e:
+            self.logger.error(f"画像処理中にエラーが発生しました: {image_file}: {str(e)}")
+            return None
+        if not processed_image:
+            self.logger.warning(f"画像処理スキップ: {image_file}")
+            return None
+        return processed_image
+
+    def _get_saved_image(self, future: Future, image_file: Path) -> Optional[tuple[Path, dict]]:
+        """処理済み画像の保存結果 (processed_path, processed_metadata) を取り出す。失敗した場合はNone"""
+        try:
+            return future.result()
+        except Exception as e:
+            self.logger.error(f"処理済み画像の保存中にエラーが発生しました: {image_file}: {str(e)}")
+            return None
+
+    def _register_saved_images(self, saved: list[tuple[int, Path, dict, Path]]) -> None:
+        """保存済みの処理済み画像を1つの transaction でDBに登録し、リストを空にする"""
+        if not saved:
+            return
+        with self.idm.transaction():
+            for image_id, processed_path, processed_metadata, image_file in saved:
+                self.idm.register_processed_image(image_id, processed_path, processed_metadata)
+                self.logger.info(f"画像処理完了: {image_file} -> {processed_path}")
+        saved.clear()
+
+class JsonProgressReporter:
+    """ステージの進捗を1行1JSONで出力する"""
+    def __init__(self, stage: str, total: int, stream: TextIO = None):
+        self.stage = stage
+        self.total = total
+        self.stream = stream or sys.stdout
+        self.start_time = time.perf_counter()
+        self.last_progress = None
+
+    def emit(self, event: str, **fields: Any) -> None:
+        record = {'stage': self.stage, 'event': event, 'elapsed': round(time.perf_counter() - self.start_time, 3)}
+        record.update(fields)
+        self.stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.stream.flush()
+
+    def progress(self, value: int) -> None:
+        """progress_callback として渡す。同じ値は出力しない"""
+        if value != self.last_progress:
+            self.last_progress = value
+            self.emit('progress', progress=value, total=self.total)
+
+    def status(self, message: str) -> None:
+        """status_callback として渡す"""
+        self.emit('status', message=message)
+
+    def done(self, **summary: Any) -> dict[str, Any]:
+        elapsed = time.perf_counter() - self.start_time
+        summary.setdefault('total', self.total)
+        summary['images_per_sec'] = round(summary['total'] / elapsed, 3) if elapsed > 0 else None
+        self.emit('done', **summary)
+        return summary
+
+class BatchRunner:
+    """CLI から画像の登録・処理・タグ付け・エクスポートを実行する"""
+    EXPORT_PAGE_SIZE = 200
+    def __init__(self, config: dict, stream: TextIO = None):
+        """
+        Args:
+            config (dict): get_config で読み込んだ設定
+            stream (TextIO): 進捗JSONの出力先。デフォルトは標準出力
+        """
+        self.logger = get_logger("BatchRunner")
+        self.config = config
+        self.stream = stream
+        self.target_resolution = config['image_processing']['target_resolution']
+        self.fsm = FileSystemManager()
+        self.fsm.initialize(Path(config['directories']['output']), self.target_resolution,
+                            config['image_processing'].get('original_store', 'dated'))
+        db_dir = Path(config['directories']['database'])
+        db_dir.mkdir(parents=True, exist_ok=True)
+        self.idm = ImageDatabaseManager(db_dir, phash_threshold=config['image_processing']['phash_threshold'],
+                                        nsfw_keywords=config['filter']['nsfw_keywords'],
+                                        db_settings=config['database'])
+
+    @staticmethod
+    def collect_image_paths(inputs: list[Path], shard: Optional[tuple[int, int]] = None) -> list[Path]:
+        """入力パスから画像ファイルを集め、指定されたシャードに属するものだけを返す
+
+        Args:
+            inputs (list[Path]): 画像ファイルまたはディレクトリのパス
+            shard (Optional[tuple[int, int]]): (index, count)。ソート済みリストの index 番目から count 個おきに取り出す
+
+        Returns:
+            list[Path]: ソート済みの画像ファイルのパスのリスト
+        """
+        image_paths = set()
+        for input_path in inputs:
+            if input_path.is_dir():
+                image_paths.update(FileSystemManager.get_image_files(input_path))
+            elif input_path.suffix.lower() in FileSystemManager.image_extensions:
+                image_paths.add(input_path)
+        image_paths = sorted(image_paths)
+        if shard:
+            index, count = shard
+            image_paths = image_paths[index::count]
+        return image_paths
+
+    def _reporter(self, stage: str, total: int) -> JsonProgressReporter:
+        return JsonProgressReporter(stage, total, self.stream)
+
+    def ingest(self, image_paths: list[Path]) -> dict[str, Any]:
+        """オリジナル画像と既存のアノテーションをDBに登録する"""
+        reporter = self._reporter('ingest', len(image_paths))
+        max_workers = self.config['image_processing'].get('process_workers', 0) or None
+        results = self.idm.register_original_images(image_paths, self.fsm, progress_callback=reporter.progress,
+                                                    max_workers=max_workers)
+        registered_images = [(image_path, result[0]) for image_path, result in zip(image_paths, results)
+                             if result is not None]
+        commit_every = max(1, self.config['database'].get('commit_every', 50))
+        for start in range(0, len(registered_images), commit_every):
+            # アノテーションのファイルは書き込みロックを取る前に読み込み、commit_every 枚ずつ短い transaction で登録する
+            annotations = [(image_id, ImageAnalyzer.get_existing_annotations(image_path))
+                           for image_path, image_id in registered_images[start:start + commit_every]]
+            with self.idm.transaction():
+                for image_id, existing_annotations in annotations:
+                    if existing_annotations:
+                        self.idm.save_annotations(image_id, existing_annotations)
+        registered = len(registered_images)
+        return reporter.done(registered=registered, failed=len(image_paths) - registered)
+
+    def process(self, image_paths: list[Path], upscaler: str = None) -> dict[str, Any]:
+        """画像を登録し、目標解像度にクロップ・リサイズして保存する"""
+        reporter = self._reporter('process', len(image_paths))
+        ipm = ImageProcessingManager(self.fsm, self.target_resolution, self.config['preferred_resolutions'],
+                                     self.config['image_processing'].get('autocrop_proxy_max_side', 0),
+                                     Upscaler.options_from_config(self.config['image_processing']))
+        processor = ImageBatchProcessor.from_config(self.config, self.fsm, self.idm, ipm,
+                                                    self.target_resolution, upscaler=upscaler)
+        summary = processor.process_images(image_paths, progress_callback=reporter.progress)
+        return reporter.done(**summary)
+
+    def tag(self, image_paths: list[Path], model_name: str, format_name: str = "danbooru",
+            use_low_res: bool = False) -> dict[str, Any]:
+        """Vision モデルでタグとキャプションを生成してDBに保存する"""
+        vision_models, score_models, _ = self.idm.get_models()
+        model_id = next((model_id for model_id, model in vision_models.items() if model['name'] == model_name), None)
+        if model_id is None:
+            raise ValueError(f"Vision モデル '{model_name}' が見つかりません。")
+        acf = APIClientFactory(self.config['api'])
+        acf.initialize(self.config['prompts']['main'], self.config['prompts']['additional'])
+        ia = ImageAnalyzer()
+        ia.initialize(acf, (vision_models, score_models))
+
+        reporter = self._reporter('tag', len(image_paths))
+        tagged, failed = 0, 0
+        for index, image_path in enumerate(image_paths):
+            image_id = self.idm.detect_duplicate_image(image_path)
+            if image_id is None:
+                image_id, _ = self.idm.register_original_image(image_path, self.fsm)
+            analyze_path = image_path
+            if use_low_res:
+                low_res_path = self.idm.get_low_res_image(image_id)
+                if low_res_path:
+                    analyze_path = Path(low_res_path)
+            result = ia.analyze_image(analyze_path, model_id, format_name)
+            if 'error' in result:
+                failed += 1
+            else:
+                self.idm.save_annotations(image_id, result)
+                tagged += 1
+            reporter.progress(int((index + 1) / len(image_paths) * 100))
+        return reporter.done(tagged=tagged, failed=failed)
+
+    def export(self, export_dir: Path, tags: list[str] = None, caption: str = None, resolution: int = 0,
+               use_and: bool = True, include_untagged: bool = False, include_nsfw: bool = False,
+               latest: bool = False, to_txt: bool = True, to_json: bool = False,
+               shard: Optional[tuple[int, int]] = None) -> dict[str, Any]:
+        """条件に一致する画像とアノテーションを学習用データセットとして出力する
+
+        検索結果は EXPORT_PAGE_SIZE 件ずつ image_id 順に取得する。シャードは image_id で分担する。
+        画像はページごとに io_workers 個のスレッドでまとめてコピーする
+        """
+        export_dir.mkdir(parents=True, exist_ok=True)
+        io_workers = self.config['image_processing'].get('io_workers', 4)
+        reporter = None
+        exported, seen, after_id = 0, 0, None
+        copy_stats = {'copied': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0}
+        while True:
+            images, total = self.idm.get_images_by_filter(tags=tags, caption=caption, resolution=resolution,
+                                                          use_and=use_and, include_untagged=include_untagged,
+                                                          include_nsfw=include_nsfw, limit=self.EXPORT_PAGE_SIZE,
+                                                          after_id=after_id)
+            if reporter is None:
+                reporter = self._reporter('export', total)
+            if not images:
+                break
+            page_ids = [image['image_id'] for image in images
+                        if not shard or image['image_id'] % shard[1] == shard[0]]
+            annotations_by_id = self.idm.get_annotations_for_images(page_ids)
+            copies = []
+            for image in images:
+                seen += 1
+                if image['image_id'] not in annotations_by_id:
+                    continue
+                annotations = annotations_by_id[image['image_id']]
+                if latest:
+                    annotations = self.idm.filter_recent_annotations(annotations)
+                image_data = {
+                    'path': Path(image['stored_image_path']),
+                    'tags': annotations.get('tags', []),
+                    'captions': annotations.get('captions', [])
+                }
+                if to_txt:
+                    self.fsm.export_dataset_to_txt(image_data, export_dir, copy_image=False)
+                if to_json:
+                    self.fsm.export_dataset_to_json(image_data, export_dir, copy_image=False)
+                if to_txt or to_json:
+                    copies.append((image_data['path'], export_dir / image_data['path'].name))
+                exported += 1
+            page_stats = self.fsm.copy_files(copies, max_workers=io_workers)
+            for key in copy_stats:
+                copy_stats[key] += page_stats[key]
+            reporter.progress(int(seen / reporter.total * 100))
+            after_id = images[-1]['image_id']
+        seconds = copy_stats['seconds']
+        return reporter.done(exported=exported, copied=copy_stats['copied'], copy_failed=copy_stats['failed'],
+                             copied_bytes=copy_stats['bytes'],
+                             copy_bytes_per_sec=round(copy_stats['bytes'] / seconds) if seconds > 0 else None)
+
+    def hash(self) -> dict[str, Any]:
+        """content_hash のない登録済み画像のSHA-256を保存済みのファイルから計算する"""
+        reporter = self._reporter('hash', self.idm.count_images_without_content_hash())
+        max_workers = self.config['image_processing'].get('io_workers', 4)
+        summary = self.idm.fill_content_hashes(progress_callback=reporter.progress, max_workers=max_workers)
+        return reporter.done(**summary)
+
+    def explain(self) -> dict[str, Any]:
+        """検索で使うSQLのクエリプランを出力し、インデックスを使わない全件スキャンの数を返す"""
+        plans = self.idm.explain_query_plans()
+        reporter = self._reporter('explain', len(plans))
+        for plan in plans:
+            reporter.emit('plan', **plan)
+        return reporter.done(full_scans=sum(len(plan['full_scans']) for plan in plans))
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """'index/count' 形式のシャード指定を解析する"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"シャードは 'index/count' の形式で指定してください: {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"シャードの指定が不正です: {value}")
+    return index, count
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli", description="画像データセットのバッチ処理 (GUIなし)")
+    parser.add_argument('--config', default='processing.toml', help="設定ファイルのパス")
+    parser.add_argument('--shard', type=parse_shard, help="複数マシンで分担する場合の担当分 (例: 0/4)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help="オリジナル画像をDBに登録する")
+    ingest.add_argument('inputs', nargs='+', type=Path, help="画像ファイルまたはディレクトリ")
+
+    process = subparsers.add_parser('process', help="画像を登録し目標解像度に加工して保存する")
+    process.add_argument('inputs', nargs='+', type=Path, help="画像ファイルまたはディレクトリ")
+    process.add_argument('--resolution', type=int, help="目標解像度 (設定ファイルの値を上書き)")
+    process.add_argument('--upscaler', help="長辺が目標解像度未満の画像に使うアップスケーラー")
+    process.add_argument('--workers', type=int, help="クロップ・リサイズを行うプロセス数")
+
+    tag = subparsers.add_parser('tag', help="Vision モデルでタグとキャプションを生成する")
+    tag.add_argument('inputs', nargs='+', type=Path, help="画像ファイルまたはディレクトリ")
+    tag.add_argument('--model', required=True, help="Vision モデル名 (例: gpt-4o)")
+    tag.add_argument('--format', default="danbooru", choices=["danbooru", "e621", "derpibooru"], help="タグの形式")
+    tag.add_argument('--low-res', action='store_true', help="DBに登録済みの低解像度画像を使う")
+
+    export = subparsers.add_parser('export', help="学習用データセットを出力する")
+    export.add_argument('output', type=Path, help="出力先ディレクトリ")
+    export.add_argument('--tags', help="カンマ区切りの検索タグ")
+    export.add_argument('--caption', help="検索キャプション")
+    export.add_argument('--resolution', type=int, default=0, help="処理済み画像の解像度 0でオリジナル画像")
+    export.add_argument('--or', dest='use_and', action='store_false', help="タグをOR条件で検索する")
+    export.add_argument('--untagged', action='store_true', help="タグが付いていない画像を出力する")
+    export.add_argument('--nsfw', action='store_true', help="NSFW画像を含める")
+    export.add_argument('--latest', action='store_true', help="最新のアノテーションのみを出力する")
+    export.add_argument('--json', action='store_true', help="meta_data.json を出力する")
+    export.add_argument('--no-txt', dest='txt', action='store_false', help=".txt/.caption を出力しない")
+
+    subparsers.add_parser('hash', help="content_hash のない登録済み画像のSHA-256を計算する")
+    subparsers.add_parser('explain', help="検索クエリのプランを出力し、全件スキャンを報告する")
+    return parser
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    config = get_config(args.config)
+    setup_logger(config['log'])
+    logger = get_logger("batch_runner")
+
+    if args.command == 'process':
+        if args.resolution:
+            config['image_processing']['target_resolution'] = args.resolution
+        if args.workers is not None:
+            config['image_processing']['process_workers'] = args.workers
+
+    try:
+        runner = BatchRunner(config)
+        if args.command == 'export':
+            tags = [tag.strip() for tag in args.tags.split(',')] if args.tags else []
+            runner.export(args.output, tags=tags, caption=args.caption, resolution=args.resolution,
+                          use_and=args.use_and, include_untagged=args.untagged, include_nsfw=args.nsfw,
+                          latest=args.latest, to_txt=args.txt, to_json=args.json, shard=args.shard)
+            return 0
+        if args.command == 'explain':
+            runner.explain()
+            return 0
+        if args.command == 'hash':
+            runner.hash()
+            return 0
+
+        image_paths = BatchRunner.collect_image_paths(args.inputs, args.shard)
+        if args.command == 'ingest':
+            runner.ingest(image_paths)
+        elif args.command == 'process':
+            runner.process(image_paths, upscaler=args.upscaler)
+        elif args.command == 'tag':
+            runner.tag(image_paths, args.model, format_name=args.format, use_low_res=args.low_res)
+        return 0
+    except Exception as e:
+        logger.error(f"{args.command} の実行中にエラーが発生しました: {e}")
+        JsonProgressReporter(args.command, 0).emit('error', message=str(e))
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -47,7 +47,10 @@ class MainWindow(QMainWindow, Ui_mainWindow):
         self.init_statusbar()
 
     def init_managers(self):
-        self.idm = ImageDatabaseManager(Path(self.cm.config['directories']['database']))
+        self.idm = ImageDatabaseManager(Path(self.cm.config['directories']['database']),
+                                        phash_threshold=self.cm.config['image_processing']['phash_threshold'],
+                                        nsfw_keywords=self.cm.config['filter']['nsfw_keywords'],
+                                        db_settings=self.cm.config['database'])
         self.fsm = FileSystemManager()
         self.progress_widget = ProgressWidget()
         self.progress_controller = Controller(self.progress_widget)
@@ -15,13 +15,27 @@ DEFAULT_CONFIG = {
     'image_processing': {
         'target_resolution': 1024,
         'realesrganer_upscale': False,
-        'realesrgan_model': "RealESRGAN_x4plus_anime_6B.pth"
+        'realesrgan_model': "RealESRGAN_x4plus_anime_6B.pth",
+        'phash_threshold': 5,
+        'process_workers': 0,
+        'io_workers': 4,
+        'max_pending_images': 32,
+        'original_store': 'dated',
+        'autocrop_proxy_max_side': 1024,
+        'upscaler_device': 'auto',
+        'upscaler_threads': 0,
+        'upscaler_tile_size': 512,
+        'upscaler_tile_overlap': 16,
+        'upscaler_batch_size': 4
     },
     'generation': {
         'batch_jsonl': False,
         'start_batch': False,
         'single_image': True
     },
+    'filter': {
+        'nsfw_keywords': ['nsfw', 'explicit', 'sex', 'pussy', 'nude', 'penis', 'cum', 'bdsm']
+    },
     'options': {
         'generate_meta_clean': False,
         'cleanup_existing_tags': False,
@@ -37,6 +51,14 @@ DEFAULT_CONFIG = {
         (1024, 1024), (1216, 832), (832, 1216)
     ],
     'image_database': 'image_database.db',
+    'database': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size_mb': 64,
+        'mmap_size_mb': 256,
+        'busy_timeout_ms': 5000,
+        'commit_every': 50
+    },
     'log': {
         'level': 'INFO',
         'file': 'app.log'
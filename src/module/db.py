@@ -2,31 +2,302 @@ import sqlite3
 import threading
 import traceback
 import uuid
-import imagehash
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import inspect
+import json
+import re
+import numpy as np
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from PIL import Image
 
+from collections import OrderedDict
 from contextlib import contextmanager
-from typing import Any, Union, Optional
+from typing import Any, Callable, Iterable, Iterator, Union, Optional
 from datetime import datetime
 from module.log import get_logger
+from module.config import DEFAULT_CONFIG
 from pathlib import Path
 
 from module.file_sys import FileSystemManager
+from module.image_handle import ImageHandle
+from module.records import ImageRecord, ProcessedImageRecord, TagRecord, CaptionRecord, ScoreRecord
 
 def calculate_phash(image_path: str) -> str:
-    with Image.open(image_path) as img:
-        return str(imagehash.phash(img))
+    with ImageHandle(image_path) as handle:
+        return handle.phash
+
+def extract_original_image_info(image_path: Path, sha256: Optional[str] = None,
+                                handle: Optional[ImageHandle] = None) -> Optional[dict[str, Any]]:
+    """
+    register_original_images のワーカープロセスで実行する
+    画像の基本情報とpHashを1回開いた画像からまとめて取得する
+
+    Args:
+        image_path (Path): 画像ファイルのパス
+        sha256 (Optional[str]): 計算済みのSHA-256。None の場合は計算する
+        handle (Optional[ImageHandle]): 呼び出し元で開いた画像。None の場合はこの関数内で開いて閉じる
+
+    Returns:
+        Optional[dict[str, Any]]: FileSystemManager.get_image_info の結果に 'phash' と 'sha256' を加えた辞書。失敗時は None
+    """
+    try:
+        if handle is None:
+            with ImageHandle(image_path) as own_handle:
+                info = {**own_handle.info, 'phash': own_handle.phash}
+        else:
+            info = {**handle.info, 'phash': handle.phash}
+        info['sha256'] = sha256 or FileSystemManager.calculate_sha256(image_path)
+        return info
+    except Exception as e:
+        get_logger("ImageDatabaseManager").error(f"画像情報の取得中にエラーが発生しました: {image_path}: {e}")
+        return None
+
+def file_fingerprint_key(image_path: Path) -> Optional[tuple[str, int, int]]:
+    """
+    file_fingerprints の照合に使う (絶対パス, ファイルサイズ, 更新日時ns) を stat だけで求める
+
+    Returns:
+        Optional[tuple[str, int, int]]: ファイルが存在しない場合は None
+    """
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    return os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns
+
+def phash_to_int(phash: str) -> Optional[int]:
+    """16進数表記のpHashを64bit整数に変換する 変換できない場合はNone"""
+    try:
+        return int(phash, 16)
+    except (TypeError, ValueError):
+        return None
+
+def phash_to_sqlite_int(phash: str) -> Optional[int]:
+    """
+    16進数表記のpHashを images.phash_int に保存する符号付き64bit整数に変換する
+    SQLiteのINTEGERは符号付きのため、上位ビットが立っている値は負数として保存する
+    """
+    value = phash_to_int(phash)
+    if value is None or value >= 1 << 64:
+        return None
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _popcount64(values: np.ndarray) -> np.ndarray:
+    """uint64配列の各要素の立っているビット数を数える"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def nearest_phashes(queries: np.ndarray, db_hashes: np.ndarray, db_ids: np.ndarray,
+                    threshold: int, chunk_elements: int = 1 << 22) -> list[Optional[int]]:
+    """
+    複数のpHashについて、DB内のpHashとのハミング距離をまとめて計算し最も近い画像IDを返す
+
+    Args:
+        queries (np.ndarray): 検索するpHashのuint64配列
+        db_hashes (np.ndarray): DB内のpHashのuint64配列
+        db_ids (np.ndarray): db_hashes に対応する画像IDの配列（昇順）
+        threshold (int): 許容するハミング距離
+        chunk_elements (int): 一度に計算する距離行列の要素数の上限
+
+    Returns:
+        list[Optional[int]]: queries と同じ順序の画像IDのリスト。しきい値以内の画像がない場合はNone
+    """
+    results: list[Optional[int]] = [None] * len(queries)
+    if len(queries) == 0 or len(db_hashes) == 0:
+        return results
+    chunk_size = max(1, chunk_elements // len(db_hashes))
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        distances = _popcount64(chunk[:, None] ^ db_hashes[None, :])
+        # 距離が同じ場合は argmin が先頭（IDが最小）の画像を選ぶ
+        nearest = distances.argmin(axis=1)
+        nearest_distances = distances[np.arange(len(chunk)), nearest]
+        for offset, (index, distance) in enumerate(zip(nearest, nearest_distances)):
+            if distance <= threshold:
+                results[start + offset] = int(db_ids[index])
+    return results
+
+class PHashIndex:
+    """
+    pHashのハミング距離で近傍検索を行うBK-tree。
+    images テーブルから一度だけ構築し、画像の追加・削除に合わせて差分更新する。
+
+    ノードは [pHash(int), image_idのリスト, {距離: 子ノード}] のリストで表現する。
+    削除はノードからimage_idを外すだけで木の形は変えない。
+    """
+    def __init__(self):
+        self._root = None
+        self._nodes: dict[int, list] = {}  # pHash(int) -> ノード
+        self._id_to_hash: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._id_to_hash)
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        return (a ^ b).bit_count()
+
+    def add(self, image_id: int, phash: int) -> None:
+        with self._lock:
+            if image_id in self._id_to_hash:
+                self._remove(image_id)
+            self._id_to_hash[image_id] = phash
+            node = self._nodes.get(phash)
+            if node is not None:
+                node[1].append(image_id)
+                return
+            new_node = [phash, [image_id], {}]
+            self._nodes[phash] = new_node
+            if self._root is None:
+                self._root = new_node
+                return
+            node = self._root
+            while True:
+                dist = self.distance(phash, node[0])
+                child = node[2].get(dist)
+                if child is None:
+                    node[2][dist] = new_node
+                    return
+                node = child
+
+    def remove(self, image_id: int) -> None:
+        with self._lock:
+            self._remove(image_id)
+
+    def _remove(self, image_id: int) -> None:
+        phash = self._id_to_hash.pop(image_id, None)
+        if phash is None:
+            return
+        node = self._nodes[phash]
+        node[1].remove(image_id)
+
+    def search(self, phash: int, threshold: int) -> list[tuple[int, int]]:
+        """
+        しきい値以内の画像を検索する
+
+        Args:
+            phash (int): 検索するpHash
+            threshold (int): 許容するハミング距離
+
+        Returns:
+            list[tuple[int, int]]: (距離, image_id) のリスト
+        """
+        results = []
+        with self._lock:
+            if self._root is None:
+                return results
+            stack = [self._root]
+            while stack:
+                node = stack.pop()
+                dist = self.distance(phash, node[0])
+                if dist <= threshold:
+                    results.extend((dist, image_id) for image_id in node[1])
+                # 三角不等式により |dist - threshold| の範囲の子だけを探索する
+                low, high = dist - threshold, dist + threshold
+                stack.extend(child for d, child in node[2].items() if low <= d <= high)
+        return results
+
+    def nearest(self, phash: int, threshold: int) -> Optional[tuple[int, int]]:
+        """しきい値以内で最も距離が近い (距離, image_id) を返す 見つからない場合はNone"""
+        results = self.search(phash, threshold)
+        return min(results) if results else None
+
+class TagIdCache:
+    """
+    タグ文字列から tag_db のtag_idを引くためのLRUキャッシュ。
+    tag_db に存在しないタグも None としてキャッシュする。
+    """
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, Optional[int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, tag: str) -> Any:
+        """キャッシュされたtag_idを返す キャッシュにない場合は TagIdCache._MISSING"""
+        with self._lock:
+            tag_id = self._data.get(tag, self._MISSING)
+            if tag_id is self._MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(tag)
+            return tag_id
+
+    def put(self, tag: str, tag_id: Optional[int]) -> None:
+        with self._lock:
+            self._data[tag] = tag_id
+            self._data.move_to_end(tag)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """ヒット数・ミス数・キャッシュ件数を返す"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
 
 class SQLiteManager:
-    def __init__(self, img_db_path: Path, tag_db_path: Path):
+    # 接続ごとに設定するPRAGMAの初期値 設定ファイルの [database] で上書きする
+    DEFAULT_SETTINGS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size_mb': 64,
+        'mmap_size_mb': 256,
+        'busy_timeout_ms': 5000,
+    }
+    BEGIN_RETRIES = 5  # BEGIN IMMEDIATE が他の接続の書き込みで SQLITE_BUSY になった場合の試行回数
+    # スキーマのマイグレーション (バージョン, 説明, メソッド名)。PRAGMA user_version に適用済みのバージョンを記録する
+    # 変更する場合は既存のマイグレーションを書き換えず、末尾に新しいバージョンを追加する
+    MIGRATIONS: list[tuple[int, str, str]] = [
+        (1, "images に整数のpHash phash_int を追加", '_migration_phash_int'),
+        (2, "tags / captions の全文検索テーブルを作成", '_migration_fts'),
+        (3, "image_flags テーブルを作成", '_migration_image_flags'),
+        (4, "検索用の複合インデックスを作成", '_migration_filter_indexes'),
+        (5, "processed_images に長辺と面積の生成カラムを追加", '_migration_processed_size_columns'),
+        (6, "file_fingerprints テーブルを作成", '_migration_file_fingerprints'),
+        (7, "images に内容のハッシュ content_hash を追加", '_migration_content_hash'),
+    ]
+    # マイグレーション後に既存の行を埋めるバックフィル (名前: (テーブル, メソッド名))
+    BACKFILLS: dict[str, tuple[str, str]] = {
+        'phash_int': ('images', '_backfill_phash_int'),
+        'tags_fts': ('tags', '_backfill_tags_fts'),
+        'captions_fts': ('captions', '_backfill_captions_fts'),
+        'content_hash': ('images', '_backfill_content_hash'),
+    }
+
+    def __init__(self, img_db_path: Path, tag_db_path: Path, settings: Optional[dict[str, Any]] = None):
+        """
+        Args:
+            img_db_path (Path): 画像データベースのパス
+            tag_db_path (Path): アタッチするタグデータベースのパス
+            settings (Optional[dict[str, Any]]): DEFAULT_SETTINGS を上書きする設定
+        """
         self.logger = get_logger("SQLiteManager")
         self.img_db_path = img_db_path
         self.tag_db_path = tag_db_path
+        self.settings = {**self.DEFAULT_SETTINGS, **(settings or {})}
         self._connection = None
         self._local = threading.local()
+        self._fts_enabled = None
+        # transaction がロールバックされたときに呼び出す関数 (メモリ上のキャッシュの破棄など)
+        self.rollback_callbacks: list[Callable[[], None]] = []
 
     @staticmethod
     def dict_factory(cursor, row):
@@ -35,12 +306,25 @@ class SQLiteManager:
             d[col[0]] = row[idx]
         return d
 
+    def _open_connection(self) -> sqlite3.Connection:
+        """PRAGMAを設定し、タグデータベースをアタッチした接続を作成する"""
+        settings = self.settings
+        conn = sqlite3.connect(self.img_db_path, check_same_thread=False,
+                               timeout=settings['busy_timeout_ms'] / 1000)
+        conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout_ms'])}")
+        conn.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+        conn.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+        # 負の値はKiB単位の指定になる
+        conn.execute(f"PRAGMA cache_size = {-int(settings['cache_size_mb'] * 1024)}")
+        conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size_mb'] * 1024 * 1024)}")
+        conn.execute(f"ATTACH DATABASE '{self.tag_db_path}' AS tag_db")
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.row_factory = self.dict_factory
+        return conn
+
     def connect(self):
         if not hasattr(self._local, 'connection') or self._local.connection is None:
-            self._local.connection = sqlite3.connect(self.img_db_path, check_same_thread=False)
-            self._local.connection.execute(f"ATTACH DATABASE '{self.tag_db_path}' AS tag_db")
-            self._local.connection.execute("PRAGMA foreign_keys = ON")
-            self._local.connection.row_factory = self.dict_factory
+            self._local.connection = self._open_connection()
         return self._local.connection
 
     def close(self):
@@ -48,9 +332,107 @@ class SQLiteManager:
             self._local.connection.close()
             self._local.connection = None
 
+    def _begin_immediate(self, conn: sqlite3.Connection) -> None:
+        """
+        BEGIN IMMEDIATE で書き込みロックを取得する。
+        他の接続が書き込み中で busy_timeout を過ぎても SQLITE_BUSY になった場合は、間隔を空けて BEGIN_RETRIES 回まで試す
+        """
+        for attempt in range(self.BEGIN_RETRIES):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                busy = getattr(e, 'sqlite_errorcode', None) == sqlite3.SQLITE_BUSY or 'locked' in str(e)
+                if not busy or attempt == self.BEGIN_RETRIES - 1:
+                    raise
+                self.logger.warning(f"データベースが他の接続に書き込みロックされています。再試行します ({attempt + 1}/{self.BEGIN_RETRIES})")
+                time.sleep(min(0.05 * 2 ** attempt, 1.0))
+
+    @property
+    def in_transaction(self) -> bool:
+        """このスレッドで transaction を実行中か"""
+        return getattr(self._local, 'transaction_depth', 0) > 0
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        ブロック内のこのスレッドの書き込みを1回のコミットにまとめる。
+        入れ子にした場合は SAVEPOINT になり、内側の例外はその範囲だけを取り消す。
+
+        Yields:
+            sqlite3.Connection: このスレッドの接続
+        """
+        conn = self.connect()
+        depth = getattr(self._local, 'transaction_depth', 0)
+        savepoint = f"sp_{depth}"
+        if depth == 0:
+            if conn.in_transaction:
+                conn.commit()
+            self._begin_immediate(conn)
+        else:
+            conn.execute(f"SAVEPOINT {savepoint}")
+        self._local.transaction_depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            if depth == 0:
+                conn.rollback()
+            else:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                conn.execute(f"RELEASE {savepoint}")
+            for callback in self.rollback_callbacks:
+                callback()
+            raise
+        else:
+            if depth == 0:
+                conn.commit()
+            else:
+                conn.execute(f"RELEASE {savepoint}")
+        finally:
+            self._local.transaction_depth = depth
+
+    @contextmanager
+    def batch_transaction(self, commit_every: int = 100) -> Iterator[Callable[[], None]]:
+        """
+        大量の処理を commit_every 件ごとにコミットする transaction。
+        例外が起きた場合はコミットしていない分だけを取り消す。
+
+        Args:
+            commit_every (int): コミットする間隔 (checkpoint の呼び出し回数)
+
+        Yields:
+            Callable[[], None]: 1件の処理が終わるたびに呼び出す checkpoint 関数
+        """
+        state = {'context': None, 'count': 0}
+
+        def begin():
+            state['context'] = self.transaction()
+            state['context'].__enter__()
+
+        def checkpoint():
+            state['count'] += 1
+            if state['count'] % max(1, commit_every) == 0:
+                context, state['context'] = state['context'], None
+                context.__exit__(None, None, None)
+                begin()
+
+        begin()
+        try:
+            yield checkpoint
+        except BaseException as e:
+            if state['context'] is not None:
+                state['context'].__exit__(type(e), e, e.__traceback__)
+            raise
+        else:
+            state['context'].__exit__(None, None, None)
+
     @contextmanager
     def get_connection(self):
         conn = self.connect()
+        if self.in_transaction:
+            # コミット・ロールバックは transaction に任せる
+            yield conn
+            return
         try:
             yield conn
         except Exception as e:
@@ -72,19 +454,61 @@ class SQLiteManager:
             cursor.executemany(query, params)
             return cursor
 
-    def fetch_one(self, query: str, params: tuple[Any, ...] = ()) -> Optional[tuple[Any, ...]]:
+    def fetch_one(self, query: str, params: tuple[Any, ...] = (),
+                  record_type: Optional[type] = None) -> Optional[tuple[Any, ...]]:
+        """record_type (module.records.Record のサブクラス) を指定した場合は辞書の代わりにレコードを返す"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            if record_type is not None:
+                cursor.row_factory = record_type
             cursor.execute(query, params)
             return cursor.fetchone()
 
-    def fetch_all(self, query: str, params: tuple[Any, ...] = ()) -> list[tuple[Any, ...]]:
+    def fetch_all(self, query: str, params: tuple[Any, ...] = (),
+                  record_type: Optional[type] = None) -> list[tuple[Any, ...]]:
+        """record_type (module.records.Record のサブクラス) を指定した場合は辞書の代わりにレコードを返す"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            if record_type is not None:
+                cursor.row_factory = record_type
             cursor.execute(query, params)
             return cursor.fetchall()
 
-    def create_tables(self):
+    def explain_query_plan(self, query: str, params: tuple[Any, ...] = ()) -> list[str]:
+        """
+        EXPLAIN QUERY PLAN の各行の説明を返す
+
+        Args:
+            query (str): 調べるSQL文
+            params (tuple[Any, ...]): SQL文のパラメータ
+
+        Returns:
+            list[str]: 'SEARCH t USING INDEX ...' などの説明のリスト
+        """
+        rows = self.fetch_all(f"EXPLAIN QUERY PLAN {query}", params)
+        return [row['detail'] for row in rows]
+
+    @property
+    def fts_enabled(self) -> bool:
+        """tags / captions の全文検索用 FTS5 テーブルが使えるか"""
+        if self._fts_enabled is None:
+            row = self.fetch_one("SELECT COUNT(*) AS count FROM sqlite_master WHERE name IN ('tags_fts', 'captions_fts')")
+            self._fts_enabled = row['count'] == 2
+        return self._fts_enabled
+
+    @property
+    def schema_version(self) -> int:
+        """適用済みのマイグレーションのバージョン (PRAGMA user_version)"""
+        return self.fetch_one("PRAGMA user_version")['user_version']
+
+    def create_tables(self, progress_callback: Optional[Callable[[str, int, int], None]] = None):
+        """
+        最初のバージョンのテーブルを作成し、migrate で最新のスキーマにする
+
+        Args:
+            progress_callback (Optional[Callable[[str, int, int], None]]): migrate に渡す進捗のコールバック
+        """
+        self._fts_enabled = None
         with self.get_connection() as conn:
             conn.executescript('''
                 -- images テーブル：オリジナル画像の情報を格納
@@ -177,6 +601,13 @@ class SQLiteManager:
                     UNIQUE (image_id, score, model_id)
                 );
 
+                -- db_settings テーブル：マイグレーションの進捗やフラグの計算に使った設定値などを格納
+                CREATE TABLE IF NOT EXISTS db_settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+
             -- インデックスの作成
             CREATE INDEX IF NOT EXISTS idx_images_uuid ON images(uuid);
             CREATE INDEX IF NOT EXISTS idx_images_phash ON images(phash);
@@ -185,113 +616,279 @@ class SQLiteManager:
             CREATE INDEX IF NOT EXISTS idx_captions_image_id ON captions(image_id);
             CREATE INDEX IF NOT EXISTS idx_scores_image_id ON scores(image_id);
             ''')
+        self.migrate(progress_callback)
 
-    # def migrate_tables(self):
-    #     """既存のテーブルに不足しているカラムを追加し、必要に応じてテーブルを再作成する"""
-    #     with self.get_connection() as conn:
-    #         cursor = conn.cursor()
-    #         # テーブルごとの新しい定義
-    #         table_definitions = {
-    #             'tags': [
-    #                 ('id', 'INTEGER PRIMARY KEY'),
-    #                 ('tag_id', 'INTEGER'),
-    #                 ('image_id', 'INTEGER'),
-    #                 ('model_id', 'INTEGER'),
-    #                 ('tag', 'TEXT NOT NULL'),
-    #                 ('existing', 'BOOLEAN NOT NULL DEFAULT 0'),
-    #                 ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-    #                 ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-    #                 ('FOREIGN KEY(image_id)', 'REFERENCES images(id) ON DELETE CASCADE'),
-    #                 ('FOREIGN KEY(model_id)', 'REFERENCES models(id) ON DELETE SET NULL'),
-    #                 ('UNIQUE(image_id, tag, tag_id, model_id)', '')
-    #             ],
-    #             # 他のテーブルも同様に定義
-    #             'captions': [
-    #                 ('id', 'INTEGER PRIMARY KEY'),
-    #                 ('image_id', 'INTEGER'),
-    #                 ('model_id', 'INTEGER'),
-    #                 ('caption', 'TEXT NOT NULL'),
-    #                 ('existing', 'BOOLEAN NOT NULL DEFAULT 0'),
-    #                 ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-    #                 ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-    #                 ('FOREIGN KEY(image_id)', 'REFERENCES images(id) ON DELETE CASCADE'),
-    #                 ('FOREIGN KEY(model_id)', 'REFERENCES models(id) ON DELETE SET NULL'),
-    #                 ('UNIQUE(image_id, caption, model_id)', '')
-    #             ],
-    #             'scores': [
-    #                 ('id', 'INTEGER PRIMARY KEY'),
-    #                 ('image_id', 'INTEGER'),
-    #                 ('model_id', 'INTEGER'),
-    #                 ('score', 'FLOAT NOT NULL'),
-    #                 ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-    #                 ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-    #                 ('FOREIGN KEY(image_id)', 'REFERENCES images(id) ON DELETE CASCADE'),
-    #                 ('FOREIGN KEY(model_id)', 'REFERENCES models(id) ON DELETE SET NULL'),
-    #                 ('UNIQUE(image_id, score, model_id)', '')
-    #             ]
-    #         }
-
-    #         for table_name, columns in table_definitions.items():
-    #             # 既存テーブルのカラムを取得
-    #             cursor.execute(f"PRAGMA table_info({table_name});")
-    #             existing_columns_info = cursor.fetchall()
-    #             existing_column_names = {col['name'] for col in existing_columns_info}
-
-    #             # 必要なカラムがすべて存在するか確認
-    #             required_columns = [col[0] for col in columns if not col[0].startswith('FOREIGN KEY') and not col[0].startswith('UNIQUE')]
-    #             missing_columns = set(required_columns) - existing_column_names
-
-    #             # カラムが不足している場合、テーブルを再作成
-    #             if missing_columns or self.need_to_recreate_table(table_name, columns, existing_columns_info):
-    #                 self.logger.info(f"テーブル '{table_name}' を再作成します。")
-    #                 self.recreate_table(conn, table_name, columns)
-    #             else:
-    #                 self.logger.info(f"テーブル '{table_name}' は再作成の必要がありません。")
-
-    # def need_to_recreate_table(self, table_name, columns, existing_columns_info):
-    #     """テーブルの再作成が必要かどうかを判断する"""
-    #     # FOREIGN KEY や UNIQUE 制約の変更が必要かどうかをチェックする
-    #     # この例では簡略化のため、常に False を返す
-    #     # 必要に応じて実装を追加する
-    #     return True  # 常に再作成する
-
-    # def recreate_table(self, conn, table_name, columns):
-    #     """テーブルを再作成してデータを移行する"""
-    #     cursor = conn.cursor()
-
-    #     # 一時テーブル名を生成
-    #     temp_table_name = f"{table_name}_backup"
-
-    #     # テーブルをリネーム（バックアップ）
-    #     cursor.execute(f"ALTER TABLE {table_name} RENAME TO {temp_table_name};")
-    #     self.logger.info(f"テーブル '{table_name}' を '{temp_table_name}' にリネームしました。")
-
-    #     # 新しいテーブルを作成
-    #     columns_definitions = []
-    #     for col_name, col_def in columns:
-    #         if col_def:  # 制約や FOREIGN KEY も含む
-    #             columns_definitions.append(f"{col_name} {col_def}")
-    #         else:
-    #             columns_definitions.append(f"{col_name}")
-
-    #     create_table_sql = f"CREATE TABLE {table_name} (\n" + ",\n".join(columns_definitions) + "\n);"
-    #     cursor.execute(create_table_sql)
-    #     self.logger.info(f"テーブル '{table_name}' を新しい定義で作成しました。")
-
-    #     # データを移行
-    #     old_columns = [col['name'] for col in cursor.execute(f"PRAGMA table_info({temp_table_name});")]
-    #     new_columns = [col[0] for col in columns if not col[0].startswith('FOREIGN KEY') and not col[0].startswith('UNIQUE')]
-    #     common_columns = set(old_columns) & set(new_columns)
-    #     common_columns_str = ", ".join(common_columns)
-
-    #     cursor.execute(f"INSERT INTO {table_name} ({common_columns_str}) SELECT {common_columns_str} FROM {temp_table_name};")
-    #     self.logger.info(f"データを '{temp_table_name}' から '{table_name}' に移行しました。")
-
-    #     # 一時テーブルを削除
-    #     cursor.execute(f"DROP TABLE {temp_table_name};")
-    #     self.logger.info(f"一時テーブル '{temp_table_name}' を削除しました。")
-
-    #     conn.commit()
+    def migrate(self, progress_callback: Optional[Callable[[str, int, int], None]] = None,
+                batch_size: int = 10000) -> int:
+        """
+        未適用のマイグレーションを番号順に実行する
+
+        各マイグレーションのスキーマ変更と PRAGMA user_version の更新は1つのトランザクションで行い、
+        既存の行を埋めるバックフィルは batch_size 行ずつコミットしながら進める。
+        中断された場合は、次回の実行時に db_settings に記録した位置からバックフィルを再開する。
+        今の環境では適用できず保留したマイグレーション (_defer_migration) は、実行のたびに再試行する
+
+        Args:
+            progress_callback (Optional[Callable[[str, int, int], None]]): (説明, 処理済みの行数, 全体の行数) を受け取るコールバック
+            batch_size (int): バックフィルで1回にコミットする行数
+
+        Returns:
+            int: 適用後のバージョン
+        """
+        # 保留したマイグレーションを再試行し、前回中断したバックフィルを先に終わらせる
+        self._retry_deferred_migrations()
+        self._run_backfills(progress_callback, batch_size)
+        current_version = self.schema_version
+        for version, description, method in self.MIGRATIONS:
+            if version <= current_version:
+                continue
+            try:
+                with self.transaction() as conn:
+                    getattr(self, method)(conn)
+                    conn.execute(f"PRAGMA user_version = {version}")
+            except sqlite3.Error as e:
+                self.logger.error(f"マイグレーション {version} ({description}) に失敗しました: {e}")
+                raise
+            self.logger.info(f"マイグレーション {version}: {description}")
+            self._run_backfills(progress_callback, batch_size)
+            current_version = version
+        self._fts_enabled = None
+        return current_version
+
+    def _defer_migration(self, conn: sqlite3.Connection, method: str) -> None:
+        """
+        SQLite のバージョンなど今の環境が原因で適用できなかったマイグレーションを db_settings に記録する。
+        user_version は進めるが、次回以降の migrate で適用できるまで再試行する
+
+        Args:
+            conn (sqlite3.Connection): マイグレーション中の接続
+            method (str): マイグレーションのメソッド名
+        """
+        conn.execute("""
+            INSERT INTO db_settings (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        """, (f"deferred_migration:{method}", sqlite3.sqlite_version))
+
+    def _retry_deferred_migrations(self) -> None:
+        """_defer_migration で保留したマイグレーションを再実行する。また適用できなければメソッドが記録し直す"""
+        deferred = self.fetch_all("SELECT key FROM db_settings WHERE key LIKE 'deferred_migration:%' ORDER BY rowid")
+        for row in deferred:
+            method = row['key'].split(':', 1)[1]
+            try:
+                with self.transaction() as conn:
+                    conn.execute("DELETE FROM db_settings WHERE key = ?", (row['key'],))
+                    getattr(self, method)(conn)
+                    applied = conn.execute("SELECT 1 FROM db_settings WHERE key = ?", (row['key'],)).fetchone() is None
+            except sqlite3.Error as e:
+                self.logger.error(f"保留したマイグレーション {method} の再実行に失敗しました: {e}")
+                raise
+            if applied:
+                self.logger.info(f"保留したマイグレーション {method} を適用しました")
+        if deferred:
+            self._fts_enabled = None
+
+    def _schedule_backfill(self, conn: sqlite3.Connection, name: str) -> None:
+        """
+        バックフィルを予約する。マイグレーションと同じトランザクションで呼び出し、
+        この時点で存在する行だけを対象にする（以降の行はトリガーや登録処理で埋められる）
+
+        Args:
+            conn (sqlite3.Connection): マイグレーション中の接続
+            name (str): BACKFILLS のキー
+        """
+        table, _ = self.BACKFILLS[name]
+        end_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) AS end_id FROM {table}").fetchone()['end_id']
+        conn.execute("""
+            INSERT INTO db_settings (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        """, (f"backfill:{name}", json.dumps({'last_id': 0, 'end_id': end_id})))
+
+    def _run_backfills(self, progress_callback: Optional[Callable[[str, int, int], None]], batch_size: int) -> None:
+        """
+        予約されたバックフィルを id 順に batch_size 行ずつ実行する。
+        行の処理と進捗 (last_id) の記録を同じトランザクションでコミットするので、中断しても続きから再開できる
+        """
+        pending = self.fetch_all("SELECT key, value FROM db_settings WHERE key LIKE 'backfill:%' ORDER BY rowid")
+        for row in pending:
+            name = row['key'].split(':', 1)[1]
+            table, method = self.BACKFILLS[name]
+            state = json.loads(row['value'])
+            total = self.fetch_one(f"SELECT COUNT(*) AS count FROM {table} WHERE id <= ?",
+                                   (state['end_id'],))['count']
+            done = self.fetch_one(f"SELECT COUNT(*) AS count FROM {table} WHERE id <= ?",
+                                  (state['last_id'],))['count']
+            try:
+                while True:
+                    with self.transaction() as conn:
+                        ids = conn.execute(f"SELECT id FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                                           (state['last_id'], state['end_id'], batch_size)).fetchall()
+                        if not ids:
+                            conn.execute("DELETE FROM db_settings WHERE key = ?", (row['key'],))
+                            break
+                        getattr(self, method)(conn, ids[0]['id'], ids[-1]['id'])
+                        state['last_id'] = ids[-1]['id']
+                        conn.execute("UPDATE db_settings SET value = ?, updated_at = CURRENT_TIMESTAMP WHERE key = ?",
+                                     (json.dumps(state), row['key']))
+                    done += len(ids)
+                    self.logger.info(f"バックフィル {name}: {done}/{total}")
+                    if progress_callback:
+                        progress_callback(name, done, total)
+            except sqlite3.Error as e:
+                self.logger.error(f"バックフィル {name} に失敗しました: {e}")
+                raise
+
+    def _migration_phash_int(self, conn: sqlite3.Connection) -> None:
+        """images テーブルに整数のpHashカラム phash_int を追加し、既存の16進数pHashの変換を予約する"""
+        columns = {col['name'] for col in conn.execute("PRAGMA table_info(images)").fetchall()}
+        if 'phash_int' not in columns:
+            conn.execute("ALTER TABLE images ADD COLUMN phash_int INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_images_phash_int ON images(phash_int)")
+        self._schedule_backfill(conn, 'phash_int')
+
+    def _backfill_phash_int(self, conn: sqlite3.Connection, first_id: int, last_id: int) -> None:
+        rows = conn.execute(
+            "SELECT id, phash FROM images WHERE id BETWEEN ? AND ? AND phash_int IS NULL AND phash IS NOT NULL",
+            (first_id, last_id)
+        ).fetchall()
+        data = [(phash_to_sqlite_int(row['phash']), row['id']) for row in rows]
+        data = [(value, image_id) for value, image_id in data if value is not None]
+        conn.executemany("UPDATE images SET phash_int = ? WHERE id = ?", data)
+
+    def _migration_fts(self, conn: sqlite3.Connection) -> None:
+        """
+        tags / captions の部分一致検索用に trigram トークナイザの FTS5 テーブルを作成する
+        元テーブルを参照する external content テーブルとし、トリガーで同期する。既存の行の索引はバックフィルで作る
+        trigram トークナイザが使えない場合は保留し、SQLite を更新した後の migrate で作成する
+        """
+        if sqlite3.sqlite_version_info < (3, 34, 0):
+            self.logger.warning(f"SQLite {sqlite3.sqlite_version} は trigram トークナイザに対応していないため、全文検索は使用しません")
+            self._defer_migration(conn, '_migration_fts')
+            return
+        for table, column in (('tags', 'tag'), ('captions', 'caption')):
+            fts_table = f"{table}_fts"
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts_table,)).fetchone()
+            try:
+                conn.execute("SAVEPOINT create_fts")
+                conn.execute(f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table}
+                    USING fts5({column}, content='{table}', content_rowid='id', tokenize='trigram')
+                """)
+                conn.execute("RELEASE create_fts")
+            except sqlite3.OperationalError as e:
+                conn.execute("ROLLBACK TO create_fts")
+                conn.execute("RELEASE create_fts")
+                self.logger.warning(f"FTS5 テーブル {fts_table} を作成できないため、全文検索は使用しません: {e}")
+                self._defer_migration(conn, '_migration_fts')
+                return
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+                END
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                END
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {column} ON {table} BEGIN
+                    INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                    INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+                END
+            """)
+            if not exists:
+                # トリガーを作成した時点の行までを索引に追加する
+                self._schedule_backfill(conn, fts_table)
+
+    def _backfill_tags_fts(self, conn: sqlite3.Connection, first_id: int, last_id: int) -> None:
+        conn.execute("INSERT INTO tags_fts(rowid, tag) SELECT id, tag FROM tags WHERE id BETWEEN ? AND ?",
+                     (first_id, last_id))
+
+    def _backfill_captions_fts(self, conn: sqlite3.Connection, first_id: int, last_id: int) -> None:
+        conn.execute("INSERT INTO captions_fts(rowid, caption) SELECT id, caption FROM captions WHERE id BETWEEN ? AND ?",
+                     (first_id, last_id))
+
+    def _migration_image_flags(self, conn: sqlite3.Connection) -> None:
+        """アノテーションから求めた画像ごとのフラグとタグの一覧を格納する image_flags テーブルを作成する"""
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_flags (
+                image_id INTEGER PRIMARY KEY,
+                nsfw BOOLEAN NOT NULL DEFAULT 0,
+                tag_set TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (image_id) REFERENCES images(id) ON DELETE CASCADE
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_image_flags_nsfw ON image_flags(nsfw)")
+
+    def _migration_filter_indexes(self, conn: sqlite3.Connection) -> None:
+        """
+        検索条件に合わせた複合インデックスを作成する
+        processed_images(image_id, width, height) は UNIQUE 制約の自動インデックスで足りるので作成しない
+        """
+        # タグの完全一致・更新日時の範囲検索と、部分一致検索のカバリングインデックス
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tags_tag_updated_at ON tags(tag, updated_at, image_id)")
+        # キャプション検索の EXISTS (image_id と更新日時)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_captions_image_id_updated_at ON captions(image_id, updated_at)")
+        # ファイル名による重複チェック
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_images_filename ON images(filename)")
+        # 新しいインデックスの統計情報をクエリプランナーに反映する
+        conn.execute("PRAGMA optimize")
+
+    def _migration_processed_size_columns(self, conn: sqlite3.Connection) -> None:
+        """
+        解像度による処理済み画像の選択をSQLで行うため、長辺 long_side と面積 area の生成カラムとインデックスを追加する
+        VIRTUAL の生成カラムは読み出し時に計算されるので、既存の行を埋める必要はない
+        """
+        columns = {col['name'] for col in conn.execute("PRAGMA table_xinfo(processed_images)").fetchall()}
+        if 'long_side' not in columns:
+            conn.execute("ALTER TABLE processed_images ADD COLUMN long_side INTEGER "
+                         "GENERATED ALWAYS AS (MAX(width, height)) VIRTUAL")
+        if 'area' not in columns:
+            conn.execute("ALTER TABLE processed_images ADD COLUMN area INTEGER "
+                         "GENERATED ALWAYS AS (width * height) VIRTUAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_images_size ON processed_images(image_id, long_side, area)")
+
+    def _migration_file_fingerprints(self, conn: sqlite3.Connection) -> None:
+        """
+        取り込み元ファイルのpHash・SHA-256・画像情報を、パス・サイズ・更新日時と合わせて記録する file_fingerprints テーブルを作成する
+        サイズと更新日時が変わっていなければ、画像をデコードせずに記録を使う
+        """
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_fingerprints (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                phash TEXT,
+                sha256 TEXT,
+                info TEXT,
+                image_id INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (image_id) REFERENCES images(id) ON DELETE SET NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_file_fingerprints_image_id ON file_fingerprints(image_id)")
+
+    def _migration_content_hash(self, conn: sqlite3.Connection) -> None:
+        """
+        内容が完全に一致する画像をデコードせずに判定するため、images に SHA-256 の content_hash カラムを追加する
+        既存の画像は file_fingerprints に記録したハッシュから埋める。起動を遅らせないよう、ここではファイルを読まない
+        記録のない画像は ImageDatabaseManager.fill_content_hashes (CLI の hash) で保存済みのファイルから計算し、
+        それまでは pHash による判定のみとする
+        """
+        columns = {col['name'] for col in conn.execute("PRAGMA table_info(images)").fetchall()}
+        if 'content_hash' not in columns:
+            conn.execute("ALTER TABLE images ADD COLUMN content_hash TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images(content_hash)")
+        self._schedule_backfill(conn, 'content_hash')
+
+    def _backfill_content_hash(self, conn: sqlite3.Connection, first_id: int, last_id: int) -> None:
+        conn.execute("""
+            UPDATE images SET content_hash = (
+                SELECT f.sha256 FROM file_fingerprints f WHERE f.image_id = images.id AND f.sha256 IS NOT NULL LIMIT 1
+            )
+            WHERE id BETWEEN ? AND ? AND content_hash IS NULL
+        """, (first_id, last_id))
 
     def insert_models(self) -> None:
         """
@@ -328,15 +925,58 @@ class ImageRepository:
     画像関連のデータベース操作を担当するクラス。
     このクラスは、画像メタデータの保存、取得、アノテーションの管理などを行います。
     """
-    def __init__(self, db_manager: SQLiteManager):
+    # タグかキャプションに含まれていたらNSFWとみなすキーワードの初期値 (設定の [filter] nsfw_keywords の初期値と共通)
+    NSFW_KEYWORDS = DEFAULT_CONFIG['filter']['nsfw_keywords']
+    # file_fingerprints に記録する FileSystemManager.get_image_info の項目
+    FINGERPRINT_INFO_KEYS = ('width', 'height', 'format', 'mode', 'has_alpha', 'filename', 'extension',
+                             'color_space', 'icc_profile')
+
+    def __init__(self, db_manager: SQLiteManager, phash_threshold: int = 5, nsfw_keywords: Optional[list[str]] = None):
         """
         ImageRepositoryクラスのコンストラクタ。
 
         Args:
             db_manager (SQLiteManager): データベース接続を管理するオブジェクト。
+            phash_threshold (int): 類似画像とみなすpHashのハミング距離。小さいほど厳密な一致を要求します。
+            nsfw_keywords (Optional[list[str]]): NSFWとみなすキーワード。Noneの場合は NSFW_KEYWORDS。
         """
         self.logger = get_logger("ImageRepository")
         self.db_manager = db_manager
+        self.phash_threshold = phash_threshold
+        self.nsfw_keywords = list(self.NSFW_KEYWORDS if nsfw_keywords is None else nsfw_keywords)
+        self._phash_index: Optional[PHashIndex] = None
+        self._phash_index_lock = threading.Lock()
+        # ロールバックされた画像がインデックスに残らないよう作り直す
+        self.db_manager.rollback_callbacks.append(self._reset_phash_index)
+        self.tag_id_cache = TagIdCache()
+
+    def _get_phash_index(self) -> PHashIndex:
+        """pHashインデックスを取得する 未構築の場合は images テーブルから構築"""
+        with self._phash_index_lock:
+            if self._phash_index is None:
+                index = PHashIndex()
+                rows = self.db_manager.fetch_all("SELECT id, phash_int FROM images WHERE phash_int IS NOT NULL")
+                for row in rows:
+                    index.add(row['id'], row['phash_int'] & 0xFFFFFFFFFFFFFFFF)
+                self.logger.info(f"pHashインデックスを構築しました: {len(index)} 件")
+                self._phash_index = index
+            return self._phash_index
+
+    def _reset_phash_index(self) -> None:
+        """pHashインデックスを破棄し、次回の検索時に images テーブルから構築し直す"""
+        with self._phash_index_lock:
+            self._phash_index = None
+
+    def _update_phash_index(self, image_id: int, phash: Optional[str]) -> None:
+        """構築済みのpHashインデックスに画像を反映する 未構築の場合は次回の検索時にDBから構築される"""
+        index = self._phash_index
+        if index is None:
+            return
+        phash_int = phash_to_int(phash)
+        if phash_int is None:
+            index.remove(image_id)
+        else:
+            index.add(image_id, phash_int)
 
     def add_original_image(self, info: dict[str, Any]) -> int:
         """
@@ -353,9 +993,16 @@ class ImageRepository:
             sqlite3.Error: データベース操作でエラーが発生した場合。
         """
 
+        # 内容が完全に一致する画像は pHash を計算せずに重複とする
+        if info.get('sha256'):
+            duplicate = self.find_images_by_content_hash([info['sha256']]).get(info['sha256'])
+            if duplicate:
+                self.logger.warning(f"同じ内容の画像が既に存在します: ID {duplicate}")
+                return duplicate
+
         # pHashの計算と重複チェック
         try:
-            phash = calculate_phash(Path(info['stored_image_path']))
+            phash = info.get('phash') or calculate_phash(Path(info['stored_image_path']))
             info['phash'] = phash
             duplicate = self.find_duplicate_image(phash)
             if duplicate:
@@ -373,8 +1020,9 @@ class ImageRepository:
 
         query = """
         INSERT INTO images (uuid, stored_image_path, width, height, format, mode, has_alpha,
-                            filename, extension, color_space, icc_profile, phash, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            filename, extension, color_space, icc_profile, phash, phash_int, content_hash,
+                            created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
         try:
             created_at = datetime.now().isoformat()
@@ -392,16 +1040,223 @@ class ImageRepository:
                 info['color_space'],
                 info['icc_profile'],
                 info['phash'],
+                phash_to_sqlite_int(info['phash']),
+                info.get('sha256'),
                 created_at,
                 updated_at
             )
             cursor = self.db_manager.execute(query, params)
+            image_id = cursor.lastrowid
+            self._update_phash_index(image_id, info['phash'])
             self.logger.info(f"オリジナル画像をDBに追加しました: UUID={info['uuid']}")
-            return cursor.lastrowid
+            return image_id
         except sqlite3.Error as e:
             self.logger.error(f"オリジナル画像の追加中にエラーが発生しました: {e}")
             raise
 
+    def add_original_images(self, infos: list[dict[str, Any]]) -> list[int]:
+        """
+        複数のオリジナル画像のメタデータを1回の executemany で images テーブルに追加します。
+        pHashは各 info に計算済みであること。重複チェックは呼び出し側で行います。
+
+        Args:
+            infos (list[dict[str, Any]]): 画像情報を含む辞書のリスト。
+
+        Returns:
+            list[int]: infos と同じ順序の挿入された画像のID。
+
+        Raises:
+            ValueError: 必須情報が不足している場合。
+            sqlite3.Error: データベース操作でエラーが発生した場合。
+        """
+        if not infos:
+            return []
+        required_keys = ['uuid', 'stored_image_path', 'width', 'height', 'format', 'mode',
+                         'has_alpha', 'filename', 'extension', 'color_space', 'icc_profile', 'phash']
+        for info in infos:
+            missing_keys = [key for key in required_keys if key not in info]
+            if missing_keys:
+                raise ValueError(f"必須情報が不足しています: {', '.join(missing_keys)}")
+
+        query = """
+        INSERT INTO images (uuid, stored_image_path, width, height, format, mode, has_alpha,
+                            filename, extension, color_space, icc_profile, phash, phash_int, content_hash,
+                            created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        created_at = datetime.now().isoformat()
+        params = [(
+            info['uuid'], info['stored_image_path'], info['width'], info['height'], info['format'],
+            info['mode'], info['has_alpha'], info['filename'], info['extension'], info['color_space'],
+            info['icc_profile'], info['phash'], phash_to_sqlite_int(info['phash']), info.get('sha256'),
+            created_at, created_at
+        ) for info in infos]
+        try:
+            self.db_manager.executemany(query, params)
+            # executemany では lastrowid が取れないため uuid から ID を引き直す
+            uuid_to_id = {}
+            uuids = [info['uuid'] for info in infos]
+            for start in range(0, len(uuids), 500):
+                chunk = uuids[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.db_manager.fetch_all(f"SELECT id, uuid FROM images WHERE uuid IN ({placeholders})", tuple(chunk))
+                uuid_to_id.update({row['uuid']: row['id'] for row in rows})
+            image_ids = [uuid_to_id[info['uuid']] for info in infos]
+            for image_id, info in zip(image_ids, infos):
+                self._update_phash_index(image_id, info['phash'])
+            self.logger.info(f"オリジナル画像を {len(image_ids)} 件DBに追加しました")
+            return image_ids
+        except sqlite3.Error as e:
+            self.logger.error(f"オリジナル画像の一括追加中にエラーが発生しました: {e}")
+            raise
+
+    def get_images_metadata(self, image_ids: list[int]) -> dict[int, dict[str, Any]]:
+        """
+        複数の画像メタデータをまとめて取得します。
+
+        Args:
+            image_ids (list[int]): 取得する画像のIDのリスト。
+
+        Returns:
+            dict[int, dict[str, Any]]: image_id をキーとする画像メタデータの辞書。見つからないIDは含まれない。
+        """
+        metadata = {}
+        unique_ids = list(dict.fromkeys(image_ids))
+        for start in range(0, len(unique_ids), 500):
+            chunk = unique_ids[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self.db_manager.fetch_all(f"SELECT * FROM images WHERE id IN ({placeholders})", tuple(chunk),
+                                             record_type=ImageRecord)
+            metadata.update({row['id']: row for row in rows})
+        return metadata
+
+    def find_images_by_content_hash(self, content_hashes: list[str]) -> dict[str, int]:
+        """
+        内容のSHA-256が一致する登録済み画像をまとめて検索します。
+
+        Args:
+            content_hashes (list[str]): 16進数表記のSHA-256のリスト。
+
+        Returns:
+            dict[str, int]: SHA-256 -> image_id。見つからないハッシュは含みません。
+        """
+        hashes = [content_hash for content_hash in dict.fromkeys(content_hashes) if content_hash]
+        found = {}
+        try:
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.db_manager.fetch_all(
+                    f"SELECT content_hash, MIN(id) AS id FROM images WHERE content_hash IN ({placeholders}) GROUP BY content_hash",
+                    tuple(chunk))
+                found.update({row['content_hash']: row['id'] for row in rows})
+            return found
+        except sqlite3.Error as e:
+            self.logger.error(f"内容のハッシュによる画像の検索中にエラーが発生しました: {e}")
+            raise
+
+    def count_images_without_content_hash(self) -> int:
+        """content_hash が未設定の画像の数を返します。"""
+        try:
+            return self.db_manager.fetch_one("SELECT COUNT(*) AS count FROM images WHERE content_hash IS NULL")['count']
+        except sqlite3.Error as e:
+            self.logger.error(f"content_hash が未設定の画像の数の取得中にエラーが発生しました: {e}")
+            raise
+
+    def get_images_without_content_hash(self, after_id: int = 0, limit: int = 500) -> list[sqlite3.Row]:
+        """
+        content_hash が未設定の画像の id と stored_image_path を id 順に取得します。
+
+        Args:
+            after_id (int): この ID より後の画像を取得する。
+            limit (int): 取得する最大件数。
+
+        Returns:
+            list[sqlite3.Row]: 'id', 'stored_image_path' を持つ行のリスト。
+        """
+        try:
+            return self.db_manager.fetch_all(
+                "SELECT id, stored_image_path FROM images WHERE content_hash IS NULL AND id > ? ORDER BY id LIMIT ?",
+                (after_id, limit))
+        except sqlite3.Error as e:
+            self.logger.error(f"content_hash が未設定の画像の取得中にエラーが発生しました: {e}")
+            raise
+
+    def update_content_hashes(self, hashes: list[tuple[str, int]]) -> None:
+        """
+        画像の content_hash をまとめて設定します。
+
+        Args:
+            hashes (list[tuple[str, int]]): (16進数表記のSHA-256, image_id) のリスト。
+        """
+        try:
+            self.db_manager.executemany("UPDATE images SET content_hash = ? WHERE id = ?", hashes)
+        except sqlite3.Error as e:
+            self.logger.error(f"content_hash の更新中にエラーが発生しました: {e}")
+            raise
+
+    def get_file_fingerprints(self, keys: list[tuple[str, int, int]]) -> dict[str, dict[str, Any]]:
+        """
+        file_fingerprints から、サイズと更新日時が記録時から変わっていないファイルの記録をまとめて取得します。
+
+        Args:
+            keys (list[tuple[str, int, int]]): file_fingerprint_key で求めた (絶対パス, サイズ, 更新日時ns) のリスト。
+
+        Returns:
+            dict[str, dict[str, Any]]: 絶対パス -> {'phash', 'sha256', 'info', 'image_id'}。info は get_image_info の結果。
+        """
+        expected = {path: (size, mtime_ns) for path, size, mtime_ns in keys}
+        paths = list(expected)
+        fingerprints = {}
+        try:
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.db_manager.fetch_all(f"SELECT * FROM file_fingerprints WHERE path IN ({placeholders})",
+                                                 tuple(chunk))
+                for row in rows:
+                    if (row['size'], row['mtime_ns']) != expected[row['path']]:
+                        continue
+                    fingerprints[row['path']] = {
+                        'phash': row['phash'],
+                        'sha256': row['sha256'],
+                        'info': json.loads(row['info']) if row['info'] else None,
+                        'image_id': row['image_id'],
+                    }
+            return fingerprints
+        except sqlite3.Error as e:
+            self.logger.error(f"ファイルの記録の取得中にエラーが発生しました: {e}")
+            raise
+
+    def save_file_fingerprints(self, entries: list[tuple[tuple[str, int, int], dict[str, Any], Optional[int]]]) -> None:
+        """
+        取り込み元ファイルのpHash・SHA-256・画像情報を file_fingerprints に記録します。同じパスの記録は置き換えます。
+
+        Args:
+            entries (list[tuple[tuple[str, int, int], dict[str, Any], Optional[int]]]):
+                (file_fingerprint_key の結果, extract_original_image_info の結果, 登録済みの image_id) のリスト。
+        """
+        if not entries:
+            return
+        query = """
+        INSERT INTO file_fingerprints (path, size, mtime_ns, phash, sha256, info, image_id, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(path) DO UPDATE SET
+            size = excluded.size, mtime_ns = excluded.mtime_ns, phash = excluded.phash, sha256 = excluded.sha256,
+            info = excluded.info, image_id = excluded.image_id, updated_at = excluded.updated_at
+        """
+        params = []
+        for (path, size, mtime_ns), info, image_id in entries:
+            # 画像情報を取得していない (ハッシュだけで判定した) 場合は info を NULL にする
+            image_info = {key: info[key] for key in self.FINGERPRINT_INFO_KEYS if key in info}
+            params.append((path, size, mtime_ns, info.get('phash'), info.get('sha256'),
+                           json.dumps(image_info) if image_info else None, image_id))
+        try:
+            self.db_manager.executemany(query, params)
+        except sqlite3.Error as e:
+            self.logger.error(f"ファイルの記録の保存中にエラーが発生しました: {e}")
+            raise
+
     def add_processed_image(self, info: dict[str, Any]) -> int:
         """
         処理済み画像のメタデータを images テーブルに追加します。
@@ -465,7 +1320,7 @@ class ImageRepository:
         """
         query = "SELECT * FROM images WHERE id = ?"
         try:
-            metadata = self.db_manager.fetch_one(query, (image_id,))
+            metadata = self.db_manager.fetch_one(query, (image_id,), record_type=ImageRecord)
             return metadata
         except sqlite3.Error as e:
             current_method = inspect.currentframe().f_code.co_name
@@ -514,6 +1369,7 @@ class ImageRepository:
                 score = score_data.get('score', 0)
                 score_model_id = score_data.get('model_id', model_id)
                 self.save_score(image_id, score, score_model_id)
+            self.refresh_image_flags([image_id])
         except sqlite3.Error as e:
             current_method = inspect.currentframe().f_code.co_name
             raise sqlite3.Error(f"{current_method} アノテーションの保存中にエラーが発生しました: {e}")
@@ -542,19 +1398,10 @@ class ImageRepository:
                     existing = EXCLUDED.existing,
                     updated_at = CURRENT_TIMESTAMP
                 """
-        data = []
-
-        for tag in tags:
-            tag_id = self.find_tag_id(tag)
-            existing = 1 if model_id is None else 0
-            if model_id is None:
-                # None の場合は明示的に NULL を設定
-                data.append((image_id, tag_id, tag, None, existing))
-            else:
-                data.append((image_id, tag_id, tag, model_id, existing))
-        self.logger.debug(f"ImageRepository._save_tags_with_ids: tag={tag}, tag_id={tag_id}")
-
+        existing = 1 if model_id is None else 0
         try:
+            tag_ids = self.find_tag_ids(tags)
+            data = [(image_id, tag_ids[tag], tag, model_id, existing) for tag in tags]
             self.db_manager.executemany(query, data)
             self.logger.info(f"画像ID {image_id} に {len(data)} 個のタグとIDを保存しました")
         except sqlite3.Error as e:
@@ -600,6 +1447,82 @@ class ImageRepository:
             self.logger.error(f"キャプションの保存中にエラーが発生しました: {e}")
             raise
 
+    def refresh_image_flags(self, image_ids: Optional[list[int]] = None, batch_size: int = 10000) -> int:
+        """
+        image_flags テーブルのNSFWフラグとタグの一覧をアノテーションから計算し直す
+
+        Args:
+            image_ids (Optional[list[int]]): 対象の画像ID。Noneの場合は全ての画像
+            batch_size (int): 1回のクエリで処理する画像数
+
+        Returns:
+            int: 更新した画像数
+        """
+        patterns = [f"%{self.escape_special_characters(keyword)}%" for keyword in self.nsfw_keywords]
+        if patterns:
+            tag_sql = " OR ".join("t.tag LIKE ? ESCAPE '\\'" for _ in patterns)
+            caption_sql = " OR ".join("c.caption LIKE ? ESCAPE '\\'" for _ in patterns)
+            nsfw_sql = (f"EXISTS (SELECT 1 FROM tags t WHERE t.image_id = i.id AND ({tag_sql})) "
+                        f"OR EXISTS (SELECT 1 FROM captions c WHERE c.image_id = i.id AND ({caption_sql}))")
+        else:
+            nsfw_sql = "0"
+        query = f"""
+        INSERT INTO image_flags (image_id, nsfw, tag_set, updated_at)
+        SELECT i.id,
+               {nsfw_sql},
+               (SELECT group_concat(tag, ', ') FROM (
+                   SELECT DISTINCT t.tag FROM tags t WHERE t.image_id = i.id ORDER BY t.tag)),
+               CURRENT_TIMESTAMP
+        FROM images i
+        WHERE {{condition}}
+        ON CONFLICT(image_id) DO UPDATE SET
+            nsfw = excluded.nsfw,
+            tag_set = excluded.tag_set,
+            updated_at = excluded.updated_at
+        """
+        updated = 0
+        try:
+            if image_ids is not None:
+                unique_ids = list(dict.fromkeys(image_ids))
+                for start in range(0, len(unique_ids), 500):
+                    chunk = unique_ids[start:start + 500]
+                    placeholders = ", ".join("?" * len(chunk))
+                    cursor = self.db_manager.execute(query.format(condition=f"i.id IN ({placeholders})"),
+                                                     tuple(patterns + patterns + chunk))
+                    updated += cursor.rowcount
+            else:
+                last_id = 0
+                max_id = self.db_manager.fetch_one("SELECT MAX(id) AS max_id FROM images")['max_id'] or 0
+                while last_id < max_id:
+                    cursor = self.db_manager.execute(query.format(condition="i.id > ? AND i.id <= ?"),
+                                                     tuple(patterns + patterns + [last_id, last_id + batch_size]))
+                    updated += cursor.rowcount
+                    last_id += batch_size
+                self.logger.info(f"image_flags を {updated} 件再計算しました")
+            return updated
+        except sqlite3.Error as e:
+            self.logger.error(f"image_flags の更新中にエラーが発生しました: {e}")
+            raise
+
+    def sync_image_flags(self) -> bool:
+        """
+        NSFWキーワードが前回の計算時から変わっていれば、全画像の image_flags を計算し直す
+
+        Returns:
+            bool: 再計算した場合はTrue
+        """
+        keywords = json.dumps(sorted(keyword.lower() for keyword in self.nsfw_keywords), ensure_ascii=False)
+        row = self.db_manager.fetch_one("SELECT value FROM db_settings WHERE key = 'nsfw_keywords'")
+        if row and row['value'] == keywords:
+            return False
+        self.logger.info("NSFWキーワードが変更されたため image_flags を再計算します")
+        self.refresh_image_flags()
+        self.db_manager.execute("""
+            INSERT INTO db_settings (key, value, updated_at) VALUES ('nsfw_keywords', ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        """, (keywords,))
+        return True
+
     def save_score(self, image_id: int, score: float, model_id: int) -> None:
         """スコアを保存
 
@@ -710,12 +1633,74 @@ class ImageRepository:
             self.logger.error(f"予期せぬエラーが発生しました: {e}")
             raise
 
+    def iter_annotations_for_images(self, image_ids: Iterable[int],
+                                    chunk_size: int = 5000) -> Iterator[dict[int, dict[str, list[dict[str, Any]]]]]:
+        """
+        複数の画像のアノテーションを chunk_size 件ずつまとめて取得します。
+        画像IDを一時テーブルに入れ、tags / captions / scores をそれぞれ1回の結合で取得します。
+
+        Args:
+            image_ids (Iterable[int]): アノテーションを取得する画像のID。
+            chunk_size (int): 1回に取得する画像数。
+
+        Yields:
+            dict[int, dict[str, list[dict[str, Any]]]]: image_id -> get_image_annotations と同じ形式の辞書。
+            存在しない画像やアノテーションのない画像は空のリストになります。
+        """
+        join = "JOIN temp.annotation_image_ids ids ON ids.image_id = a.image_id ORDER BY a.image_id, a.id"
+        # image_id は振り分けにだけ使うので '_' を付けてレコードのキーに含めない
+        queries = {
+            'tags': (f"SELECT a.image_id AS _image_id, a.tag, a.model_id, a.tag_id, a.updated_at FROM tags a {join}",
+                     TagRecord),
+            'captions': (f"SELECT a.image_id AS _image_id, a.caption, a.model_id, a.updated_at FROM captions a {join}",
+                         CaptionRecord),
+            'scores': (f"SELECT a.image_id AS _image_id, a.score, a.model_id FROM scores a {join}", ScoreRecord),
+        }
+        ids = list(dict.fromkeys(image_ids))
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            annotations = {image_id: {'tags': [], 'captions': [], 'scores': []} for image_id in chunk}
+            try:
+                # 一時テーブルは接続ごとなので、同じ接続で作成から参照まで行う
+                with self.db_manager.get_connection() as conn:
+                    conn.execute("CREATE TEMP TABLE IF NOT EXISTS annotation_image_ids (image_id INTEGER PRIMARY KEY)")
+                    conn.execute("DELETE FROM temp.annotation_image_ids")
+                    conn.executemany("INSERT INTO temp.annotation_image_ids (image_id) VALUES (?)",
+                                     [(image_id,) for image_id in chunk])
+                    for key, (query, record_type) in queries.items():
+                        cursor = conn.cursor()
+                        cursor.row_factory = record_type
+                        for row in cursor.execute(query).fetchall():
+                            annotations[row._image_id][key].append(row)
+                    conn.execute("DELETE FROM temp.annotation_image_ids")
+            except sqlite3.Error as e:
+                self.logger.error(f"アノテーションの一括取得中にデータベースエラーが発生しました: {e}")
+                raise
+            yield annotations
+
+    def get_annotations_for_images(self, image_ids: Iterable[int],
+                                   chunk_size: int = 5000) -> dict[int, dict[str, list[dict[str, Any]]]]:
+        """
+        複数の画像のアノテーションをまとめて取得します。
+
+        Args:
+            image_ids (Iterable[int]): アノテーションを取得する画像のID。
+            chunk_size (int): 1回に取得する画像数。
+
+        Returns:
+            dict[int, dict[str, list[dict[str, Any]]]]: image_id -> アノテーションの辞書。
+        """
+        annotations = {}
+        for chunk in self.iter_annotations_for_images(image_ids, chunk_size):
+            annotations.update(chunk)
+        return annotations
+
     def _get_tags(self, image_id: int) -> list[dict[str, Any]]:
         """image_idからタグを取得する内部メソッド"""
         query = "SELECT tag, model_id, tag_id, updated_at FROM tags WHERE image_id = ?"
         try:
             self.logger.debug(f"タグを取得するimage_id: {image_id}")
-            result = self.db_manager.fetch_all(query, (image_id,))
+            result = self.db_manager.fetch_all(query, (image_id,), record_type=TagRecord)
             if not result:
                 self.logger.debug(f"Image_id: {image_id} にタグは登録されていません。")
             return result
@@ -728,7 +1713,7 @@ class ImageRepository:
         query = "SELECT caption, model_id, updated_at FROM captions WHERE image_id = ?"
         try:
             self.logger.debug(f"キャプションを取得するimage_id: {image_id}")
-            result = self.db_manager.fetch_all(query, (image_id,))
+            result = self.db_manager.fetch_all(query, (image_id,), record_type=CaptionRecord)
             if not result:
                 self.logger.info(f"Image_id: {image_id} にキャプションは登録されていません。")
             return result
@@ -741,7 +1726,7 @@ class ImageRepository:
         query = "SELECT score, model_id FROM scores WHERE image_id = ?"
         try:
             self.logger.debug(f"スコアを取得するimage_id: {image_id}")
-            result = self.db_manager.fetch_all(query, (image_id,))
+            result = self.db_manager.fetch_all(query, (image_id,), record_type=ScoreRecord)
             if not result:
                 self.logger.info(f"Image_id: {image_id} にスコアは登録されていません。")
             return result
@@ -782,33 +1767,17 @@ class ImageRepository:
         Returns:
             list[int]: タグを持つ画像IDのリスト か 空リスト
         """
-        if tag.startswith('"') and tag.endswith('"'):
-            # 完全一致検索用のクエリ
-            query = """
-            SELECT i.id
-            FROM images i
-            JOIN tags t ON i.id = t.image_id
-            WHERE t.tag = ?
-            AND t.updated_at BETWEEN ? AND ?
-            """
-            # ダブルクオートを外したタグで検索
-            pattern = tag.strip('"')
-        else:
-            # ワイルドカードなしでも部分一致検索にする
-            pattern = self.escape_special_characters(tag)
-            if '*' not in tag:
-                # '*' がない場合も部分一致のLIKEを使う
-                pattern = f'%{pattern}%'
-
-            query = """
-            SELECT i.id
-            FROM images i
-            JOIN tags t ON i.id = t.image_id
-            WHERE t.tag LIKE ? ESCAPE '\\'
-            AND t.updated_at BETWEEN ? AND ?
-            """
+        # ダブルクオートで囲まれていれば完全一致、ワイルドカードなしでも部分一致検索にする
+        condition, match_params = self._match_condition('tags', 't', tag)
+        query = f"""
+        SELECT i.id
+        FROM images i
+        JOIN tags t ON i.id = t.image_id
+        WHERE {condition}
+        AND t.updated_at BETWEEN ? AND ?
+        """
         # タイムスタンプをパラメータに追加
-        params = [pattern, start_date, end_date]
+        params = match_params + [start_date, end_date]
         rows = self.db_manager.fetch_all(query, params)
         if not rows:
             self.logger.info("%s を含む画像はありません", tag)
@@ -837,31 +1806,16 @@ class ImageRepository:
             list[int]: キャプションを持つ画像IDのリスト か 空リスト
         """
         # キャプションがダブルクオートで囲まれている場合は完全一致検索を行う
-        if caption.startswith('"') and caption.endswith('"'):
-            # 完全一致検索用のクエリ
-            query = """
-            SELECT DISTINCT i.id
-            FROM images i
-            JOIN captions c ON i.id = c.image_id
-            WHERE c.caption = ?
-            AND c.updated_at BETWEEN ? AND ?
-            """
-            # ダブルクオートを外したキャプションで検索
-            pattern = caption.strip('"')
-        else:
-            # 部分一致検索用のパターン作成
-            pattern = self.escape_special_characters(caption)
-            if '*' not in caption:
-                pattern = f'%{pattern}%'
-            query = """
-            SELECT DISTINCT i.id
-            FROM images i
-            JOIN captions c ON i.id = c.image_id
-            WHERE c.caption LIKE ? ESCAPE '\\'
-            AND c.updated_at BETWEEN ? AND ?
-            """
+        condition, match_params = self._match_condition('captions', 'c', caption)
+        query = f"""
+        SELECT DISTINCT i.id
+        FROM images i
+        JOIN captions c ON i.id = c.image_id
+        WHERE {condition}
+        AND c.updated_at BETWEEN ? AND ?
+        """
 
-        params = [pattern, start_date, end_date]
+        params = match_params + [start_date, end_date]
         rows = self.db_manager.fetch_all(query, params)
         if not rows:
             self.logger.info("'%s' を含むキャプションを持つ画像はありません", caption)
@@ -869,6 +1823,187 @@ class ImageRepository:
         else:
             return [row['id'] for row in rows]
 
+    def _match_condition(self, table: str, alias: str, term: str) -> tuple[str, list[str]]:
+        """
+        タグ・キャプションの検索語句をSQLの条件式とパラメータに変換する
+        ダブルクオートで囲まれた語句は完全一致、それ以外は部分一致（'*' はワイルドカード）
+
+        全文検索テーブルが使える場合は trigram の LIKE で候補の行に絞り込んでから元の条件で確認する。
+        3文字以上続く固定部分がない語句は索引を使えないため、元テーブルの検索だけを行う
+
+        Args:
+            table (str): 'tags' または 'captions'
+            alias (str): クエリ内でのテーブルの別名
+            term (str): 検索語句
+
+        Returns:
+            tuple[str, list[str]]: 条件式とパラメータ
+        """
+        column = 'tag' if table == 'tags' else 'caption'
+        if term.startswith('"') and term.endswith('"'):
+            literal = term.strip('"')
+            sql, params = f"{alias}.{column} = ?", [literal]
+            fts_pattern = literal.replace('%', '_')
+        else:
+            pattern = self.escape_special_characters(term)
+            fts_pattern = term.replace('%', '_').replace('*', '%')
+            if '*' not in term:
+                pattern = f'%{pattern}%'
+                fts_pattern = f'%{fts_pattern}%'
+            sql, params = f"{alias}.{column} LIKE ? ESCAPE '\\'", [pattern]
+
+        # FTS の LIKE は ESCAPE を使えないので、% と _ は1文字のワイルドカードとして候補を広めに取る
+        has_trigram = any(len(part) >= 3 for part in re.split(r'[%_]', fts_pattern))
+        if self.db_manager.fts_enabled and has_trigram:
+            sql = f"{alias}.id IN (SELECT rowid FROM {table}_fts WHERE {column} LIKE ?) AND {sql}"
+            params = [fts_pattern] + params
+        return f"({sql})", params
+
+    def _build_filter_query(self, tags: list[str], caption: str, resolution: int, use_and: bool,
+                            start_date: str, end_date: str, include_untagged: bool,
+                            exclude_nsfw: bool) -> tuple[str, list[Any]]:
+        """
+        検索条件に一致する画像IDを返すクエリを組み立てる
+        処理済み画像を検索する場合は条件に合う処理済み画像のIDも返す
+
+        Returns:
+            tuple[str, list[Any]]: image_id と processed_id を返すSELECT文とパラメータ
+        """
+        conditions = []
+        params = []
+        if include_untagged:
+            conditions.append("NOT EXISTS (SELECT 1 FROM tags t WHERE t.image_id = i.id)")
+        else:
+            if tags:
+                matches = [self._match_condition('tags', 't', tag) for tag in tags]
+                tag_sql = " OR ".join(sql for sql, _ in matches)
+                subquery = f"SELECT t.image_id FROM tags t WHERE t.updated_at BETWEEN ? AND ? AND ({tag_sql})"
+                params += [start_date, end_date] + [param for _, match_params in matches for param in match_params]
+                if use_and and len(matches) > 1:
+                    # 画像ごとにまとめて、全ての検索語句に一致するタグを持つ画像だけを残す
+                    having = " AND ".join(f"MAX{sql}" for sql, _ in matches)
+                    subquery += f" GROUP BY t.image_id HAVING {having}"
+                    params += [param for _, match_params in matches for param in match_params]
+                conditions.append(f"i.id IN ({subquery})")
+            if caption:
+                sql, match_params = self._match_condition('captions', 'c', caption)
+                conditions.append(f"EXISTS (SELECT 1 FROM captions c WHERE c.image_id = i.id "
+                                  f"AND c.updated_at BETWEEN ? AND ? AND {sql})")
+                params += [start_date, end_date] + match_params
+
+        if exclude_nsfw:
+            conditions.append("i.id NOT IN (SELECT f.image_id FROM image_flags f WHERE f.nsfw = 1)")
+
+        where_sql = " AND ".join(conditions) if conditions else "1"
+        if not resolution:
+            return f"SELECT i.id AS image_id, NULL AS processed_id FROM images i WHERE {where_sql}", params
+
+        match_sql, match_params, order_sql, order_params = self._processed_match_sql(resolution, 'p2')
+        processed_sql = f"""
+            SELECT p2.id FROM processed_images p2
+            WHERE p2.image_id = i.id AND {match_sql}
+            ORDER BY {order_sql} LIMIT 1
+        """
+        query = f"""
+            SELECT * FROM (
+                SELECT i.id AS image_id, ({processed_sql}) AS processed_id FROM images i WHERE {where_sql}
+            ) WHERE processed_id IS NOT NULL
+        """
+        return query, match_params + order_params + params
+
+    @staticmethod
+    def _processed_match_sql(resolution: int, alias: str = 'p') -> tuple[str, list[Any], str, list[Any]]:
+        """
+        解像度に合う処理済み画像を選ぶ条件と並び順を返す
+        長辺が解像度と一致するか、面積の誤差が20%以内のものが対象で、長辺が一致するもの、面積が近いものの順に選ぶ。
+        解像度が0の場合は全てが対象で、面積が最も小さいものを選ぶ
+
+        Args:
+            resolution (int): 目標解像度
+            alias (str): クエリ内での processed_images の別名
+
+        Returns:
+            tuple[str, list[Any], str, list[Any]]: 条件式とそのパラメータ、ORDER BY 句とそのパラメータ
+        """
+        if not resolution:
+            return "1", [], f"{alias}.area, {alias}.id", []
+        target_area = resolution * resolution
+        tolerance = target_area * 0.2
+        match_sql = f"({alias}.long_side = ? OR {alias}.area BETWEEN ? AND ?)"
+        order_sql = f"{alias}.long_side = ? DESC, ABS({alias}.area - ?), {alias}.id"
+        return match_sql, [resolution, target_area - tolerance, target_area + tolerance], order_sql, [resolution, target_area]
+
+    def find_images(self, tags: list[str] = None, caption: str = None, resolution: int = 0,
+                    use_and: bool = True, start_date: str = None, end_date: str = None,
+                    include_untagged: bool = False, exclude_nsfw: bool = False,
+                    limit: Optional[int] = None, offset: int = 0,
+                    after_id: Optional[int] = None) -> tuple[list[dict[str, Any]], int]:
+        """
+        検索条件を1つのSQL文にまとめて、一致する画像のメタデータを image_id 順に取得する
+
+        Args:
+            tags (list[str], optional): 検索するタグ。ダブルクオートで完全一致、'*' はワイルドカード
+            caption (str, optional): 検索するキャプション
+            resolution (int, optional): 0の場合はオリジナル画像、それ以外は解像度に合う処理済み画像を返す
+            use_and (bool, optional): Trueの場合は全てのタグ、Falseの場合はいずれかのタグに一致する画像
+            start_date (str): タグ・キャプションの更新日時の下限
+            end_date (str): タグ・キャプションの更新日時の上限
+            include_untagged (bool, optional): タグが付いていない画像のみを取得する。検索語句は無視される
+            exclude_nsfw (bool, optional): image_flags でNSFWとされた画像を除外する
+            limit (Optional[int], optional): 取得する最大件数。Noneの場合は全件
+            offset (int, optional): 読み飛ばす件数
+            after_id (Optional[int], optional): この image_id より後の画像から取得する（キーセットページング）
+
+        Returns:
+            tuple[list[dict[str, Any]], int]: メタデータのリストと、ページングする前の一致件数
+            (after_id を指定した場合は after_id より後の一致件数)
+        """
+        matched_sql, params = self._build_filter_query(tags, caption, resolution, use_and, start_date, end_date,
+                                                       include_untagged, exclude_nsfw)
+        if resolution:
+            columns = "p.*"
+            join_sql = "JOIN processed_images p ON p.id = m.processed_id"
+            record_type = ProcessedImageRecord
+        else:
+            columns = "i.*, m.image_id"
+            join_sql = "JOIN images i ON i.id = m.image_id"
+            record_type = ImageRecord
+        query = f"""
+        WITH matched AS ({matched_sql})
+        SELECT {columns}, (SELECT COUNT(*) FROM matched) AS _total_count
+        FROM matched m {join_sql}
+        """
+        page_params = []
+        if after_id is not None:
+            query += " WHERE m.image_id > ?"
+            page_params.append(after_id)
+        query += " ORDER BY m.image_id"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            page_params += [limit, offset]
+        elif offset:
+            query += " LIMIT -1 OFFSET ?"
+            page_params.append(offset)
+
+        try:
+            rows = self.db_manager.fetch_all(query, tuple(params + page_params), record_type=record_type)
+            if rows:
+                # _total_count はレコードのキーに含まれない
+                total_count = rows[0]._total_count
+            elif limit is not None or offset or after_id is not None:
+                # ページが空でも一致件数は返す
+                count_row = self.db_manager.fetch_one(
+                    f"WITH matched AS ({matched_sql}) SELECT COUNT(*) AS total_count FROM matched"
+                    + (" WHERE image_id > ?" if after_id is not None else ""),
+                    tuple(params + ([after_id] if after_id is not None else [])))
+                total_count = count_row['total_count']
+            else:
+                total_count = 0
+            return rows, total_count
+        except sqlite3.Error as e:
+            self.logger.error(f"画像の検索中にエラーが発生しました: {e}")
+            raise
+
     def get_original_image(self, image_id: int) -> dict[str, Any]:
         """
         指定されたIDのオリジナル画像のメタデータを取得します。
@@ -884,7 +2019,7 @@ class ImageRepository:
         """
         query = "SELECT * FROM images WHERE id = ?"
         try:
-            metadata = self.db_manager.fetch_one(query, (image_id,))
+            metadata = self.db_manager.fetch_one(query, (image_id,), record_type=ImageRecord)
             return metadata
         except sqlite3.Error as e:
             current_method = inspect.currentframe().f_code.co_name
@@ -893,6 +2028,7 @@ class ImageRepository:
     def get_processed_image(self, image_id: int, resolution: int = 0, all_data: bool = False) -> Optional[dict[str, Any]]:
         """
         image_idとresolutionから関連する処理済み画像のメタデータを取得し、指定した解像度でリサイズされた画像のメタデータを返します。
+        解像度による選択は long_side / area カラムを使ってSQLで行います。
 
         Args:
             image_id (int): 元画像のID。
@@ -905,54 +2041,58 @@ class ImageRepository:
         Raises:
             sqlite3.Error: データベース操作でエラーが発生した場合。
         """
-        query = "SELECT * FROM processed_images WHERE image_id = ?"
         try:
-            # 全ての処理済み画像を取得
-            metadata_list = self.db_manager.fetch_all(query, (image_id,))
-            if not metadata_list:
-                return None
-            self.logger.debug(f"ID {image_id} の処理済み画像メタデータを {len(metadata_list)} 取得しました")
             if all_data:
-                return metadata_list
-            # resolutionが0の場合は最も解像度が低いものを選択
-            if resolution == 0:
-                metadata = min(metadata_list, key=lambda x: x['width'] * x['height'])
-            else:
-                # 指定された解像度に近いものをフィルタリング
-                metadata = self._filter_by_resolution(metadata_list, resolution)
-            return metadata
+                metadata_list = self.db_manager.fetch_all("SELECT * FROM processed_images WHERE image_id = ? ORDER BY id",
+                                                          (image_id,), record_type=ProcessedImageRecord)
+                self.logger.debug(f"ID {image_id} の処理済み画像メタデータを {len(metadata_list)} 取得しました")
+                return metadata_list or None
+            match_sql, match_params, order_sql, order_params = self._processed_match_sql(resolution)
+            query = f"""
+                SELECT * FROM processed_images p
+                WHERE p.image_id = ? AND {match_sql}
+                ORDER BY {order_sql} LIMIT 1
+            """
+            return self.db_manager.fetch_one(query, tuple([image_id] + match_params + order_params),
+                                             record_type=ProcessedImageRecord)
 
         except sqlite3.Error as e:
             current_method = inspect.currentframe().f_code.co_name
             raise sqlite3.Error(f"{current_method} 処理済み画像の取得中にエラーが発生しました: {e}")
 
-    def _filter_by_resolution(self, metadata_list: list[dict[str, Any]], resolution: int) -> dict[str, Any]:
+    def get_processed_images(self, image_ids: Iterable[int], resolution: int = 0) -> dict[int, dict[str, Any]]:
         """
-        解像度に基づいてメタデータをフィルタリングします。
+        複数の画像について、get_processed_image と同じ基準で選んだ処理済み画像を500件ずつまとめて取得します。
 
         Args:
-            metadata_list (list[dict[str, Any]]): メタデータの辞書のリスト。
-            resolution (int): 解像度。
+            image_ids (Iterable[int]): 元画像のID。
+            resolution (int): リサイズ処理の基準にした解像度。0の場合は最も解像度が低い画像を選びます。
 
         Returns:
-            dict[str, Any]]: フィルタリングされたメタデータの辞書。解像度が条件に一致するか、
-            指定した解像度に対して誤差が20%以下であるメタデータを返します。
-
+            dict[int, dict[str, Any]]: image_id -> 処理済み画像のメタデータ。該当する画像がないIDは含みません。
         """
-        for metadata in metadata_list:
-            width, height = metadata['width'], metadata['height']
-            long_side, short_side = max(width, height), min(width, height)
-
-            if long_side == resolution:
-                return metadata
-            else:
-                target_area = resolution * resolution
-                actual_area = long_side * short_side
-                error_ratio = abs(target_area - actual_area) / target_area
-
-                if error_ratio <= 0.2:
-                    return metadata
-        return None
+        match_sql, match_params, order_sql, order_params = self._processed_match_sql(resolution)
+        ids = list(dict.fromkeys(image_ids))
+        processed = {}
+        try:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                # _rank はレコードのキーに含まれない
+                query = f"""
+                    SELECT * FROM (
+                        SELECT p.*, ROW_NUMBER() OVER (PARTITION BY p.image_id ORDER BY {order_sql}) AS _rank
+                        FROM processed_images p
+                        WHERE p.image_id IN ({placeholders}) AND {match_sql}
+                    ) WHERE _rank = 1
+                """
+                rows = self.db_manager.fetch_all(query, tuple(order_params + chunk + match_params),
+                                                 record_type=ProcessedImageRecord)
+                processed.update((row['image_id'], row) for row in rows)
+            return processed
+        except sqlite3.Error as e:
+            self.logger.error(f"処理済み画像の一括取得中にエラーが発生しました: {e}")
+            raise
 
     def get_total_image_count(self) -> int:
         try:
@@ -986,27 +2126,29 @@ class ImageRepository:
             self.logger.error(f"画像IDの取得中にエラーが発生しました: {e}")
             return None
 
-    def get_image_id_by_phash(self, phash: str) -> Optional[int]:
+    def get_image_id_by_phash(self, phash: str, threshold: Optional[int] = None) -> Optional[int]:
         """
         pHashからimage_idを取得
+        BK-treeのpHashインデックスでハミング距離が最も近い画像を検索する
 
         Args:
             phash (str): pHash
+            threshold (Optional[int]): 許容するハミング距離。Noneの場合は phash_threshold を使用。
 
         Returns:
             Optional[int]: image_id。画像が見つからない場合はNone。
         """
-        THRESHOLD = 5  # この値は調整可能です。小さいほど厳密な一致を要求します。
-
-        query = "SELECT id, phash FROM images"
+        threshold = self.phash_threshold if threshold is None else threshold
         try:
-            results = self.db_manager.fetch_all(query)
+            phash_int = phash_to_int(phash)
+            if phash_int is None:
+                raise ValueError(f"pHashを解釈できません: {phash}")
 
-            for row in results:
-                db_id, db_phash = row['id'], row['phash']
-                if imagehash.hex_to_hash(phash) - imagehash.hex_to_hash(db_phash) <= THRESHOLD:
-                    self.logger.info(f"類似画像が見つかりました: ID {db_id}, 元のpHash: {phash}, DB内pHash: {db_phash}")
-                    return db_id
+            nearest = self._get_phash_index().nearest(phash_int, threshold)
+            if nearest is not None:
+                distance, db_id = nearest
+                self.logger.info(f"類似画像が見つかりました: ID {db_id}, 元のpHash: {phash}, 距離: {distance}")
+                return db_id
 
             self.logger.info(f"類似画像は見つかりませんでした: pHash {phash}")
             return None
@@ -1014,6 +2156,24 @@ class ImageRepository:
             self.logger.error(f"類似画像の検索中にエラーが発生しました: {e}")
             return None
 
+    def get_all_phashes(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        登録済み画像のpHashを一括で取得する
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: (image_idの配列, pHashのuint64配列)。image_idの昇順。
+        """
+        query = "SELECT id, phash_int FROM images WHERE phash_int IS NOT NULL ORDER BY id"
+        conn = self.db_manager.connect()
+        cursor = conn.cursor()
+        # 行ごとの辞書生成を避けるためタプルのまま取得する
+        cursor.row_factory = None
+        rows = cursor.execute(query).fetchall()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+        data = np.array(rows, dtype=np.int64)
+        return data[:, 0], data[:, 1].view(np.uint64)
+
     def update_image_metadata(self, image_id: int, updated_info: dict[str, Any]) -> None:
         """
         指定された画像IDのメタデータを更新します。
@@ -1028,6 +2188,8 @@ class ImageRepository:
         if not updated_info:
             self.logger.warning("更新する情報が提供されていません。")
             return
+        if 'phash' in updated_info:
+            updated_info = {**updated_info, 'phash_int': phash_to_sqlite_int(updated_info['phash'])}
         fields = ", ".join(f"{key} = ?" for key in updated_info.keys())
         values = list(updated_info.values())
         query = f"UPDATE images SET {fields}, updated_at = ? WHERE id = ?"
@@ -1035,6 +2197,8 @@ class ImageRepository:
         values.append(image_id)  # image_idを追加
         try:
             self.db_manager.execute(query, tuple(values))
+            if 'phash' in updated_info:
+                self._update_phash_index(image_id, updated_info['phash'])
             self.logger.info(f"画像ID {image_id} のメタデータを更新しました。")
         except sqlite3.Error as e:
             self.logger.error(f"画像メタデータの更新中にエラーが発生しました: {e}")
@@ -1053,6 +2217,8 @@ class ImageRepository:
         query = "DELETE FROM images WHERE id = ?"
         try:
             self.db_manager.execute(query, (image_id,))
+            if self._phash_index is not None:
+                self._phash_index.remove(image_id)
             self.logger.info(f"画像ID {image_id} と関連するデータを削除しました。")
         except sqlite3.Error as e:
             self.logger.error(f"画像の削除中にエラーが発生しました: {e}")
@@ -1068,30 +2234,145 @@ class ImageRepository:
         Raises:
             ValueError: 複数または0件のタグが見つかった場合
         """
-        query = "SELECT tag_id FROM tag_db.TAGS WHERE tag = ?"
+        tag_id = self.tag_id_cache.get(keyword)
+        if tag_id is not TagIdCache._MISSING:
+            return tag_id
+        # 同じタグが複数行ある場合は find_tag_ids と同じく最小の tag_id を使う
+        query = "SELECT MIN(tag_id) AS tag_id FROM tag_db.TAGS WHERE tag = ?"
         try:
             result = self.db_manager.fetch_one(query, (keyword,))
-            if result:
-                if len(result) > 1:
-                    self.logger.warning(f"タグ '{keyword}' に対して複数のIDが見つかりました。\n {result}")
-                    return result['tag_id'][0]
-                else:
-                    tag_id = result['tag_id']
-                    self.logger.debug(f"タグ '{keyword}' のtag_id {tag_id} を取得しました")
-                return tag_id
-            self.logger.info(f"タグ '{keyword}' のtag_idを取得できませんでした")
-            return None
+            if result and result['tag_id'] is not None:
+                tag_id = result['tag_id']
+                self.logger.debug(f"タグ '{keyword}' のtag_id {tag_id} を取得しました")
+            else:
+                tag_id = None
+                self.logger.info(f"タグ '{keyword}' のtag_idを取得できませんでした")
+            self.tag_id_cache.put(keyword, tag_id)
+            return tag_id
+        except sqlite3.Error as e:
+            self.logger.error(f"タグIDの取得中にエラーが発生しました: {e}")
+            raise
+
+    def find_tag_ids(self, keywords: list[str]) -> dict[str, Optional[int]]:
+        """tags_v3.db TAGSテーブルから複数のタグを完全一致でまとめて検索
+
+        キャッシュにないタグだけを IN 句で一括検索する。
+
+        Args:
+            keywords (list[str]): 検索キーワードのリスト
+        Returns:
+            dict[str, Optional[int]]: タグ -> tag_id 見つからないタグは None
+        """
+        tag_ids = {}
+        missing = []
+        for keyword in dict.fromkeys(keywords):
+            tag_id = self.tag_id_cache.get(keyword)
+            if tag_id is TagIdCache._MISSING:
+                missing.append(keyword)
+            else:
+                tag_ids[keyword] = tag_id
+        try:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self.db_manager.fetch_all(
+                    f"SELECT tag, MIN(tag_id) AS tag_id FROM tag_db.TAGS WHERE tag IN ({placeholders}) GROUP BY tag",
+                    tuple(chunk))
+                found = {row['tag']: row['tag_id'] for row in rows}
+                for keyword in chunk:
+                    tag_ids[keyword] = found.get(keyword)
+                    self.tag_id_cache.put(keyword, tag_ids[keyword])
+            if missing:
+                self.logger.debug(f"{len(missing)} 個のタグのtag_idを検索しました: {self.tag_id_cache.stats()}")
+            return tag_ids
         except sqlite3.Error as e:
             self.logger.error(f"タグIDの取得中にエラーが発生しました: {e}")
             raise
 
+    def explain_query_plans(self) -> list[dict[str, Any]]:
+        """
+        検索系のメソッドを実際に呼び出して実行されたSQLを記録し、それぞれの EXPLAIN QUERY PLAN から
+        インデックスを使わないテーブルの全件スキャンを探す。DBの内容は変更しない
+
+        Returns:
+            list[dict[str, Any]]: {'method', 'query', 'plan', 'full_scans'} のリスト
+            full_scans は 'SCAN images' のようにインデックスを使わないスキャンの説明
+        """
+        row = self.db_manager.fetch_one("SELECT MIN(id) AS id FROM images")
+        image_id = row['id'] or 0
+        start_date, end_date = '2020-01-01 00:00:00', datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        filter_args = {'start_date': start_date, 'end_date': end_date}
+        samples = {
+            'get_images_metadata': lambda: self.get_images_metadata([image_id]),
+            'get_image_metadata': lambda: self.get_image_metadata(image_id),
+            'get_original_image': lambda: self.get_original_image(image_id),
+            'get_processed_image': lambda: self.get_processed_image(image_id, 1024),
+            'get_image_annotations': lambda: self.get_image_annotations(image_id),
+            'get_annotations_for_images': lambda: self.get_annotations_for_images([image_id]),
+            'get_images_by_tag': lambda: self.get_images_by_tag('"1girl"', start_date, end_date),
+            'get_images_by_tag (部分一致)': lambda: self.get_images_by_tag('girl', start_date, end_date),
+            'get_images_by_caption': lambda: self.get_images_by_caption('girl', start_date, end_date),
+            'get_untagged_images': self.get_untagged_images,
+            'get_image_id_by_name': lambda: self.get_image_id_by_name('sample.webp'),
+            'get_total_image_count': self.get_total_image_count,
+            'get_all_phashes': self.get_all_phashes,
+            'find_images (AND)': lambda: self.find_images(tags=['"1girl"', 'solo*'], use_and=True, limit=100,
+                                                          **filter_args),
+            'find_images (OR)': lambda: self.find_images(tags=['"1girl"', 'solo*'], use_and=False, limit=100,
+                                                         **filter_args),
+            'find_images (caption)': lambda: self.find_images(caption='girl', exclude_nsfw=True, limit=100,
+                                                              **filter_args),
+            'find_images (resolution)': lambda: self.find_images(tags=['"1girl"'], resolution=1024, limit=100,
+                                                                 **filter_args),
+            'find_images (untagged)': lambda: self.find_images(include_untagged=True, limit=100, **filter_args),
+        }
+        conn = self.db_manager.connect()
+        executed: list[str] = []
+        results = []
+        try:
+            tables = {row['name'] for row in self.db_manager.fetch_all(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND sql NOT LIKE 'CREATE VIRTUAL%'")}
+            for method, call in samples.items():
+                executed.clear()
+                conn.set_trace_callback(executed.append)
+                try:
+                    call()
+                finally:
+                    conn.set_trace_callback(None)
+                # トリガー内の文やトランザクション制御の文は除く
+                queries = [query for query in dict.fromkeys(executed)
+                           if query.lstrip().upper().startswith(('SELECT', 'WITH'))]
+                for query in queries:
+                    plan = self.db_manager.explain_query_plan(query)
+                    # プランには別名で表示されるので、テーブル名に戻して WITH 句などの走査を除く
+                    aliases = {alias: table for table, alias in
+                               re.findall(r'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)', query, re.IGNORECASE)}
+                    full_scans = [detail for detail in plan if re.fullmatch(r'SCAN \w+', detail)
+                                  and aliases.get(detail.split()[1], detail.split()[1]) in tables]
+                    results.append({'method': method, 'query': ' '.join(query.split()), 'plan': plan,
+                                    'full_scans': full_scans})
+                    if full_scans:
+                        self.logger.warning(f"{method}: 全件スキャンがあります {full_scans}")
+            return results
+        except sqlite3.Error as e:
+            self.logger.error(f"クエリプランの取得中にエラーが発生しました: {e}")
+            raise
+
 class ImageDatabaseManager:
     """
     画像データベース操作の高レベルインターフェースを提供するクラス。
     このクラスは、ImageRepositoryを使用して、画像メタデータとアノテーションの
     保存、取得、更新などの操作を行います。
     """
-    def __init__(self, db_dir: Path):
+    def __init__(self, db_dir: Path, phash_threshold: int = 5, nsfw_keywords: Optional[list[str]] = None,
+                 db_settings: Optional[dict[str, Any]] = None):
+        """
+        Args:
+            db_dir (Path): 画像データベースのディレクトリ
+            phash_threshold (int): 類似画像とみなすpHashのハミング距離
+            nsfw_keywords (Optional[list[str]]): タグかキャプションに含まれていたらNSFWとみなすキーワード
+            db_settings (Optional[dict[str, Any]]): SQLiteのPRAGMAの設定 設定ファイルの [database]
+        """
         self.logger = get_logger("ImageDatabaseManager")
         if Path("Image_database").exists():
             Path("Image_database").mkdir(parents=True, exist_ok=True)
@@ -1099,10 +2380,11 @@ class ImageDatabaseManager:
             db_dir = Path("Image_database")
         img_db_path = db_dir / "image_database.db"
         tag_db_path = Path("src") / "module" / "genai-tag-db-tools" / "tags_v3.db"
-        self.db_manager = SQLiteManager(img_db_path, tag_db_path)
-        self.repository = ImageRepository(self.db_manager)
+        self.db_manager = SQLiteManager(img_db_path, tag_db_path, db_settings)
+        self.repository = ImageRepository(self.db_manager, phash_threshold, nsfw_keywords)
         self.db_manager.create_tables()
         self.db_manager.insert_models()
+        self.repository.sync_image_flags()
         self.logger.debug("初期化")
 
     def __enter__(self):
@@ -1114,19 +2396,115 @@ class ImageDatabaseManager:
             self.logger.error("ImageDatabaseManager使用中にエラー: %s", exc_value)
         return False  # 例外を伝播させる
 
-    def register_original_image(self, image_path: Path, fsm: FileSystemManager) -> Optional[tuple]:
+    def transaction(self):
+        """
+        複数の登録・更新を1回のコミットにまとめるコンテキストマネージャ。
+        例外が起きた場合はブロック内の変更をすべて取り消す。入れ子にできる。
+
+        使用例:
+            with idm.transaction():
+                image_id, _ = idm.register_original_image(image_path, fsm)
+                idm.save_annotations(image_id, annotations)
+        """
+        return self.db_manager.transaction()
+
+    def batch_transaction(self, commit_every: int = 100):
+        """
+        大量の画像の登録を commit_every 枚ごとにコミットするコンテキストマネージャ。
+        1枚の処理が終わるたびに、返される checkpoint 関数を呼び出す。
+        コミットするまで書き込みロックを持ち続けるため、中で重い処理や完了待ちをしないこと。
+
+        使用例:
+            with idm.batch_transaction(50) as checkpoint:
+                for image_path in image_paths:
+                    ...
+                    checkpoint()
+        """
+        return self.db_manager.batch_transaction(commit_every)
+
+    def explain_query_plans(self) -> list[dict[str, Any]]:
+        """
+        検索で実行されるSQLの EXPLAIN QUERY PLAN を取得し、インデックスを使わない全件スキャンを報告する
+
+        Returns:
+            list[dict[str, Any]]: {'method', 'query', 'plan', 'full_scans'} のリスト
+        """
+        return self.repository.explain_query_plans()
+
+    def register_original_image(self, image_path: Path, fsm: FileSystemManager,
+                                handle: Optional[ImageHandle] = None) -> Optional[tuple]:
         """オリジナル画像を保存し、メタデータをデータベースに登録
 
+        前回から変更のないファイルは file_fingerprints に記録した画像情報とpHashを使い、画像をデコードしない。
+        登録済みのファイルや、内容が完全に一致する画像が登録済みのファイルは、保存せずに既存の画像を返す
+
         Args:
             image_path (Path): 画像パス
             fsm (FileSystemManager): FileSystemManager のインスタンス
+            handle (Optional[ImageHandle]): 呼び出し元で開いた画像。指定すると画像情報とpHashを共有する
 
         Returns:
             Optional[tuple]: 登録成功時は (image_id, original_metadata)、失敗時は None
         """
+        stored = self.store_original_image(image_path, fsm, handle)
+        if stored is None or stored[0] is not None:
+            return stored
+        original_image_metadata = stored[1]
         try:
-            original_image_metadata = fsm.get_image_info(image_path)
-            db_stored_original_path = fsm.save_original_image(image_path)
+            return self.add_stored_original_image(image_path, original_image_metadata), original_image_metadata
+        except Exception as e:
+            self.logger.error(f"オリジナル画像の登録中にエラーが発生しました: {e}")
+            Path(original_image_metadata['stored_image_path']).unlink(missing_ok=True)
+            return None
+
+    def store_original_image(self, image_path: Path, fsm: FileSystemManager,
+                             handle: Optional[ImageHandle] = None) -> Optional[tuple]:
+        """register_original_image のうち、登録済みかの判定とファイルの保存だけを行う
+
+        ファイルのコピーを書き込みの transaction の外で行えるよう、images への追加は add_stored_original_image で行う
+
+        Args:
+            image_path (Path): 画像パス
+            fsm (FileSystemManager): FileSystemManager のインスタンス
+            handle (Optional[ImageHandle]): 呼び出し元で開いた画像。指定すると画像情報とpHashを共有する
+
+        Returns:
+            Optional[tuple]: 登録済みの場合は (image_id, original_metadata)、保存した場合は (None, original_metadata)、
+            失敗時は None
+        """
+        try:
+            key = file_fingerprint_key(image_path)
+            fingerprint = self.repository.get_file_fingerprints([key]).get(key[0]) if key else None
+            if fingerprint and fingerprint['image_id'] is not None:
+                metadata = self.repository.get_image_metadata(fingerprint['image_id'])
+                if metadata:
+                    self.logger.info(f"登録済みのファイルです: {image_path} (ID {fingerprint['image_id']})")
+                    return fingerprint['image_id'], metadata
+
+            sha256 = None
+            if key:
+                sha256 = (fingerprint and fingerprint['sha256']) or FileSystemManager.calculate_sha256(image_path)
+                duplicate = self.repository.find_images_by_content_hash([sha256]).get(sha256)
+                if duplicate is not None:
+                    self.logger.info(f"同じ内容の画像が登録済みです: {image_path} (ID {duplicate})")
+                    cached = {**fingerprint['info'], 'phash': fingerprint['phash']} if fingerprint and fingerprint['info'] else {}
+                    self.repository.save_file_fingerprints([(key, {**cached, 'sha256': sha256}, duplicate)])
+                    return duplicate, self.repository.get_image_metadata(duplicate)
+
+            if fingerprint and fingerprint['info']:
+                original_image_metadata = {**fingerprint['info'], 'phash': fingerprint['phash'], 'sha256': sha256}
+            elif handle is not None:
+                original_image_metadata = handle.info
+                if key:
+                    original_image_metadata['phash'] = handle.phash
+                    original_image_metadata['sha256'] = sha256
+            else:
+                original_image_metadata = fsm.get_image_info(image_path)
+                if key:
+                    # 保存したコピーから計算し直さないよう、元のファイルから求めておく
+                    original_image_metadata['phash'] = calculate_phash(image_path)
+                    original_image_metadata['sha256'] = sha256
+            db_stored_original_path = fsm.save_original_image(image_path, content_hash=sha256)
             # UUIDの生成
             image_uuid = str(uuid.uuid4())
             # メタデータにUUIDと保存パスを追加
@@ -1134,13 +2512,258 @@ class ImageDatabaseManager:
                 'uuid': image_uuid,
                 'stored_image_path': str(db_stored_original_path)
             })
-            # データベースに挿入
-            image_id = self.repository.add_original_image(original_image_metadata)
-            return image_id, original_image_metadata
+            return None, original_image_metadata
         except Exception as e:
-            self.logger.error(f"オリジナル画像の登録中にエラーが発生しました: {e}")
+            self.logger.error(f"オリジナル画像の保存中にエラーが発生しました: {e}")
             return None
 
+    def add_stored_original_image(self, image_path: Path, original_image_metadata: dict[str, Any]) -> int:
+        """
+        store_original_image で保存した画像をデータベースに登録し、file_fingerprints を更新する
+
+        Args:
+            image_path (Path): 元の画像パス
+            original_image_metadata (dict[str, Any]): store_original_image が返したメタデータ
+
+        Returns:
+            int: 登録した画像のID
+        """
+        image_id = self.repository.add_original_image(original_image_metadata)
+        key = file_fingerprint_key(image_path)
+        if key:
+            self.repository.save_file_fingerprints([(key, original_image_metadata, image_id)])
+        return image_id
+
+    def register_original_images(self, image_paths: list[Path], fsm: FileSystemManager,
+                                 progress_callback: Optional[Callable[[int], None]] = None,
+                                 is_canceled: Optional[Callable[[], bool]] = None,
+                                 max_workers: Optional[int] = None) -> list[Optional[tuple]]:
+        """複数のオリジナル画像をまとめて保存し、メタデータを1トランザクションでデータベースに登録
+
+        0. file_fingerprints から前回と変わっていないファイルの記録を取得 (stat のみ)
+        1. 記録のない画像のSHA-256をスレッドプールで計算し、内容が一致する登録済み画像を除く。
+           残りの画像の情報とpHashをプロセスプールで並列に取得
+        2. DB内の画像およびバッチ内の画像とpHashで重複を判定
+        3. 重複しない画像だけをスレッドプールで並列にコピー
+        4. executemany でまとめて INSERT し、file_fingerprints を更新
+
+        Args:
+            image_paths (list[Path]): 画像パスのリスト
+            fsm (FileSystemManager): FileSystemManager のインスタンス
+            progress_callback (Optional[Callable[[int], None]]): 進捗（0-100）を受け取るコールバック
+            is_canceled (Optional[Callable[[], bool]]): キャンセルされたかを返すコールバック
+            max_workers (Optional[int]): ワーカー数。Noneの場合はCPU数
+
+        Returns:
+            list[Optional[tuple]]: image_paths と同じ順序の (image_id, original_metadata) のリスト。
+            重複画像は既存画像の (image_id, metadata)、失敗またはキャンセル時は None
+        """
+        total = len(image_paths)
+        results: list[Optional[tuple]] = [None] * total
+        if total == 0:
+            return results
+        max_workers = max_workers or os.cpu_count() or 1
+
+        def report(value: int) -> None:
+            if progress_callback:
+                progress_callback(value)
+
+        def canceled() -> bool:
+            return bool(is_canceled and is_canceled())
+
+        # 0. 前回から変更のないファイルの記録
+        keys = [file_fingerprint_key(image_path) for image_path in image_paths]
+        fingerprints = self.repository.get_file_fingerprints([key for key in keys if key])
+        infos: list[Optional[dict[str, Any]]] = [None] * total
+        registered: dict[int, int] = {}  # 登録済みのファイルの位置 -> image_id
+        extract_indices = []
+        for index, key in enumerate(keys):
+            fingerprint = fingerprints.get(key[0]) if key else None
+            if fingerprint and fingerprint['image_id'] is not None:
+                registered[index] = fingerprint['image_id']
+            elif fingerprint and fingerprint['info']:
+                infos[index] = {**fingerprint['info'], 'phash': fingerprint['phash'], 'sha256': fingerprint['sha256']}
+            else:
+                extract_indices.append(index)
+        self.logger.info(f"{total} 件中 {total - len(extract_indices)} 件は前回から変更のないファイルです")
+
+        # 1. 内容のハッシュによる重複判定 (進捗 0-20%) と画像情報・pHashの取得 (進捗 20-50%)
+        hashes: dict[int, Optional[str]] = {}
+        def calculate_hash(index: int) -> Optional[str]:
+            try:
+                return FileSystemManager.calculate_sha256(image_paths[index])
+            except OSError as e:
+                self.logger.error(f"ファイルの読み込み中にエラーが発生しました: {image_paths[index]}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as thread_pool:
+            for done, (index, sha256) in enumerate(zip(extract_indices, thread_pool.map(calculate_hash, extract_indices))):
+                hashes[index] = sha256
+                report(int((done + 1) / len(extract_indices) * 20))
+        same_content = self.repository.find_images_by_content_hash(list(hashes.values()))
+        for index, sha256 in hashes.items():
+            if sha256 in same_content:
+                registered[index] = same_content[sha256]
+                infos[index] = {'sha256': sha256}
+        self.logger.info(f"{len(extract_indices)} 件中 {sum(sha256 in same_content for sha256 in hashes.values())} 件は"
+                         f"同じ内容の画像が登録済みです")
+        extract_indices = [index for index in extract_indices if index not in registered]
+
+        extract_paths = [image_paths[index] for index in extract_indices]
+        extract_hashes = [hashes[index] for index in extract_indices]
+        if max_workers == 1 or len(extract_paths) <= 1:
+            executor = None
+            info_iter = map(extract_original_image_info, extract_paths, extract_hashes)
+        else:
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+            info_iter = executor.map(extract_original_image_info, extract_paths, extract_hashes,
+                                     chunksize=max(1, len(extract_paths) // (max_workers * 4)))
+        try:
+            for done, (index, info) in enumerate(zip(extract_indices, info_iter)):
+                infos[index] = info
+                report(20 + int((done + 1) / len(extract_paths) * 30))
+                if canceled():
+                    self.logger.info("オリジナル画像の一括登録がキャンセルされました")
+                    return results
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+        # 2. DB内およびバッチ内の重複判定
+        duplicates = self.find_duplicates_by_phashes([info.get('phash') if info else None for info in infos])
+        duplicates = [registered.get(index, image_id) for index, image_id in enumerate(duplicates)]
+        batch_index = PHashIndex()
+        batch_duplicates: dict[int, int] = {}  # バッチ内で重複した画像の位置 -> 先に登録する画像の位置
+        new_indices = []
+        for index, info in enumerate(infos):
+            if info is None or duplicates[index] is not None:
+                continue
+            phash_int = phash_to_int(info['phash'])
+            nearest = batch_index.nearest(phash_int, self.repository.phash_threshold)
+            if nearest is not None:
+                batch_duplicates[index] = nearest[1]
+                continue
+            batch_index.add(index, phash_int)
+            new_indices.append(index)
+        self.logger.info(f"{total} 件中 DB内の重複 {sum(d is not None for d in duplicates)} 件、"
+                         f"バッチ内の重複 {len(batch_duplicates)} 件、新規 {len(new_indices)} 件")
+        # 登録済みの画像と重複するものは、この後の保存や登録に失敗しても既存の画像を返す
+        existing = self.repository.get_images_metadata([image_id for image_id in duplicates if image_id is not None])
+        for index, image_id in enumerate(duplicates):
+            if image_id is not None and image_id in existing:
+                results[index] = (image_id, existing[image_id])
+        if canceled():
+            return results
+
+        # 3. 新規画像のコピー (進捗 50-90%)
+        def save(index: int) -> tuple[int, Optional[Path]]:
+            try:
+                return index, fsm.save_original_image(image_paths[index], content_hash=infos[index].get('sha256'))
+            except Exception as e:
+                self.logger.error(f"オリジナル画像の保存中にエラーが発生しました: {image_paths[index]}: {e}")
+                return index, None
+
+        def discard(stored_paths: list[Path]) -> None:
+            # 登録しなかった画像のコピーを残さない
+            for stored_path in stored_paths:
+                try:
+                    Path(stored_path).unlink(missing_ok=True)
+                except OSError as e:
+                    self.logger.error(f"保存した画像の削除中にエラーが発生しました: {stored_path}: {e}")
+
+        thread_pool = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [thread_pool.submit(save, index) for index in new_indices]
+        copy_canceled = False
+        try:
+            for done, future in enumerate(futures):
+                future.result()
+                report(50 + int((done + 1) / len(new_indices) * 40))
+                if done + 1 < len(futures) and canceled():
+                    copy_canceled = True
+                    break
+        finally:
+            thread_pool.shutdown(cancel_futures=True)
+        copied = [future.result() for future in futures if not future.cancelled()]
+        copied = [(index, stored_path) for index, stored_path in copied if stored_path is not None]
+        if copy_canceled:
+            self.logger.info("オリジナル画像の一括登録がキャンセルされました")
+            discard([stored_path for _, stored_path in copied])
+            return results
+        new_infos = []
+        for index, stored_path in copied:
+            infos[index].update({
+                'uuid': str(uuid.uuid4()),
+                'stored_image_path': str(stored_path)
+            })
+            new_infos.append((index, infos[index]))
+
+        # 4. 一括登録
+        try:
+            with self.transaction():
+                image_ids = self.repository.add_original_images([info for _, info in new_infos])
+                new_ids = {index: image_id for (index, _), image_id in zip(new_infos, image_ids)}
+                # 次回はデコードせずに済むよう、画像情報を取得したファイルを記録する
+                self.repository.save_file_fingerprints([
+                    (keys[index], info, new_ids.get(index, new_ids.get(batch_duplicates.get(index), duplicates[index])))
+                    for index, info in enumerate(infos) if info is not None and keys[index] is not None
+                ])
+        except Exception as e:
+            self.logger.error(f"オリジナル画像の一括登録中にエラーが発生しました: {e}")
+            discard([info['stored_image_path'] for _, info in new_infos])
+            return results
+        for (index, info), image_id in zip(new_infos, image_ids):
+            results[index] = (image_id, info)
+        for index, first_index in batch_duplicates.items():
+            if results[first_index] is not None:
+                results[index] = (results[first_index][0], results[first_index][1])
+        report(100)
+        return results
+
+    def fill_content_hashes(self, batch_size: int = 500, progress_callback: Optional[Callable[[int], None]] = None,
+                            is_canceled: Optional[Callable[[], bool]] = None,
+                            max_workers: Optional[int] = None) -> dict[str, int]:
+        """
+        content_hash のない登録済み画像 (content_hash を追加する前に登録したもの) のSHA-256を保存済みのファイルから計算する
+
+        ファイルの読み込みはスレッドプールで書き込みの transaction の外で行い、batch_size 件ごとに UPDATE だけを
+        短い transaction でコミットする。ファイルが見つからない画像はスキップし、pHash による判定のみとする
+
+        Args:
+            batch_size (int): 1回の transaction で更新する件数
+            progress_callback (Optional[Callable[[int], None]]): 進捗（0-100）を受け取るコールバック
+            is_canceled (Optional[Callable[[], bool]]): キャンセルされたかを返すコールバック
+            max_workers (Optional[int]): ハッシュを計算するスレッド数。Noneの場合はCPU数
+
+        Returns:
+            dict[str, int]: 'hashed'（計算した件数）, 'missing'（ファイルを読めずスキップした件数）
+        """
+        total = self.repository.count_images_without_content_hash()
+        summary = {'hashed': 0, 'missing': 0}
+
+        def calculate_hash(row: sqlite3.Row) -> Optional[tuple[str, int]]:
+            try:
+                return FileSystemManager.calculate_sha256(Path(row['stored_image_path'])), row['id']
+            except OSError as e:
+                self.logger.warning(f"content_hash を計算できない画像をスキップします (ID {row['id']}): {e}")
+                return None
+
+        after_id = 0
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as thread_pool:
+            while not (is_canceled and is_canceled()):
+                rows = self.repository.get_images_without_content_hash(after_id, batch_size)
+                if not rows:
+                    break
+                hashes = [result for result in thread_pool.map(calculate_hash, rows) if result is not None]
+                with self.transaction():
+                    self.repository.update_content_hashes(hashes)
+                after_id = rows[-1]['id']
+                summary['hashed'] += len(hashes)
+                summary['missing'] += len(rows) - len(hashes)
+                if progress_callback and total:
+                    progress_callback(int((summary['hashed'] + summary['missing']) / total * 100))
+        self.logger.info(f"content_hash を {summary['hashed']} 件計算しました (スキップ {summary['missing']} 件)")
+        return summary
+
     def register_processed_image(self, image_id: int, processed_path: Path, info: dict[str, Any]) -> Optional[int]:
         """
         処理済み画像を保存し、メタデータをデータベースに登録します。
@@ -1190,7 +2813,8 @@ class ImageDatabaseManager:
         self.logger.debug(f"Type of annotations: {type(annotations)}")
 
         try:
-            self.repository.save_annotations(image_id, annotations)
+            with self.transaction():
+                self.repository.save_annotations(image_id, annotations)
             self.logger.info(f"画像 ID {image_id} のアノテーション{annotations}を保存しました")
         except Exception as e:
             self.logger.error(f"アノテーションの保存中にエラーが発生しました: {e}")
@@ -1260,6 +2884,23 @@ class ImageDatabaseManager:
             self.logger.error(f"画像メタデータ取得中にエラーが発生しました: {e}")
             raise
 
+    def get_processed_images(self, image_ids: Iterable[int], resolution: int = 0) -> dict[int, dict[str, Any]]:
+        """
+        複数の画像について、解像度に合う処理済み画像をまとめて取得します。
+
+        Args:
+            image_ids (Iterable[int]): 元画像のID。
+            resolution (int): 目標解像度。0の場合は最も解像度が低い画像を選びます。
+
+        Returns:
+            dict[int, dict[str, Any]]: image_id -> 処理済み画像のメタデータ。該当する画像がないIDは含みません。
+        """
+        try:
+            return self.repository.get_processed_images(image_ids, resolution)
+        except Exception as e:
+            self.logger.error(f"処理済み画像の一括取得中にエラーが発生しました: {e}")
+            raise
+
     def get_processed_metadata(self, image_id: int) -> Optional[list[dict[str, Any]]]:
         """
         指定された元画像IDに関連する全ての処理済み画像のメタデータを取得します。
@@ -1305,6 +2946,39 @@ class ImageDatabaseManager:
             self.logger.error(f"画像アノテーション取得中にエラーが発生しました: {e}")
             raise
 
+    def get_annotations_for_images(self, image_ids: Iterable[int]) -> dict[int, dict[str, list[dict[str, Any]]]]:
+        """
+        複数の画像のアノテーション（タグ、キャプション、スコア）をまとめて取得します。
+
+        Args:
+            image_ids (Iterable[int]): アノテーションを取得する画像のID。
+
+        Returns:
+            dict[int, dict[str, list[dict[str, Any]]]]: image_id -> get_image_annotations と同じ形式の辞書。
+
+        Raises:
+            Exception: アノテーションの取得に失敗した場合。
+        """
+        try:
+            return self.repository.get_annotations_for_images(image_ids)
+        except Exception as e:
+            self.logger.error(f"画像アノテーションの一括取得中にエラーが発生しました: {e}")
+            raise
+
+    def iter_annotations_for_images(self, image_ids: Iterable[int],
+                                    chunk_size: int = 5000) -> Iterator[dict[int, dict[str, list[dict[str, Any]]]]]:
+        """
+        複数の画像のアノテーションを chunk_size 件ずつ取得します。大量の画像を出力する場合に使用します。
+
+        Args:
+            image_ids (Iterable[int]): アノテーションを取得する画像のID。
+            chunk_size (int): 1回に取得する画像数。
+
+        Yields:
+            dict[int, dict[str, list[dict[str, Any]]]]: image_id -> アノテーションの辞書。
+        """
+        return self.repository.iter_annotations_for_images(image_ids, chunk_size)
+
     def get_models(self) -> tuple[dict[int, dict[str, Any]], dict[int, dict[str, Any]]]:
         """
         TODO: データベースに問い合わせるのでImageRepositoryに移動したほうがキレイ その時処理は分割する
@@ -1340,8 +3014,11 @@ class ImageDatabaseManager:
 
     def get_images_by_filter(self, tags: list[str] = None, caption: str = None, resolution: int = 0, 
                              use_and: bool = True, start_date: str = None, end_date: str = None, 
-                             include_untagged: bool = False, include_nsfw: bool = False) -> tuple[list[dict[str, Any]], int]:
+                             include_untagged: bool = False, include_nsfw: bool = False,
+                             limit: Optional[int] = None, offset: int = 0,
+                             after_id: Optional[int] = None) -> tuple[list[dict[str, Any]], int]:
         """
+        検索条件を1つのSQL文にまとめて画像を検索する
 
         Args:
             tags (list[str], optional): カンマ区切りをリスト化したタグ. Defaults to None.
@@ -1352,9 +3029,12 @@ class ImageDatabaseManager:
             end_date (str,): 検索する画像の作成日時の上限
             include_untagged (bool, optional): タグが付いていない画像のみを取得. Defaults to False.
             include_nsfw (bool, optional): NSFW画像を含めるかどうか. Defaults to False.
+            limit (Optional[int], optional): 1ページの件数。Noneの場合は全件. Defaults to None.
+            offset (int, optional): 読み飛ばす件数. Defaults to 0.
+            after_id (Optional[int], optional): 前のページの最後の image_id。指定するとその次から取得する. Defaults to None.
 
         Returns:
-            tuple[list[dict[str, Any]], int]: 条件にマッチした画像データのリストとその数
+            tuple[list[dict[str, Any]], int]: 条件にマッチした画像データのリスト(image_id 順)とページングする前の件数
             例:([
                 {'id': 516, 'image_id': 515, 'stored_image_path': 'psth', 
                 'width': 1024, 'height': 768, 'mode': 'RGB', 'has_alpha': 0, 'filename': '1_240925_00304.webp', 'color_space': 'RGB', 'icc_profile': 'Not present', 'created_at': '2024-09-26T20:21:08.451199', 'updated_at': '2024-09-26T20:21:08.451199'},
@@ -1364,134 +3044,131 @@ class ImageDatabaseManager:
         """
         if not tags and not caption and not include_untagged:
             self.logger.info("タグもキャプションも指定されていない")
-            return None, 0
+            return [], 0
 
         # 現在の日付を取得
         current_datetime = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
         start_date = start_date or ('2020-01-01 00:00:00')  # 2020年1月1日
         end_date = end_date or current_datetime  # 現在
 
-        image_ids = set()
+        if include_untagged and (tags or caption):
+            self.logger.warning("検索語句とinclude_untaggedが同時に指定されています。検索語句を無視します。")
 
-        if include_untagged:
-            if tags or caption:
-                self.logger.warning("検索語句とinclude_untaggedが同時に指定されています。検索語句を無視します。")
-            untagged_image_ids = set(self.repository.get_untagged_images())
-            image_ids.update(untagged_image_ids)
-
-        # タグによるフィルタリング
-        if tags and not include_untagged:
-            tag_results = [set(self.repository.get_images_by_tag(tag, start_date, end_date)) for tag in tags]
-            if tag_results:
-                image_ids = set.intersection(*tag_results) if use_and else set.union(*tag_results)
-
-        # キャプションによるフィルタリング
-        if caption and not include_untagged:
-            caption_results = set(self.repository.get_images_by_caption(caption, start_date, end_date))
-            image_ids = image_ids.intersection(caption_results) if image_ids else caption_results
-
-        # image_idsが空の場合は空リストを返す
-        if not image_ids:
-            self.logger.info("条件に一致する画像が見つかりませんでした")
-            return [], 0
-
-        # image_idsの画像のアノテーションを取得､キーワード一致するNSFWが含まれるimage_idを除外
-        if not include_nsfw:
-            exclude_keywords = ['nsfw', 'explicit', 'sex', 'pussy', 'nude', 'penis', 'cum', 'bdsm', 'explicit']  # 除外したいキーワードのリスト
-            image_ids = self._filter_images_by_exclude_keywords(image_ids, exclude_keywords)
-
-        # 画像メタデータの取得
-        metadata_list = []
-        if resolution != 0:
-            for image_id in image_ids:
-                metadata = self.repository.get_processed_image(image_id, resolution)
-                if metadata is not None:
-                    metadata_list.append(metadata)
-        else:
-            for image_id in image_ids:
-                metadata = self.repository.get_original_image(image_id)
-                if metadata is not None:
-                    metadata['image_id'] = image_id
-                    metadata_list.append(metadata)
+        # image_flags でNSFWとされた画像を除外
+        metadata_list, list_count = self.repository.find_images(
+            tags=tags, caption=caption, resolution=resolution, use_and=use_and,
+            start_date=start_date, end_date=end_date, include_untagged=include_untagged,
+            exclude_nsfw=not include_nsfw, limit=limit, offset=offset, after_id=after_id
+        )
 
-        if not metadata_list:
-            self.logger.info(f'解像度基準:{resolution} pxの画像はDBに登録されていません')
-            return None, None
+        if not list_count:
+            if resolution != 0:
+                self.logger.info(f'解像度基準:{resolution} pxで条件に一致する画像はDBに登録されていません')
+            else:
+                self.logger.info("条件に一致する画像が見つかりませんでした")
+            return [], 0
 
-        list_count = len(metadata_list)
         self.logger.info(f"フィルタリング後の画像数: {list_count}")
 
         return metadata_list, list_count
 
-    def _filter_images_by_exclude_keywords(self, image_ids: set[int], exclude_keywords: list[str]) -> set[int]:
-        """
-        指定された除外キーワードがタグまたはキャプションに含まれる画像IDを除外して、フィルタリングされた画像IDのセットを返します。
-
-        引数:
-            image_ids (set[int]): フィルタリング対象の画像IDのセット。
-            exclude_keywords (list[str]): 除外キーワードのリスト。これらのキーワードを含む画像は除外されます。
-
-        戻り値:
-            set[int]: 除外キーワードが一致しない画像IDのセット。
-
-        方法:
-            1. `image_ids` の各画像IDに対して、その画像のタグとキャプションのアノテーションを取得します。
-            2. タグとキャプションを小文字に変換し、大文字小文字を区別せずに比較します。
-            3. 除外キーワードのいずれかがタグまたはキャプションに含まれているかを確認します。
-            4. 除外キーワードが一致する場合、その画像IDを `image_ids` から削除します。
-            5. フィルタリングされた画像IDのセットを返します。
-        """
-        image_ids_copy = image_ids.copy()  # `set` のコピーを作成します
-        for image_id in image_ids_copy:
-            annotations = self.repository.get_image_annotations(image_id)
-            tags = [tag['tag'].lower() for tag in annotations.get('tags', [])]
-            captions = [caption['caption'].lower() for caption in annotations.get('captions', [])]
-            # 除外キーワードのチェック
-            annotations = tags + captions
-            exclude_match = any(keyword.lower() in annotation for keyword in exclude_keywords for annotation in annotations)
-
-            if exclude_match:
-                image_ids.remove(image_id)  # `set` から直接削除します
-
-        return image_ids
-
-    def detect_duplicate_image(self, image_path: Path) -> Optional[int]:
+    def detect_duplicate_image(self, image_path: Path, handle: Optional[ImageHandle] = None) -> Optional[int]:
         """
         画像の重複を検出し、重複する場合はその画像のIDを返す。
-        名前による高速な検索と、pHashによる正確な重複検知を組み合わせて使用。
+        file_fingerprints の記録、名前による高速な検索、内容のハッシュによる完全一致、pHashによる重複検知の順に使用。
 
         Args:
             image_path (Path): 検査する画像ファイルのパス
+            handle (Optional[ImageHandle]): 呼び出し元で開いた画像。指定するとpHashの計算でデコードした画像を後の処理と共有する
 
         Returns:
             Optional[int]: 重複する画像が見つかった場合はそのimage_id、見つからない場合はNone
         """
         image_name = image_path.name
 
-        # まず名前で高速に検索
+        # 前回から変更のないファイルは記録した結果を使う
+        key = file_fingerprint_key(image_path)
+        fingerprint = self.repository.get_file_fingerprints([key]).get(key[0]) if key else None
+        if fingerprint and fingerprint['image_id'] is not None:
+            self.logger.info(f"登録済みのファイルを検出: {image_name}")
+            return fingerprint['image_id']
+
+        # 名前で高速に検索
         image_id = self.repository.get_image_id_by_name(image_name)
         if image_id is not None:
             self.logger.info(f"画像名の一致を検出: {image_name}")
             return image_id
 
-        # 名前で見つからない場合、pHashを計算して検索
         try:
-            with Image.open(image_path) as img:
-                phash = str(imagehash.phash(img))
+            # 名前で見つからない場合、デコードせずに内容のハッシュで検索
+            sha256 = None
+            if key:
+                sha256 = (fingerprint and fingerprint['sha256']) or FileSystemManager.calculate_sha256(image_path)
+                image_id = self.repository.find_images_by_content_hash([sha256]).get(sha256)
+                if image_id is not None:
+                    self.logger.info(f"内容の一致を検出: {image_name}")
+                    cached = {**fingerprint['info'], 'phash': fingerprint['phash']} if fingerprint and fingerprint['info'] else {}
+                    self.repository.save_file_fingerprints([(key, {**cached, 'sha256': sha256}, image_id)])
+                    return image_id
+
+            # 完全に一致する画像がない場合、pHashで検索
+            info = None
+            if fingerprint and fingerprint['phash']:
+                phash = fingerprint['phash']
+            else:
+                # 登録する場合にデコードし直さないよう、画像情報もまとめて取得して記録する
+                info = extract_original_image_info(image_path, sha256, handle)
+                if info is None:
+                    return None
+                phash = info['phash']
 
             image_id = self.repository.get_image_id_by_phash(phash)
             if image_id is not None:
                 self.logger.info(f"pHashの一致を検出: {image_name}")
+            if key and info:
+                self.repository.save_file_fingerprints([(key, info, image_id)])
             return image_id
         except Exception as e:
             self.logger.error(f"pHash計算中にエラーが発生: {e}")
             return None
 
+    def find_duplicates_by_phashes(self, phashes: list[str], threshold: Optional[int] = None) -> list[Optional[int]]:
+        """
+        複数画像のpHashをまとめてDB内の全画像と比較し、類似画像のIDを返す
+        全pHashをuint64配列として読み込み、XORとビットカウントで距離を一括計算する
+
+        Args:
+            phashes (list[str]): 検査する画像のpHash（16進数表記）のリスト
+            threshold (Optional[int]): 許容するハミング距離。Noneの場合はリポジトリの設定値を使用。
+
+        Returns:
+            list[Optional[int]]: phashes と同じ順序の類似画像IDのリスト。見つからない場合や解釈できないpHashはNone
+        """
+        threshold = self.repository.phash_threshold if threshold is None else threshold
+        results: list[Optional[int]] = [None] * len(phashes)
+        valid = [(i, phash_to_int(phash)) for i, phash in enumerate(phashes)]
+        valid = [(i, value) for i, value in valid if value is not None and value < 1 << 64]
+        if not valid:
+            return results
+
+        db_ids, db_hashes = self.repository.get_all_phashes()
+        queries = np.array([value for _, value in valid], dtype=np.uint64)
+        matches = nearest_phashes(queries, db_hashes, db_ids, threshold)
+        for (i, _), image_id in zip(valid, matches):
+            results[i] = image_id
+        self.logger.info(f"{len(phashes)} 件のpHashを {len(db_ids)} 件の登録画像と比較し、"
+                         f"{sum(r is not None for r in results)} 件の類似画像を検出しました")
+        return results
+
     def get_total_image_count(self):
         """データベース内に登録された編集前画像の総数を取得"""
         count = self.repository.get_total_image_count()
         return count
 
+    def count_images_without_content_hash(self) -> int:
+        """content_hash のない登録済み画像の数を取得"""
+        return self.repository.count_images_without_content_hash()
+
     def check_processed_image_exists(self, image_id: int, target_resolution: int) -> Optional[dict]:
         """
         指定された画像IDと目標解像度に一致する処理済み画像が存在するかチェックします。
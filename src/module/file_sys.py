@@ -1,6 +1,8 @@
 import os
+import time
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageCms
 Image.MAX_IMAGE_PIXELS = 1000000000 #クソデカファイルに対応､ローカルアプリななので攻撃の心配はない
 from io import BytesIO
@@ -8,12 +10,22 @@ import math
 import json
 import toml
 import shutil
+import hashlib
+import threading
+import uuid
 from module.log import get_logger
 from datetime import datetime
+try:
+    import fcntl
+except ImportError:  # Windows ではリフリンクを使わない
+    fcntl = None
 
 class FileSystemManager:
     logger = get_logger("FileSystemManager")
     image_extensions = ['.jpg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.jpeg', '.webp']
+    _save_lock = threading.Lock()  # 複数スレッドから保存する際の保存先ファイル名の予約用
+    ORIGINAL_STORES = ('dated', 'content')  # 元画像の保存方式 日付ごとのディレクトリ / 内容のハッシュで決まるパス
+    FICLONE = 0x40049409  # linux/fs.h のリフリンク用 ioctl 番号
     def __init__(self):
         self.logger = FileSystemManager.logger
         self.initialized = False
@@ -21,6 +33,8 @@ class FileSystemManager:
         self.image_dataset_dir = None
         self.resolution_dir = None
         self.original_images_dir = None
+        self.original_store = 'dated'
+        self.content_store_dir = None
         self.resized_images_dir = None
         self.batch_request_dir = None
         self.logger.debug("初期化")
@@ -36,14 +50,19 @@ class FileSystemManager:
             self.logger.error("FileSystemManager使用中にエラーが発生: %s",exc_val)
         return False  # 例外を伝播させる
 
-    def initialize(self, output_dir: Path, target_resolution: int):
+    def initialize(self, output_dir: Path, target_resolution: int, original_store: str = 'dated'):
         """
-        FileSystemManagerを初期化｡ 2つの引数はGUI操作で変更可能
+        FileSystemManagerを初期化｡ output_dir と target_resolution はGUI操作で変更可能
 
         Args:
             output_dir (Path): 出力ディレクトリのパス
             target_resolution (int): 学習元モデルのベース解像度
+            original_store (str): 元画像の保存方式。'dated' は日付ごとのディレクトリにコピーし、
+                'content' は内容のSHA-256から決まるパスにリンクかコピーで保存する
         """
+        if original_store not in self.ORIGINAL_STORES:
+            raise ValueError(f"元画像の保存方式が不正です: {original_store}")
+        self.original_store = original_store
         # 画像出力ディレクトリをセットアップ
         self.image_dataset_dir = output_dir / 'image_dataset'
         original_dir = self.image_dataset_dir / 'original_images'
@@ -54,6 +73,9 @@ class FileSystemManager:
         self.original_images_dir = original_dir / current_date
         self.resized_images_dir = self.resolution_dir / current_date
 
+        # 内容のハッシュで保存先を決める場合は日付によらず同じディレクトリを使う
+        self.content_store_dir = original_dir / 'objects'
+
         # batch Request jsonl ファイルの保存先
         self.batch_request_dir = output_dir / 'batch_request_jsonl'
 
@@ -64,6 +86,8 @@ class FileSystemManager:
             self.image_dataset_dir, original_dir, self.resolution_dir,
             self.original_images_dir, self.resized_images_dir,self.batch_request_dir
         ]
+        if original_store == 'content':
+            directories_to_create.append(self.content_store_dir)
         for dir_path in directories_to_create:
             self._create_directory(dir_path)
 
@@ -117,38 +141,52 @@ class FileSystemManager:
         """
         try:
             with Image.open(image_path) as img:
-                width, height = img.size
-                format_value = img.format.lower() if img.format else 'unknown'
-                mode = img.mode
-                # アルファチャンネル画像情報 BOOL
-                has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
-
-            # 色域情報の詳細な取得
-            color_space = mode
-            icc_profile = img.info.get('icc_profile')
-            if icc_profile:
-                try:
-                    profile = ImageCms.ImageCmsProfile(BytesIO(icc_profile))
-                    color_space = ImageCms.getProfileName(profile).strip()
-                except:
-                    pass
-
-            return {
-                'width': width,
-                'height': height,
-                'format': format_value,
-                'mode': mode,
-                'has_alpha': has_alpha,
-                'filename': image_path.name,
-                'extension': image_path.suffix,
-                'color_space': color_space,
-                'icc_profile': 'Present' if icc_profile else 'Not present'
-            }
+                return FileSystemManager.image_info(img, image_path)
         except Exception as e:
             message = f"画像情報の取得失敗: {image_path}. FileSystemManager.get_image_info: {str(e)}"
             FileSystemManager.logger.error(message)
             raise
 
+    @staticmethod
+    def image_info(img: Image.Image, image_path: Path) -> dict[str, Any]:
+        """
+        開いた画像のヘッダーから get_image_info と同じ情報を取得する 画素はデコードしない
+
+        Args:
+            img (Image.Image): Image.open で開いた画像
+            image_path (Path): 画像ファイルのパス
+
+        Returns:
+            dict[str, Any]: 画像の基本情報
+        """
+        width, height = img.size
+        format_value = img.format.lower() if img.format else 'unknown'
+        mode = img.mode
+        # アルファチャンネル画像情報 BOOL
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+        # 色域情報の詳細な取得
+        color_space = mode
+        icc_profile = img.info.get('icc_profile')
+        if icc_profile:
+            try:
+                profile = ImageCms.ImageCmsProfile(BytesIO(icc_profile))
+                color_space = ImageCms.getProfileName(profile).strip()
+            except:
+                pass
+
+        return {
+            'width': width,
+            'height': height,
+            'format': format_value,
+            'mode': mode,
+            'has_alpha': has_alpha,
+            'filename': image_path.name,
+            'extension': image_path.suffix,
+            'color_space': color_space,
+            'icc_profile': 'Present' if icc_profile else 'Not present'
+        }
+
     def _get_next_sequence_number(self, save_dir: str | Path ) -> int:
         """
         処理後画像のリネーム書利用連番
@@ -179,56 +217,267 @@ class FileSystemManager:
         Returns:
             Path: 保存された画像のパス
         """
+        new_filename = None
+        reserved_path = None
         try:
             parent_name = original_path.parent.name
             parent_dir = self.resized_images_dir / parent_name # type: ignore
             self._create_directory(parent_dir)
 
-            sequence = self._get_next_sequence_number(parent_dir)
-            new_filename = f"{parent_name}_{sequence:05d}.webp"
-            output_path = parent_dir /new_filename
+            # 並列保存時に同じ連番を取り合わないよう、ロック内で空ファイルを作成して名前を予約する
+            with FileSystemManager._save_lock:
+                sequence = self._get_next_sequence_number(parent_dir)
+                new_filename = f"{parent_name}_{sequence:05d}.webp"
+                output_path = parent_dir /new_filename
+                while output_path.exists():
+                    sequence += 1
+                    new_filename = f"{parent_name}_{sequence:05d}.webp"
+                    output_path = parent_dir /new_filename
+                output_path.touch()
+                reserved_path = output_path
 
             image.save(output_path)
             self.logger.info("処理済み画像を保存: %s", output_path)
             return output_path
         except Exception as e:
+            # 予約した名前の空ファイルが連番に数えられて残らないよう削除する
+            if reserved_path is not None:
+                reserved_path.unlink(missing_ok=True)
             self.logger.error("処理済み画像の保存に失敗: %s. FileSystemManager.save_original_image: %s", new_filename, str(e))
             raise
 
     @staticmethod
-    def copy_file(src: Path, dst: Path, buffer_size: int = 64 * 1024 * 1024):  # デフォルト64MB
+    def calculate_sha256(file_path: Path, buffer_size: int = 1024 * 1024) -> str:
+        """
+        ファイルの内容のSHA-256を計算する
+
+        Args:
+            file_path (Path): ファイルのパス
+            buffer_size (int): 1回に読み込むバイト数
+
+        Returns:
+            str: 16進数表記のSHA-256
+        """
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(buffer_size):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _copy_file_range(src: Path, dst: Path) -> bool:
+        """
+        os.copy_file_range でカーネル内でコピーする (Linux)。データがユーザー空間を経由せず、
+        対応するファイルシステムではリフリンクやサーバー側コピーになる
+
+        Returns:
+            bool: コピーできた場合は True。使えない場合は何も書き込まずに False
+        """
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            copied = 0
+            try:
+                while n := os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    copied += n
+            except OSError:
+                # 別のファイルシステム間などで使えない場合は shutil.copyfile に任せる
+                if copied == 0:
+                    return False
+                raise
+        return True
+
+    @classmethod
+    def copy_file(cls, src: Path, dst: Path, buffer_size: int = 8 * 1024 * 1024,
+                  calculate_hash: bool = False) -> Optional[str]:
+        """
+        ファイルをコピーする独自の関数。異なるドライブ間でのコピーにも対応。
+        ハッシュが不要な場合は copy_file_range、使えなければ shutil.copyfile (sendfile など OS ごとの高速なコピー) を使う。
+        ハッシュが必要な場合は1つのバッファを使い回して読み込みながらSHA-256を計算する。
+        更新日時などのメタデータはコピー後に1回だけ設定する。
+
+        Args:
+            src (Path): コピー元のファイルパス
+            dst (Path): コピー先のファイルパス
+            buffer_size (int): ハッシュを計算する場合のバッファサイズ（バイト）。デフォルトは8MB。
+            calculate_hash (bool): コピーした内容のSHA-256を計算する場合は True
+
+        Returns:
+            Optional[str]: calculate_hash が True の場合はコピーした内容の16進数表記のSHA-256、それ以外は None
+        """
+        content_hash = None
+        if calculate_hash:
+            sha256 = hashlib.sha256()
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                while n := fsrc.readinto(buffer):
+                    sha256.update(view[:n])
+                    fdst.write(view[:n])
+            content_hash = sha256.hexdigest()
+        elif not cls._copy_file_range(src, dst):
+            shutil.copyfile(src, dst)
+
+        # ファイルの更新日時とパーミッションを設定
+        shutil.copystat(src, dst)
+        return content_hash
+
+    @classmethod
+    def copy_files(cls, files: list[tuple[Path, Path]], max_workers: int = 4,
+                   progress_callback: Optional[Callable[[int], None]] = None) -> dict[str, Any]:
+        """
+        複数のファイルをスレッドプールで並列にコピーする。
+        コピー中は GIL を解放するので、ディスクの待ち時間を重ねられる。
+
+        Args:
+            files (list[tuple[Path, Path]]): (コピー元, コピー先) のリスト
+            max_workers (int): 同時にコピーするファイル数の上限
+            progress_callback (Optional[Callable[[int], None]]): コピーが終わったファイル数を受け取るコールバック
+
+        Returns:
+            dict[str, Any]: コピーしたファイル数 'copied'、失敗したファイル数 'failed'、コピーしたバイト数 'bytes'、
+                かかった秒数 'seconds'、1秒あたりのバイト数 'bytes_per_second'
+        """
+        def copy(pair: tuple[Path, Path]) -> int:
+            src, dst = pair
+            try:
+                cls.copy_file(src, dst)
+                return os.path.getsize(dst)
+            except OSError as e:
+                cls.logger.error("ファイルのコピーに失敗: %s -> %s: %s", src, dst, e)
+                return -1
+
+        start = time.perf_counter()
+        copied, failed, total_bytes = 0, 0, 0
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for done, size in enumerate(executor.map(copy, files), 1):
+                if size < 0:
+                    failed += 1
+                else:
+                    copied += 1
+                    total_bytes += size
+                if progress_callback:
+                    progress_callback(done)
+        seconds = time.perf_counter() - start
+        bytes_per_second = total_bytes / seconds if seconds > 0 else 0.0
+        if files:
+            cls.logger.info("%d 件 (%.1f MB) を %.2f 秒でコピーしました (%.1f MB/s)",
+                            copied, total_bytes / 1024 ** 2, seconds, bytes_per_second / 1024 ** 2)
+        return {'copied': copied, 'failed': failed, 'bytes': total_bytes, 'seconds': round(seconds, 3),
+                'bytes_per_second': round(bytes_per_second)}
+
+    @classmethod
+    def reflink_file(cls, src: Path, dst: Path) -> bool:
         """
-        ファイルをコピーする独自の関数。
-        異なるドライブ間でのコピーにも対応。
+        FICLONE で dst を src のリフリンクとして作成する。データは書き込み時までコピーされない (Btrfs, XFS など)
 
         Args:
             src (Path): コピー元のファイルパス
             dst (Path): コピー先のファイルパス
-            buffer_size (int): バッファサイズ（バイト）。デフォルトは64MB。
-        """
-        with open(src, 'rb') as fsrc:
-            with open(dst, 'wb') as fdst:
-                while True:
-                    buffer = fsrc.read(buffer_size)
-                    if not buffer:
-                        break
-                    fdst.write(buffer)
-
-        # ファイルの更新日時と作成日時を設定
-        os.utime(dst, (os.path.getatime(src), os.path.getmtime(src)))
+
+        Returns:
+            bool: 作成できた場合は True。ファイルシステムが対応していない、別のボリュームの場合は False
+        """
+        if fcntl is None:
+            return False
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), cls.FICLONE, fsrc.fileno())
+        except OSError:
+            Path(dst).unlink(missing_ok=True)
+            return False
         shutil.copystat(src, dst)
+        return True
+
+    @classmethod
+    def link_or_copy_file(cls, src: Path, dst: Path, content_hash: str = None) -> str:
+        """
+        同じボリューム上ならリフリンクかハードリンクで、データを複製せずに dst を作成する。できない場合はコピーする。
+        一時ファイルを作ってから置き換えるので、中断しても dst に書きかけのファイルは残らない。
+
+        Args:
+            src (Path): コピー元のファイルパス
+            dst (Path): コピー先のファイルパス
+            content_hash (str): src のSHA-256。コピーした場合は内容と一致するか確認する
+
+        Returns:
+            str: 作成方法 'reflink', 'hardlink', 'copy' のいずれか
+
+        Raises:
+            ValueError: コピーした内容が content_hash と一致しない場合
+        """
+        tmp_path = dst.with_name(f".{dst.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            if cls.reflink_file(src, tmp_path):
+                method = 'reflink'
+            else:
+                try:
+                    os.link(src, tmp_path)
+                    method = 'hardlink'
+                except OSError:
+                    method = 'copy'
+                    copied_hash = cls.copy_file(src, tmp_path, calculate_hash=bool(content_hash))
+                    if content_hash and copied_hash != content_hash:
+                        raise ValueError(f"コピー中に元画像が変更されました: {src}")
+            os.replace(tmp_path, dst)
+            return method
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def content_store_path(self, content_hash: str, suffix: str) -> Path:
+        """
+        内容のSHA-256から元画像の保存先を決める。1つのディレクトリのファイル数を抑えるため、先頭4文字で2階層に分ける
+
+        Args:
+            content_hash (str): 元画像のSHA-256
+            suffix (str): 元画像の拡張子
+
+        Returns:
+            Path: 保存先のパス
+        """
+        return self.content_store_dir / content_hash[:2] / content_hash[2:4] / f"{content_hash}{suffix.lower()}" # type: ignore
+
+    def _save_to_content_store(self, image_file: Path, content_hash: str = None) -> Path:
+        """
+        元画像を内容のSHA-256から決まるパスに保存する。同じ内容のファイルが保存済みならそれを返す
 
-    def save_original_image(self, image_file: Path) -> Path:
+        Args:
+            image_file (Path): 保存する元画像のパス
+            content_hash (str): 元画像のSHA-256。省略した場合は計算する
+
+        Returns:
+            Path: 保存された画像のパス
+        """
+        if not content_hash:
+            content_hash = self.calculate_sha256(image_file)
+        output_path = self.content_store_path(content_hash, image_file.suffix)
+        if output_path.exists():
+            self.logger.info("同じ内容の元画像が保存済みです: %s", output_path)
+            return output_path
+        self._create_directory(output_path.parent)
+        method = self.link_or_copy_file(image_file, output_path, content_hash)
+        self.logger.info("元画像を保存 (%s): %s", method, output_path)
+        return output_path
+
+    def save_original_image(self, image_file: Path, content_hash: str = None) -> Path:
         """
         元の画像をデータベース用ディレクトリに保存します。
+        original_store が 'content' の場合は内容のSHA-256から決まるパスに、リンクかコピーで保存します。
 
         Args:
             image_file (Path): 保存する元画像のパス
+            content_hash (str): 元画像のSHA-256。指定した場合はコピーした内容と一致するか確認する
 
         Returns:
             Path: 保存された画像のパス
+
+        Raises:
+            ValueError: コピーした内容が content_hash と一致しない場合（ハッシュの計算後に元画像が変更された）
         """
+        reserved_path = None
         try:
+            if self.original_store == 'content':
+                return self._save_to_content_store(image_file, content_hash)
             # 保存先のディレクトリパスを生成
             parent_name = image_file.parent.name
             save_dir = self.original_images_dir / parent_name # type: ignore
@@ -237,17 +486,26 @@ class FileSystemManager:
             new_filename = image_file.name
             output_path = save_dir / new_filename
             # ファイル名の重複をチェックし、必要に応じて連番を付加
-            counter = 1
-            while output_path.exists():
-                new_filename = f"{image_file.stem}_{counter}{image_file.suffix}"
-                output_path = save_dir / new_filename
-                counter += 1
+            # 並列コピー時に同じ名前を取り合わないよう、ロック内で空ファイルを作成して名前を予約する
+            with FileSystemManager._save_lock:
+                counter = 1
+                while output_path.exists():
+                    new_filename = f"{image_file.stem}_{counter}{image_file.suffix}"
+                    output_path = save_dir / new_filename
+                    counter += 1
+                output_path.touch()
+                reserved_path = output_path
             # 画像をコピー
-            self.copy_file(image_file, output_path)
+            copied_hash = self.copy_file(image_file, output_path, calculate_hash=bool(content_hash))
+            if content_hash and copied_hash != content_hash:
+                raise ValueError(f"コピー中に元画像が変更されました: {image_file}")
 
             self.logger.info("元画像を保存: %s", output_path)
             return output_path
         except Exception as e:
+            # 予約した名前の空ファイルやコピー途中のファイルを残さない
+            if reserved_path is not None:
+                reserved_path.unlink(missing_ok=True)
             self.logger.error("元画像の保存に失敗: %s. FileSystemManager.save_original_image: %s", image_file, str(e))
             raise
 
@@ -295,12 +553,13 @@ class FileSystemManager:
                 f.writelines(lines[i * lines_per_file:(i + 1) * lines_per_file])
 
     @staticmethod
-    def export_dataset_to_txt(image_data: dict, save_dir: Path):
+    def export_dataset_to_txt(image_data: dict, save_dir: Path, copy_image: bool = True):
         """学習用データセットをテキスト形式で指定ディレクトリに出力する
 
         Args:
             image_data (dict]): 画像データ. 各辞書は 'path', 'tags', 'caption' をキーに持つ
             save_dir (Path): 保存先のディレクトリパス
+            copy_image (bool): 画像もコピーする場合は True。copy_files でまとめてコピーする場合は False
         """
         image_path = image_data['path']
         file_name = image_path.stem
@@ -311,20 +570,23 @@ class FileSystemManager:
         with open(save_dir / f"{file_name}.caption", "w", encoding="utf-8") as f:
             captions = ', '.join([caption_data['caption'] for caption_data in image_data['captions']])
             f.write(captions)
-        FileSystemManager.copy_file(image_path, save_dir / image_path.name)
+        if copy_image:
+            FileSystemManager.copy_file(image_path, save_dir / image_path.name)
 
     @staticmethod
-    def export_dataset_to_json(image_data: dict, save_dir: Path):
+    def export_dataset_to_json(image_data: dict, save_dir: Path, copy_image: bool = True):
         """学習用データセットをJSON形式で指定ディレクトリに出力する
 
         Args:
             image_data (list[dict]): 画像データのリスト. 各辞書は 'path', 'tags', 'caption' をキーに持つ
             save_dir (Path): 保存先のディレクトリパス
+            copy_image (bool): 画像もコピーする場合は True。copy_files でまとめてコピーする場合は False
         """
         json_data = {}
         image_path = image_data['path']
         save_image = save_dir / image_path.name
-        FileSystemManager.copy_file(image_path, save_image)
+        if copy_image:
+            FileSystemManager.copy_file(image_path, save_image)
         tags = ', '.join([tag_data['tag'] for tag_data in image_data['tags']])
         captions = ', '.join([caption_data['caption'] for caption_data in image_data['captions']])
         image_key = str(save_image)
@@ -0,0 +1,117 @@
+"""
+1枚の画像を1回だけ開いてデコードし、その結果を処理の各段階で共有するハンドル
+- ImageHandle: ヘッダーの画像情報、デコードした画像、pHash、グレースケールの縮小画像を必要になった時に1回だけ求めてキャッシュする
+
+重複チェック (pHash)、画像情報の取得、元画像の登録、クロップ・リサイズがそれぞれ同じファイルを開き直してデコードしないよう、
+ImageBatchProcessor が画像ごとに1つ生成して各処理に渡す。
+"""
+from pathlib import Path
+from typing import Any, Optional
+
+import imagehash
+from PIL import Image
+
+from module.file_sys import FileSystemManager
+
+class ImageHandle:
+    """デコード済みの画像と、そこから求めた情報をまとめて保持する
+
+    画像情報 (info, size, mode, has_alpha) はヘッダーだけから求め、画素は image、grayscale_proxy、phash を
+    参照した時に初めてデコードする。ProcessPoolExecutor に渡す場合は画素を含めず、求めた画像情報とpHashだけを渡す。
+    with 文で使うか、使い終わったら close() を呼ぶ。
+    """
+    PHASH_PROXY_SIZE = 32  # imagehash.phash が DCT の入力に縮小する大きさ (hash_size 8 × highfreq_factor 4)
+
+    def __init__(self, image_path: Path):
+        """
+        Args:
+            image_path (Path): 画像ファイルのパス
+        """
+        self.path = Path(image_path)
+        self.decode_count = 0  # 画素をデコードした回数 (計測用)
+        self._img: Optional[Image.Image] = None
+        self._decoded = False
+        self._info: Optional[dict[str, Any]] = None
+        self._phash: Optional[str] = None
+        self._grayscale_proxy: Optional[Image.Image] = None
+
+    def __enter__(self) -> 'ImageHandle':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # ワーカープロセスには画素を送らず、ヘッダーから求めた情報とpHashだけを渡す
+        return {'path': self.path, 'info': self._info, 'phash': self._phash}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__(state['path'])
+        self._info = state['info']
+        self._phash = state['phash']
+
+    def _open(self) -> Image.Image:
+        if self._img is None:
+            self._img = Image.open(self.path)
+        return self._img
+
+    @property
+    def info(self) -> dict[str, Any]:
+        """FileSystemManager.get_image_info と同じ画像情報 (呼び出し元が変更できるようコピーを返す)"""
+        if self._info is None:
+            self._info = FileSystemManager.image_info(self._open(), self.path)
+        return dict(self._info)
+
+    @property
+    def size(self) -> tuple[int, int]:
+        info = self.info
+        return info['width'], info['height']
+
+    @property
+    def mode(self) -> str:
+        return self.info['mode']
+
+    @property
+    def has_alpha(self) -> bool:
+        return self.info['has_alpha']
+
+    @property
+    def is_decoded(self) -> bool:
+        """元の解像度の画素をデコード済みかどうか"""
+        return self._decoded
+
+    @property
+    def image(self) -> Image.Image:
+        """元の解像度でデコードした画像 変更せずに参照する"""
+        img = self._open()
+        if not self._decoded:
+            img.load()
+            self._decoded = True
+            self.decode_count += 1
+        return img
+
+    @property
+    def grayscale_proxy(self) -> Image.Image:
+        """imagehash.phash と同じ方法で PHASH_PROXY_SIZE 四方に縮小したグレースケール画像"""
+        if self._grayscale_proxy is None:
+            size = (ImageHandle.PHASH_PROXY_SIZE, ImageHandle.PHASH_PROXY_SIZE)
+            self._grayscale_proxy = self.image.convert('L').resize(size, Image.Resampling.LANCZOS)
+        return self._grayscale_proxy
+
+    @property
+    def phash(self) -> str:
+        """16進数表記のpHash imagehash.phash(Image.open(path)) と同じ値"""
+        if self._phash is None:
+            self._phash = str(imagehash.phash(self.grayscale_proxy))
+        return self._phash
+
+    def release(self) -> None:
+        """ファイルとデコードした画素を解放する 求めた画像情報とpHashは残す"""
+        if self._img is not None:
+            self._img.close()
+            self._img = None
+        self._decoded = False
+        self._grayscale_proxy = None
+
+    def close(self) -> None:
+        self.release()
@@ -0,0 +1,102 @@
+"""
+データベースの行を表すレコードクラス
+- Record: sqlite3.Row を拡張し、辞書と同じように参照できる読み取り専用のレコード
+- ImageRecord などのテーブルごとのレコード
+
+SQLiteManager.fetch_one / fetch_all の record_type に指定すると、row_factory として C 実装の
+sqlite3.Row がそのまま行を生成するため、行ごとに辞書を作る dict_factory より速く、メモリ使用量も少ない。
+'_' で始まる列 (例: '_total_count') は record['_total_count'] で参照できるが、keys() には含めない。
+"""
+import sqlite3
+from collections.abc import Mapping
+from typing import Any, Iterator
+
+class Record(sqlite3.Row):
+    """辞書として参照できるレコード
+
+    record['width'], record.get('width'), record.width, dict(record), {**record} のいずれでも参照できる。
+    値は変更できないので、変更する場合は to_dict() で辞書に変換する。
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key: str) -> Any:
+        if not isinstance(key, str):
+            # sqlite3.Row は列番号やスライスも受け付けるが、辞書と同じく列名だけを受け付ける
+            raise KeyError(key)
+        try:
+            return super().__getitem__(key)
+        except IndexError:
+            raise KeyError(key) from None
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return super().__getitem__(name)
+        except IndexError:
+            raise AttributeError(f"{type(self).__name__} に列 '{name}' はありません") from None
+
+    def keys(self) -> list[str]:
+        return [key for key in super().keys() if not key.startswith('_')]
+
+    def values(self) -> list[Any]:
+        return [super(Record, self).__getitem__(key) for key in self.keys()]
+
+    def items(self) -> list[tuple[str, Any]]:
+        return [(key, super(Record, self).__getitem__(key)) for key in self.keys()]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if not isinstance(key, str):
+            return default
+        try:
+            return super().__getitem__(key)
+        except IndexError:
+            return default
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.keys()
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Mapping):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def __reduce__(self):
+        # sqlite3.Row は pickle できないので辞書として渡す
+        return dict, (self.to_dict(),)
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(self.items())
+
+Mapping.register(Record)
+
+class ImageRecord(Record):
+    """images テーブルの行 (検索結果の image_id を含む)"""
+    __slots__ = ()
+
+class ProcessedImageRecord(Record):
+    """processed_images テーブルの行"""
+    __slots__ = ()
+
+class TagRecord(Record):
+    """tags テーブルの行"""
+    __slots__ = ()
+
+class CaptionRecord(Record):
+    """captions テーブルの行"""
+    __slots__ = ()
+
+class ScoreRecord(Record):
+    """scores テーブルの行"""
+    __slots__ = ()